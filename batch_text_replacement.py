@@ -0,0 +1,72 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+エスペラント文の文字列(漢字)置換を、Streamlit を使わずにファイル単位で一括実行するスクリプト。
+(20250215_*Folder/windows_multiprocessing_成功_20250202.py の後継。
+ esp_replacement_engine_module.ReplacementEngine を1つだけ作って使い回す)
+
+使い方:
+    python batch_text_replacement.py [入力ファイル] [出力HTMLファイル]
+"""
+
+import sys
+import time
+
+from esp_replacement_engine_module import ReplacementEngine
+from esp_executor_module import DEFAULT_WORKER_START_METHOD, configure_worker_start_method
+
+# --- 1) グローバル設定 (例: プロセス数など) ---
+num_processes = 8
+format_type = 'HTML格式_Ruby文字_大小调整'  # 例: "HTML格式_Ruby文字_大小调整"
+replacement_pipeline = "placeholder"  # "span" にすると placeholder ファイルを使わずに置換する
+stream_window_chars = 256 * 1024  # 1度に読み込んで変換する文字数の目安
+use_memory_map = True  # 入力ファイルを mmap し、各プロセスが自分の範囲だけを読んで変換する
+worker_start_method = DEFAULT_WORKER_START_METHOD  # "forkserver" (使える環境の既定) / "spawn"
+
+# --- 2) 置換用JSONファイル (合并3个JSON文件) ---
+JSON_FILE = "./Appの运行に使用する各类文件/最终的な替换用リスト(列表)(合并3个JSON文件).json"
+
+# --- 3) 入力テキストファイル (エスペラント文) / 出力先HTML ---
+INPUT_TEXT_FILE = "例句_Esperanto文本.txt"
+OUTPUT_HTML_FILE = "Esperanto_Text_Replacement_Result_Multiprocessing.html"
+
+
+def main(input_path: str = INPUT_TEXT_FILE, output_path: str = OUTPUT_HTML_FILE):
+    """
+    メイン処理:
+      1) 置換用JSON + placeholder から変換エンジンを1回だけ作る
+      2) 入力テキストを窓(stream_window_chars 文字程度)ごとに読み込みながら、
+         並列(または単一プロセス)で変換
+         (use_memory_map なら、各プロセスが mmap した入力の自分の範囲だけを読んで変換する)
+      3) HTMLヘッダー/フッターを付けて、変換結果を少しずつ出力
+    (入力全体を1つの文字列として持たないので、大きなファイルでもメモリ使用量が増えない)
+    """
+    start_time = time.time()
+    engine = ReplacementEngine.from_json_file(JSON_FILE, format_type, pipeline=replacement_pipeline)
+    print(f"[準備] 変換エンジンを作成しました ({time.time() - start_time:.2f} 秒)")
+
+    start_time = time.time()
+    if use_memory_map and num_processes > 1:
+        num_bytes = engine.convert_file_mmap(
+            input_path, output_path, num_processes,
+            window_chars=stream_window_chars
+        )
+        print(f"[変換] {num_bytes} バイトを変換しました ({time.time() - start_time:.2f} 秒)")
+    else:
+        num_chars = engine.convert_file_streaming(
+            input_path, output_path,
+            window_chars=stream_window_chars,
+            num_processes=num_processes
+        )
+        print(f"[変換] {num_chars} 文字を変換しました ({time.time() - start_time:.2f} 秒)")
+
+    print(f"[完了] 変換結果を '{output_path}' に保存しました。")
+
+
+if __name__ == '__main__':
+    # Windows などでは 'spawn'。forkserver なら、サーバープロセスで置換用JSONを1回だけ読み込んでおき、
+    # 各ワーカーはそのエンジンを引き継ぐ (replacement_pipeline が既定の "placeholder" の場合)
+    configure_worker_start_method(worker_start_method, preload_ruleset_path=JSON_FILE)
+
+    main(*sys.argv[1:3])
@@ -0,0 +1,106 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+並列処理の実行方式 (esp_executor_module の "process" / "thread" / "inline") ごとの処理時間を比べるスクリプト。
+
+1) 文章の変換: ReplacementEngine.convert_parallel (毎回 executor を作り直すので、起動時間も含む)
+   と WarmWorkerPool.convert_lines (起動済みのワーカーで変換する時間だけ。ワーカーの起動時間も別に表示する)
+2) JSON 作成ページの parallel_build_pre_replacements_dict (全語根を語根自身に置換する規則で)
+を、実行方式 × プロセス(スレッド)数 ごとに実行して秒数を表示する。
+全ての実行方式の結果が直列の結果と同じかどうかも確かめる。
+
+使い方:
+    python benchmark_executor_backends.py [入力ファイル] [spawn / forkserver]
+"""
+
+import sys
+import json
+import time
+
+from esp_replacement_engine_module import ReplacementEngine
+from esp_worker_pool_module import WarmWorkerPool
+from esp_replacement_json_make_module import parallel_build_pre_replacements_dict, process_chunk_for_pre_replacements
+from esp_executor_module import (
+    EXECUTOR_BACKENDS,
+    DEFAULT_WORKER_START_METHOD,
+    is_free_threaded_build,
+    configure_worker_start_method
+)
+from esp_parallel_planning_module import available_cpu_count
+
+# --- 1) 設定 ---
+process_counts = [2, 4]
+format_type = 'HTML格式_Ruby文字_大小调整'
+replacement_pipeline = "span"  # placeholder ファイルがなくても動くように
+worker_start_method = DEFAULT_WORKER_START_METHOD  # "process" のワーカーの起動方式 ("forkserver" / "spawn")
+
+JSON_FILE = "./Appの运行に使用する各类文件/最终的な替换用リスト(列表)(合并3个JSON文件).json"
+INPUT_TEXT_FILE = "例句_Esperanto文本.txt"
+E_STEM_FILE = "./Appの运行に使用する各类文件/PEJVO(世界语全部单词列表)'全部'について、词尾(a,i,u,e,o,n等)をcutし、comma(,)で隔てて词性と併せて记录した列表(E_stem_with_Part_Of_Speech_list).json"
+E_ROOT_FILE = "./Appの运行に使用する各类文件/世界语全部词根_约11137个_202501.txt"
+
+
+def benchmark_text_conversion(input_path: str) -> None:
+    engine = ReplacementEngine.from_json_file(JSON_FILE, format_type, pipeline=replacement_pipeline)
+    with open(input_path, 'r', encoding='utf-8') as f:
+        text = f.read()
+    lines = text.splitlines(keepends=True)
+
+    started = time.perf_counter()
+    expected = engine.convert(text)
+    print(f"[変換] 直列: {time.perf_counter() - started:.2f} 秒 ({len(text)} 文字)")
+
+    for backend in EXECUTOR_BACKENDS:
+        for num_processes in process_counts:
+            engine.executor_backend = backend
+            started = time.perf_counter()
+            converted = engine.convert_parallel(text, num_processes)
+            cold_seconds = time.perf_counter() - started
+
+            with WarmWorkerPool(engine, num_processes) as pool:
+                pool.wait_until_ready()
+                started = time.perf_counter()
+                warm_converted = ''.join(pool.convert_lines(lines))
+                warm_seconds = time.perf_counter() - started
+
+            same = "一致" if converted == expected and warm_converted == expected else "不一致"
+            print(
+                f"[変換] {backend:7s} × {num_processes}: 起動込み {cold_seconds:.2f} 秒 / "
+                f"常駐 {warm_seconds:.2f} 秒 (ワーカーの起動 {pool.cold_start_seconds:.2f} 秒) ({same})"
+            )
+
+
+def benchmark_pre_replacements() -> None:
+    with open(E_STEM_FILE, 'r', encoding='utf-8') as g:
+        E_stem_with_Part_Of_Speech_list = json.load(g)
+    with open(E_ROOT_FILE, 'r', encoding='utf-8') as file:
+        E_roots = [E_root.strip() for E_root in file if E_root.strip() and not E_root.strip().isdigit()]
+    # JSON 作成ページと同じく文字数の多い語根から順に、placeholder を経由して置換する規則
+    E_roots.sort(key=len, reverse=True)
+    replacements = [(E_root, f"<{E_root}>", f"${20987 + i}$") for i, E_root in enumerate(E_roots)]
+
+    started = time.perf_counter()
+    expected = process_chunk_for_pre_replacements(E_stem_with_Part_Of_Speech_list, replacements)
+    print(f"[JSON作成] 直列: {time.perf_counter() - started:.2f} 秒 ({len(E_stem_with_Part_Of_Speech_list)} 語)")
+
+    for backend in EXECUTOR_BACKENDS:
+        for num_processes in process_counts:
+            started = time.perf_counter()
+            result = parallel_build_pre_replacements_dict(
+                E_stem_with_Part_Of_Speech_list, replacements, num_processes, executor_backend=backend
+            )
+            seconds = time.perf_counter() - started
+            same = "一致" if {k: v[0] for k, v in result.items()} == {k: v[0] for k, v in expected.items()} else "不一致"
+            print(f"[JSON作成] {backend:7s} × {num_processes}: {seconds:.2f} 秒 ({same})")
+
+
+def main(input_path: str = INPUT_TEXT_FILE, start_method: str = worker_start_method):
+    start_method = configure_worker_start_method(start_method)
+    print(f"使える CPU: {available_cpu_count()} / free-threaded: {is_free_threaded_build()} / 起動方式: {start_method}")
+    benchmark_text_conversion(input_path)
+    benchmark_pre_replacements()
+
+
+if __name__ == '__main__':
+    main(*sys.argv[1:3])
@@ -0,0 +1,262 @@
+## esp_conversion_cache_module.py
+
+"""
+変換結果を行(段落)単位で保持するキャッシュ。
+
+同じ文書を何度も変換し直したり、同じ行が何度も現れる文書(歌詞・繰り返しの見出し・教材など)を
+変換したりする場合、同じ行に対して orchestrate_comprehensive_esperanto_text_replacement を
+毎回実行するのは無駄である。
+
+ConversionCache は
+  (行のハッシュ, 置換規則の fingerprint, format_type)
+をキーにして変換結果を保持する (出力の表記を指定した変換では、format_type に表記の名前も含める: output_format_key)。
+- メモリ上の LRU (件数の上限つき)
+- (任意) SQLite ファイルによるディスク上の保存 (複数のプロセス/実行で共有できる)
+の2段構成で、ヒット/ミスの回数を数えている。
+
+%...% / @...@ / 置換規則はいずれも改行をまたがないので、行ごとに変換した結果を連結したものは
+文書全体をまとめて変換した結果と同じになる (ReplacementEngine.convert_lines を参照)。
+
+reconvert_changed_lines は、編集前後の文書を行(段落)単位で比較して、変わった行だけを変換し直す。
+"""
+
+import json
+import difflib
+import hashlib
+import sqlite3
+import threading
+from collections import OrderedDict
+from typing import List, Dict, Tuple, Optional, Callable
+
+# ================================
+# 1) キーの作成
+# ================================
+def compute_ruleset_fingerprint(*ruleset_parts) -> str:
+    """
+    置換リスト・placeholder リストなど(JSON にできるもの)から、規則の組を表す fingerprint を作る。
+    同じ内容なら同じ値になるので、プロセスや実行をまたいでキャッシュを共有できる。
+    (SharedRuleList のようなリスト以外の列も、リストとして扱う)
+    """
+    digest = hashlib.sha256()
+    for part in ruleset_parts:
+        digest.update(json.dumps(part, ensure_ascii=False, default=list).encode('utf-8'))
+        digest.update(b'\0')
+    return digest.hexdigest()
+
+def output_format_key(format_type: str, output_orthography: Optional[str] = None) -> str:
+    """
+    キーの format_type の部分。出力の表記 (esp_orthography_module.OUTPUT_ORTHOGRAPHIES) を指定した変換では、
+    同じ format_type でも結果が違うので、表記の名前も含める (指定しなければ format_type のまま)。
+    """
+    if output_orthography is None:
+        return format_type
+    return f"{format_type}|{output_orthography}"
+
+def make_cache_key(line: str, ruleset_fingerprint: str, format_type: str) -> str:
+    line_hash = hashlib.blake2b(line.encode('utf-8', 'surrogatepass'), digest_size=16).hexdigest()
+    return f"{ruleset_fingerprint}:{format_type}:{line_hash}"
+
+# ================================
+# 2) キャッシュ本体
+# ================================
+class ConversionCache:
+    """
+    行単位の変換結果のキャッシュ (メモリ上の LRU + 任意の SQLite ファイル)。
+
+    cache = ConversionCache(max_entries=20000, disk_path="conversion_cache.sqlite3")
+    cache.get(key) / cache.put(key, value)
+    cache.counters()  # {"memory_hits": …, "disk_hits": …, "misses": …}
+
+    Streamlit では1つのキャッシュを全てのセッション (それぞれ別のスレッド) で共有するので、
+    LRU の並べ替え・追い出しと SQLite への問い合わせは1つのロックの中で行う。
+    """
+
+    def __init__(self, max_entries: int = 20000, disk_path: Optional[str] = None):
+        if max_entries < 1:
+            raise ValueError("max_entries は1以上にしてください")
+        self.max_entries = max_entries
+        self.disk_path = disk_path
+        self._memory: "OrderedDict[str, str]" = OrderedDict()
+        self._connection: Optional[sqlite3.Connection] = None
+        self._lock = threading.Lock()
+        self.memory_hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+
+    # ----------------------------------------
+    # ディスク (SQLite)
+    # ----------------------------------------
+    def _disk(self) -> Optional[sqlite3.Connection]:
+        # 接続は最初に使うときに作る (pickle されて別プロセスに渡っても使えるように)
+        if self.disk_path is None:
+            return None
+        if self._connection is None:
+            self._connection = sqlite3.connect(self.disk_path, timeout=30, check_same_thread=False)
+            self._connection.execute(
+                "CREATE TABLE IF NOT EXISTS conversion_cache (key TEXT PRIMARY KEY, value TEXT NOT NULL)"
+            )
+            self._connection.commit()
+        return self._connection
+
+    def __getstate__(self) -> Dict:
+        state = self.__dict__.copy()
+        state['_connection'] = None
+        del state['_lock']
+        return state
+
+    def __setstate__(self, state: Dict) -> None:
+        self.__dict__.update(state)
+        self._lock = threading.Lock()
+
+    def close(self) -> None:
+        with self._lock:
+            if self._connection is not None:
+                self._connection.close()
+                self._connection = None
+
+    # ----------------------------------------
+    # 参照 / 登録
+    # ----------------------------------------
+    def _remember(self, key: str, value: str) -> None:
+        # self._lock の中で呼ぶこと
+        memory = self._memory
+        memory[key] = value
+        memory.move_to_end(key)
+        while len(memory) > self.max_entries:
+            memory.popitem(last=False)
+
+    def get_many(self, keys: List[str]) -> Dict[str, str]:
+        """見つかったキーだけを {key: 変換結果} で返す (回数も数える)。"""
+        with self._lock:
+            return self._get_many_locked(keys)
+
+    def _get_many_locked(self, keys: List[str]) -> Dict[str, str]:
+        found: Dict[str, str] = {}
+        missing: List[str] = []
+        memory = self._memory
+        for key in keys:
+            value = memory.get(key)
+            if value is None:
+                missing.append(key)
+            else:
+                memory.move_to_end(key)
+                found[key] = value
+        self.memory_hits += len(found)
+
+        connection = self._disk()
+        if connection is not None and missing:
+            # SQLite の変数の上限 (古い版では999) を超えないように分けて問い合わせる
+            for start in range(0, len(missing), 500):
+                batch = missing[start:start + 500]
+                rows = connection.execute(
+                    "SELECT key, value FROM conversion_cache WHERE key IN (" + ",".join("?" * len(batch)) + ")",
+                    batch
+                ).fetchall()
+                for key, value in rows:
+                    found[key] = value
+                    self._remember(key, value)
+                self.disk_hits += len(rows)
+        self.misses += len(keys) - len(found)
+        return found
+
+    def put_many(self, items: List[Tuple[str, str]]) -> None:
+        with self._lock:
+            for key, value in items:
+                self._remember(key, value)
+            connection = self._disk()
+            if connection is not None and items:
+                connection.executemany("INSERT OR REPLACE INTO conversion_cache (key, value) VALUES (?, ?)", items)
+                connection.commit()
+
+    def get(self, key: str) -> Optional[str]:
+        return self.get_many([key]).get(key)
+
+    def put(self, key: str, value: str) -> None:
+        self.put_many([(key, value)])
+
+    def clear(self) -> None:
+        """メモリ上の結果と回数を消す (ディスク上の結果は残す)。"""
+        with self._lock:
+            self._memory.clear()
+            self._reset_counters_locked()
+
+    def reset_counters(self) -> None:
+        with self._lock:
+            self._reset_counters_locked()
+
+    def _reset_counters_locked(self) -> None:
+        self.memory_hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+
+    def counters(self) -> Dict[str, int]:
+        with self._lock:
+            return {"memory_hits": self.memory_hits, "disk_hits": self.disk_hits, "misses": self.misses}
+
+    def __len__(self) -> int:
+        return len(self._memory)
+
+# ================================
+# 3) 重複を除いた行単位の変換
+# ================================
+def convert_unique_lines(
+    lines: List[str],
+    convert_missing_lines: Callable[[List[str]], List[str]],
+    cache: Optional[ConversionCache] = None,
+    ruleset_fingerprint: str = "",
+    format_type: str = ""
+) -> List[str]:
+    """
+    lines の各行の変換結果を(同じ順番で)返す。
+    同じ行は1回だけ、キャッシュにない行だけをまとめて convert_missing_lines に渡す。
+    (convert_missing_lines は渡された行と同じ数・同じ順番の変換結果を返すこと)
+    """
+    unique_lines = list(dict.fromkeys(lines))
+    results: Dict[str, str] = {}
+    keys: Dict[str, str] = {}
+    if cache is not None:
+        keys = {line: make_cache_key(line, ruleset_fingerprint, format_type) for line in unique_lines}
+        found = cache.get_many(list(keys.values()))
+        for line in unique_lines:
+            value = found.get(keys[line])
+            if value is not None:
+                results[line] = value
+
+    missing_lines = [line for line in unique_lines if line not in results]
+    if missing_lines:
+        converted_lines = convert_missing_lines(missing_lines)
+        if len(converted_lines) != len(missing_lines):
+            raise ValueError("変換結果の行数が入力の行数と一致しません")
+        results.update(zip(missing_lines, converted_lines))
+        if cache is not None:
+            cache.put_many([(keys[line], converted) for line, converted in zip(missing_lines, converted_lines)])
+
+    return [results[line] for line in lines]
+
+# ================================
+# 4) 編集された文書の差分だけの再変換
+# ================================
+def reconvert_changed_lines(
+    lines: List[str],
+    previous_lines: List[str],
+    previous_results: List[str],
+    convert_lines: Callable[[List[str]], List[str]]
+) -> Tuple[List[str], int]:
+    """
+    前回の入力 previous_lines (行ごとの変換結果 previous_results) と今回の lines を行(段落)単位で比較し、
+    変わった行だけを convert_lines でまとめて変換して、前回の結果とつなぎ合わせる。
+    (各行の変換結果のリスト, 変換し直した行数) を返す。
+    """
+    if len(previous_lines) != len(previous_results):
+        raise ValueError("previous_lines と previous_results の行数が一致しません")
+    opcodes = difflib.SequenceMatcher(None, previous_lines, lines, autojunk=False).get_opcodes()
+    changed_lines = [line for tag, i1, i2, j1, j2 in opcodes if tag != 'equal' for line in lines[j1:j2]]
+    converted_lines = iter(convert_lines(changed_lines) if changed_lines else [])
+
+    results: List[str] = []
+    for tag, i1, i2, j1, j2 in opcodes:
+        if tag == 'equal':
+            results.extend(previous_results[i1:i2])
+        else:
+            results.extend(next(converted_lines) for _ in range(j2 - j1))
+    return results, len(changed_lines)
@@ -0,0 +1,333 @@
+## esp_executor_module.py
+
+"""
+並列処理の実行方式 (executor) を、プロセス / スレッド / インライン(呼び出し元でそのまま実行) から選べるようにするモジュール。
+
+これまでの parallel_process / WarmWorkerPool / parallel_build_pre_replacements_dict は multiprocessing.Pool に固定されていて、
+ワーカーごとに Python の起動 (spawn) と規則の pickle による受け渡しが必要だった。
+- "process": multiprocessing.Pool (従来どおり。GIL のある CPython で複数の CPU を使える唯一の方式)
+- "thread":  concurrent.futures.ThreadPoolExecutor (起動も pickle も不要。
+             GIL を外した free-threaded CPython 3.13+ では複数の CPU を使える。GIL があると同時には1スレッドしか動かない)
+- "inline":  呼び出し元のスレッドで順番に実行する (並列にはならない。デバッグや比較の基準用)
+のどれでも、同じ呼び出し方 (submit / submit_with_state / starmap) で使える。create_executor(backend, ...) で作る。
+
+ワーカー側の状態 (規則やエンジンなど、initializer で1回だけ作るもの) は executor ごとの番号で _worker_states に入れ、
+submit_with_state(function, *args) で function(状態, *args) として受け取る。
+- "process": 各ワーカープロセスで initializer(*initargs) を1回ずつ実行する (initargs は pickle して送られる)
+- "thread" / "inline": 呼び出し元のプロセスで1回だけ実行し、全スレッドで同じ状態を共有する (コピーしない)
+(モジュールのグローバル変数に1つだけ持つと、スレッド / インラインでは同じプロセスの別の executor の状態で上書きされてしまうため)
+
+cancel() は投入済みで終わっていないタスクを捨てる ("process" ではワーカープロセスごと終了させる)。
+with 文の中で例外 (変換の中止や streamlit の rerun など) が起きた場合は、close() の代わりに cancel() になるので、
+残りのタスクが終わるまで待ったり、CPU を使い続けたりしない。
+
+"process" のワーカーの起動方式は configure_worker_start_method で決める。
+"spawn" ではワーカーごとに Python を起動して streamlit / pandas / 変換モジュールを import し直すが、
+"forkserver" では最初に1回だけ起動したサーバープロセス (FORKSERVER_PRELOAD_MODULES を import 済み) を fork するので、
+ワーカーの起動は fork だけになる。preload_ruleset_path を渡すと、サーバープロセスで既定の置換用JSONも読み込んで
+エンジン (automaton など) を組み立てておき (esp_forkserver_preload_module)、同じ規則のワーカーはそれをそのまま使う。
+"""
+
+import os
+import sys
+import types
+import itertools
+import threading
+import multiprocessing
+import multiprocessing.pool
+from contextlib import contextmanager
+from concurrent.futures import ThreadPoolExecutor
+from typing import List, Dict, Callable, Iterable, Optional
+
+# ================================
+# 1) 実行方式の名前と既定値
+# ================================
+EXECUTOR_BACKENDS = ("process", "thread", "inline")
+
+def is_free_threaded_build() -> bool:
+    """GIL を外した (free-threaded) CPython で動いていて、GIL が実際に無効になっているかどうか。"""
+    is_gil_enabled = getattr(sys, '_is_gil_enabled', None)
+    return is_gil_enabled is not None and not is_gil_enabled()
+
+def backend_runs_in_parallel(backend: str) -> bool:
+    """backend で複数の CPU を同時に使えるかどうか (thread は free-threaded CPython のときだけ)。"""
+    if backend == "process":
+        return True
+    if backend == "thread":
+        return is_free_threaded_build()
+    return False
+
+# free-threaded CPython ではスレッドの方が起動も受け渡しも軽いので、既定をスレッドにする
+DEFAULT_EXECUTOR_BACKEND = "thread" if is_free_threaded_build() else "process"
+
+# ================================
+# 2) ワーカー側の状態
+# ================================
+_worker_states: Dict[int, object] = {}
+_state_keys = itertools.count()
+
+def _initialize_worker_state(state_key: int, initializer: Optional[Callable], initargs: tuple) -> None:
+    _worker_states[state_key] = initializer(*initargs) if initializer is not None else None
+
+def _call_with_worker_state(state_key: int, function: Callable, args: tuple):
+    return function(_worker_states[state_key], *args)
+
+# ================================
+# 3) 各実行方式
+# ================================
+class _TaskExecutor:
+    """
+    executor = create_executor("thread", 4, initializer=build_state, initargs=(rules,))
+    result = executor.submit_with_state(function, lines)  # ワーカーで function(build_state(rules), lines)
+    result.get()                                           # 結果を待って受け取る (例外はここで送出される)
+    executor.starmap(function, [(a, b), ...])              # [function(a, b), ...] (状態は使わない)
+    executor.close()                                       # with 文でもよい
+    executor.cancel()                                      # 終わっていないタスクを捨てて閉じる
+    """
+
+    backend = ""
+
+    def __init__(self, num_workers: int, initializer: Optional[Callable] = None, initargs: tuple = ()):
+        if num_workers < 1:
+            raise ValueError("num_workers は1以上にしてください")
+        self.num_workers = num_workers
+        self.state_key = next(_state_keys)
+
+    def submit(self, function: Callable, *args):
+        raise NotImplementedError
+
+    def submit_with_state(self, function: Callable, *args):
+        return self.submit(_call_with_worker_state, self.state_key, function, args)
+
+    def starmap(self, function: Callable, argument_tuples: Iterable[tuple]) -> List:
+        return [task.get() for task in [self.submit(function, *args) for args in argument_tuples]]
+
+    def close(self) -> None:
+        _worker_states.pop(self.state_key, None)
+
+    def cancel(self) -> None:
+        self.close()
+
+    def __enter__(self) -> "_TaskExecutor":
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback) -> None:
+        if exc_type is not None:
+            self.cancel()
+        else:
+            self.close()
+
+class ProcessTaskExecutor(_TaskExecutor):
+    """multiprocessing.Pool で実行する (start method は multiprocessing の既定 / set_start_method の設定に従う)。"""
+
+    backend = "process"
+
+    def __init__(self, num_workers: int, initializer: Optional[Callable] = None, initargs: tuple = ()):
+        super().__init__(num_workers, initializer, initargs)
+        self._pool = create_worker_pool(num_workers, _initialize_worker_state, (self.state_key, initializer, initargs))
+
+    def submit(self, function: Callable, *args):
+        return self._pool.apply_async(function, args)
+
+    def starmap(self, function: Callable, argument_tuples: Iterable[tuple]) -> List:
+        return self._pool.starmap(function, argument_tuples)
+
+    def close(self) -> None:
+        if self._pool is not None:
+            self._pool.close()
+            self._pool.join()
+            self._pool = None
+        super().close()
+
+    def cancel(self) -> None:
+        # 実行中・待機中のタスクごとワーカープロセスを終了させる (メモリもここで解放される)
+        if self._pool is not None:
+            self._pool.terminate()
+            self._pool.join()
+            self._pool = None
+        super().close()
+
+class _FutureResult:
+    # concurrent.futures.Future を multiprocessing の AsyncResult と同じ get() で受け取れるようにする
+    def __init__(self, future):
+        self._future = future
+
+    def get(self, timeout: Optional[float] = None):
+        return self._future.result(timeout)
+
+class ThreadTaskExecutor(_TaskExecutor):
+    """ThreadPoolExecutor で実行する (状態は呼び出し元で1回だけ作り、全スレッドで共有する)。"""
+
+    backend = "thread"
+
+    def __init__(self, num_workers: int, initializer: Optional[Callable] = None, initargs: tuple = ()):
+        super().__init__(num_workers, initializer, initargs)
+        _initialize_worker_state(self.state_key, initializer, initargs)
+        self._threads = ThreadPoolExecutor(max_workers=num_workers, thread_name_prefix="esp-worker")
+
+    def submit(self, function: Callable, *args):
+        return _FutureResult(self._threads.submit(function, *args))
+
+    def close(self) -> None:
+        if self._threads is not None:
+            self._threads.shutdown(wait=True)
+            self._threads = None
+        super().close()
+
+    def cancel(self) -> None:
+        # まだ始まっていないタスクは捨てる (スレッドは外から止められないので、実行中のタスクは終わるまで続く)
+        if self._threads is not None:
+            self._threads.shutdown(wait=False, cancel_futures=True)
+            self._threads = None
+        super().close()
+
+class _CompletedResult:
+    def __init__(self, value=None, error: Optional[BaseException] = None):
+        self._value = value
+        self._error = error
+
+    def get(self, timeout: Optional[float] = None):
+        if self._error is not None:
+            raise self._error
+        return self._value
+
+class InlineTaskExecutor(_TaskExecutor):
+    """submit した時点で、呼び出し元のスレッドでそのまま実行する (num_workers は数えるだけで使わない)。"""
+
+    backend = "inline"
+
+    def __init__(self, num_workers: int = 1, initializer: Optional[Callable] = None, initargs: tuple = ()):
+        super().__init__(num_workers, initializer, initargs)
+        _initialize_worker_state(self.state_key, initializer, initargs)
+
+    def submit(self, function: Callable, *args):
+        # 例外は他の方式と同じく get() のときに送出する
+        try:
+            return _CompletedResult(function(*args))
+        except Exception as error:
+            return _CompletedResult(error=error)
+
+_EXECUTOR_CLASSES = {
+    "process": ProcessTaskExecutor,
+    "thread": ThreadTaskExecutor,
+    "inline": InlineTaskExecutor
+}
+
+def create_executor(
+    backend: str,
+    num_workers: int,
+    initializer: Optional[Callable] = None,
+    initargs: tuple = ()
+) -> _TaskExecutor:
+    """
+    backend ("process" / "thread" / "inline") の executor を作る。
+    initializer は "process" では各ワーカーで実行されるので、pickle できるモジュールの関数にすること。
+    """
+    if backend not in _EXECUTOR_CLASSES:
+        raise ValueError(f"未知の executor backend です: {backend}")
+    return _EXECUTOR_CLASSES[backend](num_workers, initializer, initargs)
+
+# ================================
+# 4) ワーカープロセスの起動方式
+# ================================
+# "spawn"     : ワーカーごとに新しい Python を起動し、モジュールを import し直す (Windows / macOS の既定)
+# "forkserver": 最初に1回だけ起動したサーバープロセスを fork する (POSIX のみ)
+WORKER_START_METHODS = ("spawn", "forkserver")
+DEFAULT_WORKER_START_METHOD = "forkserver" if "forkserver" in multiprocessing.get_all_start_methods() else "spawn"
+
+# forkserver のサーバープロセスで最初に import しておくモジュール (ワーカーでは import し直さない)
+FORKSERVER_PRELOAD_MODULES = [
+    "esp_pattern_matcher_module",
+    "esp_text_replacement_module",
+    "esp_span_replacement_module",
+    "esp_shared_ruleset_module",
+    "esp_replacement_engine_module",
+    "esp_worker_pool_module"
+]
+# サーバープロセスで読み込む置換用JSONのパスを渡す環境変数 (サーバープロセスは環境変数を引き継ぐ)
+PRELOAD_RULESET_ENVIRONMENT_VARIABLE = "ESP_FORKSERVER_PRELOAD_RULESET"
+_MODULE_DIRECTORY = os.path.dirname(os.path.abspath(__file__))
+# True にすると、ワーカーには親プロセスの __main__ を import させない (configure_worker_start_method で設定)
+_hide_main_module_from_workers = False
+
+def configure_worker_start_method(
+    start_method: str = DEFAULT_WORKER_START_METHOD,
+    preload_ruleset_path: Optional[str] = None,
+    hide_main_module: bool = False
+) -> str:
+    """
+    "process" のワーカーの起動方式を設定し、実際に使われる起動方式を返す。
+    forkserver を使えない環境では "spawn" にする。
+    preload_ruleset_path を渡すと、forkserver のサーバープロセスでその置換用JSONからエンジンを組み立てておく
+    (サーバープロセスが起動する前 = 最初に Pool を作る前に呼ぶこと。2回目以降の呼び出しでは起動方式は変わらない)。
+    hide_main_module=True にすると、ワーカーは親プロセスの __main__ を import し直さない
+    (streamlit のページでは、ワーカーごとにページのスクリプト全体が実行されるのを防ぐ。
+     その代わり、__main__ で定義した関数はワーカーで使えなくなる)。
+    """
+    global _hide_main_module_from_workers
+    _hide_main_module_from_workers = _hide_main_module_from_workers or hide_main_module
+    if start_method not in WORKER_START_METHODS:
+        raise ValueError(f"未知の start method です: {start_method}")
+    if start_method not in multiprocessing.get_all_start_methods():
+        start_method = "spawn"
+    if start_method == "forkserver":
+        preload_modules = list(FORKSERVER_PRELOAD_MODULES)
+        if preload_ruleset_path is not None:
+            os.environ[PRELOAD_RULESET_ENVIRONMENT_VARIABLE] = os.path.abspath(preload_ruleset_path)
+        # Python 3.11 の forkserver は親プロセスの sys.path を引き継がない (起動時の作業ディレクトリしか見ない) ので、
+        # このモジュールのディレクトリを PYTHONPATH に加えておく (import できないモジュールは黙って読み飛ばされる)
+        python_path = os.environ.get("PYTHONPATH", "")
+        if _MODULE_DIRECTORY not in python_path.split(os.pathsep):
+            os.environ["PYTHONPATH"] = os.pathsep.join(path for path in (_MODULE_DIRECTORY, python_path) if path)
+        # (別のページから preload_ruleset_path なしで呼ばれても、先に設定された読み込みは取り消さない)
+        if os.environ.get(PRELOAD_RULESET_ENVIRONMENT_VARIABLE):
+            preload_modules.append("esp_forkserver_preload_module")
+        multiprocessing.set_forkserver_preload(preload_modules)
+    try:
+        multiprocessing.set_start_method(start_method)
+    except RuntimeError:
+        pass  # すでに start method が設定済みの場合はここで無視する
+    return multiprocessing.get_start_method()
+
+# __main__ の差し替えはプロセス全体に効くので、Pool の作成ごと1つのロックの中で行う
+# (streamlit ではセッションごとのスクリプトのスレッドが同時に Pool を作ることがあり、
+#  ロックがないと一方が他方の差し替え用のモジュールを「元の __main__」として戻してしまう)
+_main_module_lock = threading.RLock()
+_hidden_main_module = types.ModuleType('__main__')
+
+@contextmanager
+def _main_module_hidden_from_workers():
+    # spawn / forkserver のワーカーは起動時に親プロセスの __main__ を import し直す。
+    # streamlit では __main__ が実行中のページのスクリプトなので、ワーカーごとにアプリ全体が実行されてしまう。
+    # ワーカーで使う関数はすべて esp_* モジュールにあるので、設定されていればプロセスを起動する間だけ __main__ を空のモジュールにしておく
+    with _main_module_lock:
+        main_module = sys.modules.get('__main__')
+        if (not _hide_main_module_from_workers or main_module is None or main_module is _hidden_main_module
+                or multiprocessing.get_start_method() == "fork"):
+            yield
+            return
+        sys.modules['__main__'] = _hidden_main_module
+        try:
+            yield
+        finally:
+            sys.modules['__main__'] = main_module
+
+def create_worker_pool(
+    num_processes: int,
+    initializer: Optional[Callable] = None,
+    initargs: tuple = ()
+) -> multiprocessing.pool.Pool:
+    """
+    multiprocessing.Pool を作る (configure_worker_start_method(hide_main_module=True) の後は、
+    ワーカーに親プロセスの __main__ を import させない。その場合 initializer とタスクの関数は
+    import できるモジュールの関数にすること)。
+    """
+    with _main_module_hidden_from_workers():
+        return multiprocessing.Pool(processes=num_processes, initializer=initializer, initargs=initargs)
+
+def ruleset_preload_configured() -> bool:
+    """forkserver で置換用JSONを読み込む設定になっているかどうか。"""
+    return (
+        multiprocessing.get_start_method(allow_none=True) == "forkserver"
+        and bool(os.environ.get(PRELOAD_RULESET_ENVIRONMENT_VARIABLE))
+    )
@@ -0,0 +1,31 @@
+## esp_forkserver_preload_module.py
+
+"""
+forkserver のサーバープロセスで import される (multiprocessing.set_forkserver_preload) モジュール。
+
+import されると、環境変数 ESP_FORKSERVER_PRELOAD_RULESET (esp_executor_module.configure_worker_start_method が設定する)
+の置換用JSONから変換エンジンを1回だけ組み立てて、esp_replacement_engine_module に登録する。
+サーバープロセスから fork されたワーカーはそのエンジン (automaton などを含む) をそのまま引き継ぐので、
+ワーカーごとに JSON の読み込みや automaton の組み立てをしなくてよく、automaton などのメモリもワーカー間で共有される
+(ワーカー数を増やしてもメモリ使用量がほぼ一定になるのはこの場合だけ。他の置換用JSONでは、規則のリストは
+共有メモリで共有されるが、automaton などは各ワーカーが組み立てる: esp_shared_ruleset_module)。
+
+import するだけで規則を読み込むので、サーバープロセス以外では import しないこと。
+"""
+
+import os
+import gc
+import sys
+
+from esp_executor_module import PRELOAD_RULESET_ENVIRONMENT_VARIABLE
+from esp_replacement_engine_module import preload_engine
+
+_ruleset_path = os.environ.get(PRELOAD_RULESET_ENVIRONMENT_VARIABLE)
+if _ruleset_path:
+    try:
+        preload_engine(_ruleset_path)
+    except Exception as e:
+        # 読み込めなくてもサーバープロセスは止めない (各ワーカーでエンジンを組み立てる従来の動作になる)
+        print(f"forkserver: 置換用JSONを事前に読み込めませんでした: {e}", file=sys.stderr)
+    # 読み込んだオブジェクトを GC の対象から外し、fork 後に GC がページに書き込んで複製されるのを防ぐ
+    gc.freeze()
@@ -0,0 +1,264 @@
+## esp_input_normalization_module.py
+
+"""
+置換の前の入力の正規化 (空白の統一 + 字上符への統一 + %...% / @...@ の検出) を1回の走査で行うモジュール。
+
+これまでは置換の前に
+1) unify_halfwidth_spaces (正規表現で1回)
+2) convert_to_circumflex (^ 表記 / x 表記 → 字上符)
+3) PERCENT_PATTERN.finditer で %...% を探す
+4) (%...% を placeholder にした後の文字列で) AT_PATTERN.finditer で @...@ を探す
+と、文章を4回走査していた。
+
+normalize_input は1つの正規表現で文章を1回だけ分割し、
+- 特殊な空白 → ' '、cx / c^ → ĉ などの置き換え
+- '%' / '@' の (正規化後の文字列での) 位置の記録
+を同時に行って1回の join で正規化後の文字列を作る。%...% / @...@ の区間は、記録した位置だけから
+従来の正規表現 (r'%(.{1,50}?)%' / r'@(.{1,18}?)@' の finditer) と同じ規則で決める。
+@...@ の文字数は従来どおり、%...% の区間を6文字 ('%1854%' と同じ長さ) の placeholder に置き換えた文字列で数える
+(そのため @...@ の区間は %...% の区間を含むことがある。'@' が %...% の中にあれば @...@ の端にはならない)。
+
+戻り値の区間は正規化後の文字列での (開始, 終了) で、後の段階 (placeholder / span パイプライン) は
+%...% / @...@ を探し直さずにこの区間を使う。
+
+入力の多くは、すでに字上符で書かれているか、特殊な空白や '%' / '@' を含まない。
+そこで正規化の前に、最初に見つかった所で止まる軽い検索で文書に現れるものを調べ (sniff_input と同じ判定)、
+現れないもの (特殊な空白 / cx / c^ / '%' '@') は正規表現に含めずに探す。どれも現れなければ分割もしない。
+normalize_input(text, counters) に new_normalization_counters() の辞書を渡すと、飛ばした段階の数をそこに足す
+(ReplacementEngine.convert_lines / WarmWorkerPool.convert_lines は変換した行の分を集計し、main.py はそれを表示する)。
+"""
+
+from bisect import bisect_left, bisect_right
+import re
+from typing import List, Tuple, Dict, Optional
+
+# ================================
+# 1) 置き換える文字と検出する記号
+# ================================
+# 半角スペースと視覚的に区別がつきにくい空白文字 (全角スペース U+3000 は変更しない)
+SPECIAL_SPACES = "\u00A0\u2002\u2003\u2004\u2005\u2006\u2007\u2008\u2009\u200A"
+PERCENT_MAX_CONTENT_CHARS = 50   # %...% の中身の最大文字数
+AT_MAX_CONTENT_CHARS = 18        # @...@ の中身の最大文字数
+PROTECTED_PLACEHOLDER_WIDTH = 6  # @...@ の文字数を数えるときの %...% 1つ分の長さ ('%1854%')
+
+_NORMALIZED_CHARS: Dict[str, str] = {space: ' ' for space in SPECIAL_SPACES}
+for _ascii_letter, _circumflex_letter in zip("cghjsuCGHJSU", "ĉĝĥĵŝŭĈĜĤĴŜŬ"):
+    _NORMALIZED_CHARS[_ascii_letter + 'x'] = _circumflex_letter
+    _NORMALIZED_CHARS[_ascii_letter + '^'] = _circumflex_letter
+
+# 置き換える部分 (2文字の表記 / 特殊な空白) と、位置を記録する記号 ('%' / '@') を1つの正規表現で探す。
+# 文書に現れるもの (sniff_input) だけを探すように、組み合わせごとに正規表現を作る (_normalization_pattern)。
+# 'cx|…' と '[…]' の選択 (|) にすると re の「1文字目の文字クラスで候補位置を飛ばす」高速化が効かないので、
+# 1文字目を1つの文字クラスにまとめ、それが空白 / 記号でなければ続く '^' / 'x' を要求する形にしている
+_DIGRAPH_FIRST_CHARS = "CGHJSUcghjsu"
+_normalization_patterns: Dict[Tuple[bool, str, bool], Optional["re.Pattern"]] = {}
+
+def _normalization_pattern(special_spaces: bool, digraph_marks: str, markup: bool) -> Optional["re.Pattern"]:
+    key = (special_spaces, digraph_marks, markup)
+    if key not in _normalization_patterns:
+        single_chars = (SPECIAL_SPACES if special_spaces else '') + ('%@' if markup else '')
+        marks = '[' + ''.join(re.escape(mark) for mark in digraph_marks) + ']'
+        if not digraph_marks:
+            pattern = '([' + single_chars + '])' if single_chars else None
+        elif not single_chars:
+            pattern = '([' + _DIGRAPH_FIRST_CHARS + ']' + marks + ')'
+        else:
+            pattern = '([' + _DIGRAPH_FIRST_CHARS + single_chars + '](?:(?<=[' + single_chars + '])|' + marks + '))'
+        _normalization_patterns[key] = re.compile(pattern) if pattern is not None else None
+    return _normalization_patterns[key]
+
+# ================================
+# 2) 文書の分類 (どの段階が必要か)
+# ================================
+CIRCUMFLEX_LETTERS = "ĉĝĥĵŝŭĈĜĤĴŜŬ"
+_X_DIGRAPH_PATTERN = re.compile(r'[CGHJSUcghjsu]x')
+_HAT_DIGRAPH_PATTERN = re.compile(r'[CGHJSUcghjsu]\^')
+_SPECIAL_SPACE_PATTERN = re.compile('[' + SPECIAL_SPACES + ']')
+# これより長い文書では、特殊な空白を1文字ずつの部分文字列検索で探す
+# (正規表現の文字クラスより速いが、1回ごとの呼び出しの手間があるので短い行では正規表現の方が速い)
+_SUBSTRING_SEARCH_MIN_CHARS = 2000
+
+def _required_stages(text: str) -> Tuple[bool, str, bool]:
+    # (特殊な空白があるか, 探す2文字表記の2文字目 ('x' / '^'), '%' / '@' があるか)
+    # 2文字表記は 'x' / '^' があれば探す (cx などが本当にあるかは、正規化の分割そのもので分かる)
+    if text.isascii():
+        special_spaces = False
+    elif len(text) < _SUBSTRING_SEARCH_MIN_CHARS:
+        special_spaces = _SPECIAL_SPACE_PATTERN.search(text) is not None
+    else:
+        special_spaces = any(space in text for space in SPECIAL_SPACES)
+    digraph_marks = ('x' if 'x' in text else '') + ('^' if '^' in text else '')
+    return special_spaces, digraph_marks, '%' in text or '@' in text
+
+def sniff_input(text: str) -> Dict[str, object]:
+    """
+    文書の表記と、正規化の各段階が必要かどうかを調べる。
+    {"orthography": "x" / "hat" / "circumflex" / "mixed" / "plain" (字上符付き文字がない),
+     "x_digraphs": cx などがあるか, "hat_digraphs": c^ などがあるか, "circumflex_letters": ĉ などがあるか,
+     "special_spaces": 特殊な空白があるか, "markup": '%' / '@' があるか}
+    どれも最初に見つかった所で止まる検索 ('x' や '^' がなければ正規表現も使わない) で、
+    ASCII だけの文書なら字上符付き文字と特殊な空白は調べない。
+    """
+    special_spaces, digraph_marks, markup = _required_stages(text)
+    x_digraphs = 'x' in digraph_marks and _X_DIGRAPH_PATTERN.search(text) is not None
+    hat_digraphs = '^' in digraph_marks and _HAT_DIGRAPH_PATTERN.search(text) is not None
+    circumflex_letters = not text.isascii() and any(letter in text for letter in CIRCUMFLEX_LETTERS)
+    systems = [name for name, found in (("x", x_digraphs), ("hat", hat_digraphs), ("circumflex", circumflex_letters)) if found]
+    return {
+        "orthography": systems[0] if len(systems) == 1 else ("mixed" if systems else "plain"),
+        "x_digraphs": x_digraphs,
+        "hat_digraphs": hat_digraphs,
+        "circumflex_letters": circumflex_letters,
+        "special_spaces": special_spaces,
+        "markup": markup
+    }
+
+# normalize_input で正規化した文書の数と、段階ごとに不要なので飛ばした文書の数
+# (spaces: 空白の統一, orthography: 字上符への統一, markup: %...% / @...@ の検出, all: 全段階)
+NORMALIZATION_COUNTER_KEYS = ("documents", "spaces_skipped", "orthography_skipped", "markup_skipped", "all_skipped")
+
+def new_normalization_counters() -> Dict[str, int]:
+    """normalize_input(text, counters) に渡す、回数がすべて0の辞書を返す。"""
+    return dict.fromkeys(NORMALIZATION_COUNTER_KEYS, 0)
+
+def add_normalization_counters(total: Dict[str, int], counters: Dict[str, int]) -> None:
+    """counters (ワーカーで集計したものなど) の回数を total に足す。"""
+    for key in NORMALIZATION_COUNTER_KEYS:
+        total[key] += counters[key]
+
+# ================================
+# 3) 記号の位置から区間を決める
+# ================================
+def _enclosed_spans(
+    text: str,
+    marker_positions: List[int],
+    max_content_chars: int,
+    virtual_position=None
+) -> List[Tuple[int, int]]:
+    """
+    marker_positions (記号の位置, 昇順) から、r'記号(.{1,max}?)記号' の finditer と同じ区間を返す。
+    virtual_position(位置) を渡すと、中身の文字数をその座標で数える (@...@ 用)。
+    """
+    spans = []
+    num_markers = len(marker_positions)
+    index = 0
+    while index < num_markers:
+        start = marker_positions[index]
+        # 中身は1文字以上なので、閉じる記号は start + 2 以降で最初のもの (start + 1 の記号は中身になる)
+        close_index = index + 1
+        if close_index < num_markers and marker_positions[close_index] == start + 1:
+            close_index += 1
+        if close_index >= num_markers:
+            break
+        end = marker_positions[close_index]
+        if virtual_position is None:
+            content_chars = end - start - 1
+        else:
+            content_chars = virtual_position(end) - virtual_position(start) - 1
+        if content_chars <= max_content_chars and '\n' not in text[start + 1:end]:
+            spans.append((start, end + 1))
+            index = close_index + 1
+        else:
+            # この位置からは一致しないので、次の記号から探し直す
+            index += 1
+    return spans
+
+def find_markup_spans(
+    text: str,
+    percent_positions: List[int],
+    at_positions: List[int]
+) -> Tuple[List[Tuple[int, int]], List[Tuple[int, int]]]:
+    """
+    '%' / '@' の位置 (正規化後の文字列での位置, 昇順) から (%...% の区間, @...@ の区間) を返す。
+    """
+    percent_spans = _enclosed_spans(text, percent_positions, PERCENT_MAX_CONTENT_CHARS)
+    if not at_positions:
+        return percent_spans, []
+    if not percent_spans:
+        return percent_spans, _enclosed_spans(text, at_positions, AT_MAX_CONTENT_CHARS)
+
+    # %...% の中の '@' は placeholder に置き換えられて見えなくなる
+    span_starts = [start for start, end in percent_spans]
+    span_ends = [end for start, end in percent_spans]
+    visible_at_positions = []
+    for position in at_positions:
+        span_index = bisect_right(span_starts, position) - 1
+        if span_index < 0 or position >= span_ends[span_index]:
+            visible_at_positions.append(position)
+
+    # %...% を6文字の placeholder にした文字列での位置
+    shrink_before = [0]
+    for start, end in percent_spans:
+        shrink_before.append(shrink_before[-1] + (end - start) - PROTECTED_PLACEHOLDER_WIDTH)
+
+    def virtual_position(position: int) -> int:
+        return position - shrink_before[bisect_left(span_ends, position + 1)]
+
+    return percent_spans, _enclosed_spans(text, visible_at_positions, AT_MAX_CONTENT_CHARS, virtual_position)
+
+_MARKER_PATTERNS = {'%': re.compile('%'), '@': re.compile('@')}
+
+def _marker_positions(text: str, marker: str) -> List[int]:
+    return [match.start() for match in _MARKER_PATTERNS[marker].finditer(text)]
+
+def find_enclosed_spans(text: str, marker: str, max_content_chars: int) -> List[Tuple[int, int]]:
+    """
+    r'記号(.{1,max_content_chars}?)記号' (記号は '%' / '@') の finditer と同じ、重ならない区間 (記号を含む) を返す。
+    記号の位置を1回だけ探し、区間はその位置だけから決める (文書の長さと記号の数に比例する時間)。
+    """
+    return _enclosed_spans(text, _marker_positions(text, marker), max_content_chars)
+
+def scan_markup_spans(text: str) -> Tuple[List[Tuple[int, int]], List[Tuple[int, int]]]:
+    """
+    正規化済みの text から (%...% の区間, @...@ の区間) を求める (normalize_input が返す区間と同じ)。
+    """
+    if '%' not in text and '@' not in text:
+        return [], []
+    return find_markup_spans(text, _marker_positions(text, '%'), _marker_positions(text, '@'))
+
+# ================================
+# 4) 正規化
+# ================================
+def normalize_input(
+    text: str,
+    counters: Optional[Dict[str, int]] = None
+) -> Tuple[str, List[Tuple[int, int]], List[Tuple[int, int]]]:
+    """
+    (正規化後の文字列, %...% の区間, @...@ の区間) を返す。
+    正規化後の文字列は convert_to_circumflex(unify_halfwidth_spaces(text)) と同じ。
+    区間は正規化後の文字列での (開始, 終了) で、'%' / '@' を含む。
+    文書に現れないもの (特殊な空白 / cx / c^ / '%' '@', sniff_input と同じ判定) は探さず、
+    どれも現れなければ text をそのまま返す。
+    counters (new_normalization_counters) を渡すと、この文書で飛ばした段階をそこに数える。
+    """
+    special_spaces, digraph_marks, has_markup = _required_stages(text)
+    pattern = _normalization_pattern(special_spaces, digraph_marks, has_markup)
+    if counters is not None:
+        counters["documents"] += 1
+        counters["spaces_skipped"] += not special_spaces
+        counters["orthography_skipped"] += not digraph_marks
+        counters["markup_skipped"] += not has_markup
+        counters["all_skipped"] += pattern is None
+    if pattern is None:
+        return text, [], []
+
+    parts = pattern.split(text)
+    if len(parts) == 1:
+        return text, [], []
+    parts[1::2] = [_NORMALIZED_CHARS.get(part, part) for part in parts[1::2]]
+    normalized = ''.join(parts)
+    if not has_markup:
+        return normalized, [], []
+
+    # 置き換えた後の各部分の長さから、'%' / '@' の位置を求める
+    percent_positions: List[int] = []
+    at_positions: List[int] = []
+    position = 0
+    for part in parts:
+        if part == '%':
+            percent_positions.append(position)
+        elif part == '@':
+            at_positions.append(position)
+        position += len(part)
+    percent_spans, at_spans = find_markup_spans(normalized, percent_positions, at_positions)
+    return normalized, percent_spans, at_spans
@@ -0,0 +1,298 @@
+## esp_orthography_module.py
+
+"""
+エスペラントの字上符付き文字の表記 (字上符 ĉ / x 表記 cx / ^ 表記 c^) を相互に変換するモジュール。
+
+これまでの replace_esperanto_chars は12組の対応表を1組ずつ text.replace() していたので、
+convert_to_circumflex (^ 表記 → 字上符, x 表記 → 字上符) だけで文章全体を24回コピーし、
+main.py ではさらに出力の表記 (letter_type) のために2つの対応表で同じことをしていた。
+同じ対応表は esp_text_replacement_module と esp_replacement_json_make_module にも重複して定義されていた。
+
+OrthographyConverter は複数の対応表を1つにまとめて前もってコンパイルし、1回の走査で変換する。
+- 1文字 → 文字列 の対応だけなら str.translate
+- 2文字の対応 (cx, c^) を含むなら、正規表現 (対応表の文字の組がそろっていれば [cghjsu][x^] のような文字クラス) で
+  文章を分割し、一致した部分だけを置き換えて1回の join でつなぐ
+対応表を順に text.replace() した場合と結果が同じになるように、前の対応表の変換結果に
+(またはその結果と前後の文字にまたがって) 後の対応表の変換元が現れうる組み合わせ
+(x → ^ → 字上符 のように連鎖するもの、変換先が空文字列のもの) や、
+変換元どうしが重なりうる対応表 (どちらを先に置き換えるかで結果が変わるもの) は受け付けない。
+
+よく使う変換器 (convert_to_circumflex など) はモジュールの読み込み時に1回だけ作り、
+replace_esperanto_chars(text, 対応表) は対応表ごとの変換器をキャッシュして使う (従来の関数と同じ呼び出し方)。
+
+出力の表記 (main.py の letter_type) は、変換後の文書全体にもう1回掛けるのではなく、
+変換エンジンが変換結果の部分ごとに掛ける (OutputOrthography)。
+規則の new の中身は何度も現れるので、表記を変えたものを1回だけ作ってキャッシュし、
+それ以外の部分 (置換されなかった部分、%...% / @...@ の部分) だけをその都度変換する。
+"""
+
+import re
+from typing import List, Tuple, Dict, Iterable, Optional, Union
+
+# ================================
+# 1) エスペラント文字変換用の辞書
+# ================================
+# それぞれ (x表記 → ĉ) や (ĉ → c^)など、様々なマッピングを辞書にしている
+x_to_circumflex = {
+    'cx': 'ĉ', 'gx': 'ĝ', 'hx': 'ĥ', 'jx': 'ĵ', 'sx': 'ŝ', 'ux': 'ŭ',
+    'Cx': 'Ĉ', 'Gx': 'Ĝ', 'Hx': 'Ĥ', 'Jx': 'Ĵ', 'Sx': 'Ŝ', 'Ux': 'Ŭ'
+}
+circumflex_to_x = {
+    'ĉ': 'cx', 'ĝ': 'gx', 'ĥ': 'hx', 'ĵ': 'jx', 'ŝ': 'sx', 'ŭ': 'ux',
+    'Ĉ': 'Cx', 'Ĝ': 'Gx', 'Ĥ': 'Hx', 'Ĵ': 'Jx', 'Ŝ': 'Sx', 'Ŭ': 'Ux'
+}
+x_to_hat = {
+    'cx': 'c^', 'gx': 'g^', 'hx': 'h^', 'jx': 'j^', 'sx': 's^', 'ux': 'u^',
+    'Cx': 'C^', 'Gx': 'G^', 'Hx': 'H^', 'Jx': 'J^', 'Sx': 'S^', 'Ux': 'U^'
+}
+hat_to_x = {
+    'c^': 'cx', 'g^': 'gx', 'h^': 'hx', 'j^': 'jx', 's^': 'sx', 'u^': 'ux',
+    'C^': 'Cx', 'G^': 'Gx', 'H^': 'Hx', 'J^': 'Jx', 'S^': 'Sx', 'U^': 'Ux'
+}
+hat_to_circumflex = {
+    'c^': 'ĉ', 'g^': 'ĝ', 'h^': 'ĥ', 'j^': 'ĵ', 's^': 'ŝ', 'u^': 'ŭ',
+    'C^': 'Ĉ', 'G^': 'Ĝ', 'H^': 'Ĥ', 'J^': 'Ĵ', 'S^': 'Ŝ', 'U^': 'Ŭ'
+}
+circumflex_to_hat = {
+    'ĉ': 'c^', 'ĝ': 'g^', 'ĥ': 'h^', 'ĵ': 'j^', 'ŝ': 's^', 'ŭ': 'u^',
+    'Ĉ': 'C^', 'Ĝ': 'G^', 'Ĥ': 'H^', 'Ĵ': 'J^', 'Ŝ': 'S^', 'Ŭ': 'U^'
+}
+
+# ================================
+# 2) 1回の走査で変換する変換器
+# ================================
+def _character_class(chars: List[str]) -> str:
+    return '[' + ''.join(re.escape(char) for char in sorted(chars)) + ']'
+
+def _keys_may_overlap(keys: List[str]) -> bool:
+    # ある変換元が別の変換元を含むか、ある変換元の末尾が別の変換元の先頭と重なるか
+    for key in keys:
+        for other in keys:
+            if key == other:
+                continue
+            if key in other or any(other.startswith(key[i:]) for i in range(1, len(key))):
+                return True
+    return False
+
+def _may_form_later_key(converted: str, later_keys: List[str]) -> bool:
+    # 変換結果の中、または変換結果と前後の文字にまたがって、後で置き換える変換元が現れうるか
+    # (変換先が空文字列なら前後の文字がつながる)
+    if not converted:
+        return bool(later_keys)
+    for key in later_keys:
+        if key in converted or converted in key:
+            return True
+        if any(key.startswith(converted[i:]) or key.endswith(converted[:i]) for i in range(1, len(converted))):
+            return True
+    return False
+
+def _compile_pattern(keys: List[str]) -> "re.Pattern":
+    # 同じ長さの変換元が「1文字目の集合 × 2文字目の集合 ...」をちょうど埋めていれば文字クラスの並びにし、
+    # そうでなければ文字列の選択 (|) にする (長い変換元を先に試す)
+    alternatives = []
+    for length in sorted({len(key) for key in keys}, reverse=True):
+        same_length = [key for key in keys if len(key) == length]
+        position_chars = [sorted({key[i] for key in same_length}) for i in range(length)]
+        num_combinations = 1
+        for chars in position_chars:
+            num_combinations *= len(chars)
+        if num_combinations == len(same_length):
+            alternatives.append(''.join(_character_class(chars) for chars in position_chars))
+        else:
+            alternatives.extend(re.escape(key) for key in sorted(same_length))
+    return re.compile('(' + '|'.join(alternatives) + ')')
+
+class OrthographyConverter:
+    """
+    converter = OrthographyConverter(hat_to_circumflex, x_to_circumflex)
+    converter.convert("c^u vi sxatas") == "ĉu vi ŝatas"
+    (replace_esperanto_chars(replace_esperanto_chars(text, hat_to_circumflex), x_to_circumflex) と同じ結果)
+    """
+
+    def __init__(self, *char_dicts: Dict[str, str]):
+        mapping: Dict[str, str] = {}
+        for index, char_dict in enumerate(char_dicts):
+            later_keys = [key for later_dict in char_dicts[index:] for key in later_dict]
+            for original_char, converted_char in char_dict.items():
+                if _may_form_later_key(converted_char, later_keys):
+                    raise ValueError(
+                        f"'{original_char}' → '{converted_char}' の変換結果が後の対応表で再び変換されうるので、1回の走査にまとめられません"
+                    )
+                mapping.setdefault(original_char, converted_char)
+        if _keys_may_overlap(list(mapping)):
+            raise ValueError("変換元どうしが重なりうるので、1回の走査にまとめられません")
+        self.mapping = mapping
+        if all(len(key) == 1 for key in mapping):
+            self._translation_table = str.maketrans(mapping)
+            self._pattern = None
+        else:
+            self._translation_table = None
+            self._pattern = _compile_pattern(list(mapping))
+
+    def convert(self, text: str) -> str:
+        if self._translation_table is not None:
+            return text.translate(self._translation_table)
+        # 分割すると一致した部分が奇数番目に入るので、そこだけを置き換えて1回でつなぐ
+        parts = self._pattern.split(text)
+        if len(parts) == 1:
+            return text
+        mapping = self.mapping
+        parts[1::2] = [mapping[part] for part in parts[1::2]]
+        return ''.join(parts)
+
+    __call__ = convert
+
+# ================================
+# 3) よく使う変換 (読み込み時に1回だけ作る)
+# ================================
+# 入力の正規化: ^ 表記と x 表記を字上符に統一する
+circumflex_converter = OrthographyConverter(hat_to_circumflex, x_to_circumflex)
+# 出力の表記: main.py の letter_type ('上付き文字' / '^形式' / 'x 形式') ごと
+hat_converter = OrthographyConverter(x_to_hat, circumflex_to_hat)
+x_converter = OrthographyConverter(hat_to_x, circumflex_to_x)
+
+def convert_to_circumflex(text: str) -> str:
+    """
+    テキストを字上符形式（ĉ, ĝ, ĥ, ĵ, ŝ, ŭなど）に統一します。
+    (c^ → ĉ と cx → ĉ を1回の走査で行う)
+    """
+    return circumflex_converter.convert(text)
+
+def convert_to_hat(text: str) -> str:
+    """テキストを ^ 表記 (c^, g^ など) に統一する (cx → c^ と ĉ → c^ を1回の走査で行う)。"""
+    return hat_converter.convert(text)
+
+def convert_to_x(text: str) -> str:
+    """テキストを x 表記 (cx, gx など) に統一する (c^ → cx と ĉ → cx を1回の走査で行う)。"""
+    return x_converter.convert(text)
+
+# ================================
+# 4) 従来の関数 (対応表を渡す呼び出し方)
+# ================================
+# 同じ辞書オブジェクト (と同じ内容) に対しては変換器を作り直さない。
+# (辞書自体への参照も保持するので、id が別の辞書に再利用されることはない)
+_CONVERTER_CACHE_SIZE = 16
+_converter_cache: List[Tuple[dict, tuple, OrthographyConverter]] = []
+
+def get_orthography_converter(char_dict: Dict[str, str]) -> OrthographyConverter:
+    items = tuple(char_dict.items())
+    for cached_dict, cached_items, converter in _converter_cache:
+        if cached_dict is char_dict and cached_items == items:
+            return converter
+    converter = OrthographyConverter(char_dict)
+    _converter_cache.append((char_dict, items, converter))
+    if len(_converter_cache) > _CONVERTER_CACHE_SIZE:
+        _converter_cache.pop(0)
+    return converter
+
+def replace_esperanto_chars(text, char_dict: Dict[str, str]) -> str:
+    """
+    char_dict の (変換元, 変換先) の組で text を置き換える (1回の走査)。
+    1回の走査では1組ずつ text.replace() した結果と変わりうる対応表 (OrthographyConverter を参照) は、従来どおり1組ずつ置き換える。
+    """
+    try:
+        converter = get_orthography_converter(char_dict)
+    except ValueError:
+        for original_char, converted_char in char_dict.items():
+            text = text.replace(original_char, converted_char)
+        return text
+    return converter.convert(text)
+
+# ================================
+# 5) 出力の表記 (変換結果の部分ごとに掛ける)
+# ================================
+# main.py の letter_type ('上付き文字' / '^形式' / 'x 形式') に対応する名前
+OUTPUT_ORTHOGRAPHIES = ("circumflex", "hat", "x")
+_OUTPUT_CONVERTERS = {"circumflex": circumflex_converter, "hat": hat_converter, "x": x_converter}
+# 規則の new の中身の変換結果を保持する上限 (超えたら作り直す)
+RULE_VALUE_VARIANT_CACHE_SIZE = 100000
+
+class OutputOrthography:
+    """
+    出力の表記の変換器 (converter) を、変換結果の部分 (pieces) ごとに掛ける。
+    規則の new の中身 (rule_value) の変換結果は1回だけ作ってキャッシュする
+    (使われた規則の分だけ。全規則を前もって変換すると、各ワーカーの起動のたびに1秒ほどかかる)。
+    キャッシュはインスタンスごとで、max_cached_variants 件を超えたら作り直す
+    (ReplacementEngine は規則ごとに create_output_orthography で自分用のものを作るので、
+     エンジンが捨てられればキャッシュも解放される)。
+
+    部分ごとに変換してつないだ結果は、つないだ文章全体を converter で変換した結果と同じになる。
+    ただし、部分の境目をまたいで2文字の変換元 (cx, c^ など) ができる場合は、つないでから変換する。
+    """
+
+    def __init__(self, name: str, converter: OrthographyConverter, max_cached_variants: int = RULE_VALUE_VARIANT_CACHE_SIZE):
+        self.name = name
+        self.converter = converter
+        self.max_cached_variants = max_cached_variants
+        self._rule_value_variants: Dict[str, str] = {}
+        self._digraphs = {key for key in converter.mapping if len(key) == 2}
+        self._digraph_second_chars = tuple(sorted({key[1] for key in self._digraphs}))
+        # 1文字の変換元が全て ASCII 以外なら、ASCII だけの部分は2文字の変換元の2文字目 ('x' / '^') がなければ変わらない
+        self._skip_plain_ascii_pieces = bool(self._digraphs) and all(
+            not key.isascii() for key in converter.mapping if len(key) == 1
+        )
+        self._second_char_pattern = re.compile(_character_class(list(self._digraph_second_chars))) if self._digraphs else None
+
+    def rule_value_variant(self, value: str) -> str:
+        variant = self._rule_value_variants.get(value)
+        if variant is None:
+            variant = self._remember_variant(value)
+        return variant
+
+    def _remember_variant(self, value: str) -> str:
+        variants = self._rule_value_variants
+        if len(variants) >= self.max_cached_variants:
+            variants.clear()
+        variant = variants[value] = self.converter.convert(value)
+        return variant
+
+    def convert_pieces(self, pieces: List[str], rule_value_flags: Iterable[bool]) -> List[str]:
+        """
+        pieces の各部分を変換したリストを返す (rule_value_flags が真の部分は規則の new の中身として、キャッシュを使う)。
+        隣り合う部分の境目をまたぐ変換元があれば、つないだ全体を変換した1要素のリストを返す。
+        (空の部分は返すリストに含めない)
+        """
+        convert = self.converter.convert
+        variants = self._rule_value_variants
+        digraphs = self._digraphs
+        second_chars = self._digraph_second_chars
+        skip_ascii = self._skip_plain_ascii_pieces
+        second_char_pattern = self._second_char_pattern
+        converted = []
+        previous = ''
+        for piece, is_rule_value in zip(pieces, rule_value_flags):
+            if not piece:
+                continue
+            if piece[0] in second_chars and previous and previous[-1] + piece[0] in digraphs:
+                return [convert(''.join(pieces))]
+            previous = piece
+            if is_rule_value:
+                variant = variants.get(piece)
+                if variant is None:
+                    variant = self._remember_variant(piece)
+                converted.append(variant)
+            elif skip_ascii and piece.isascii() and second_char_pattern.search(piece) is None:
+                converted.append(piece)
+            else:
+                converted.append(convert(piece))
+        return converted
+
+def create_output_orthography(name: str) -> OutputOrthography:
+    """出力の表記の名前 (OUTPUT_ORTHOGRAPHIES のどれか) から、自分用のキャッシュを持つ変換器を作る。"""
+    if name not in _OUTPUT_CONVERTERS:
+        raise ValueError(f"未知の出力の表記です: {name}")
+    return OutputOrthography(name, _OUTPUT_CONVERTERS[name])
+
+# 名前だけで指定された場合 (orchestrate_comprehensive_esperanto_text_replacement などの関数) に使う、表記ごとの変換器
+_output_orthographies = {name: create_output_orthography(name) for name in OUTPUT_ORTHOGRAPHIES}
+
+def get_output_orthography(output_orthography: Union[str, OutputOrthography, None]) -> Optional[OutputOrthography]:
+    """
+    出力の表記の名前 (OUTPUT_ORTHOGRAPHIES のどれか) から変換器を返す (None なら None: 表記を変えない)。
+    OutputOrthography を渡した場合は、それ (エンジンが持つ変換器) をそのまま返す。
+    """
+    if output_orthography is None or isinstance(output_orthography, OutputOrthography):
+        return output_orthography
+    if output_orthography not in _output_orthographies:
+        raise ValueError(f"未知の出力の表記です: {output_orthography}")
+    return _output_orthographies[output_orthography]
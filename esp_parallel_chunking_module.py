@@ -0,0 +1,223 @@
+## esp_parallel_chunking_module.py
+
+"""
+行のリストを文字数の予算で小さな塊(チャンク)に分け、ワーカー(プロセス / スレッド)に少しずつ割り振るためのモジュール。
+
+これまでの parallel_process は行数でちょうど num_processes 個の範囲に分け、最後の範囲に余りを全部割り当てていた。
+数個の非常に長い段落を含む文書では、その段落を受け持つプロセスだけが働き、他のプロセスは先に終わって待つことになる。
+
+map_chunks_in_order は
+- 行を文字数の予算ごとの多数のチャンクに分け (1行は分けないので、予算より長い行は1行だけのチャンクになる)
+- 空いたプロセスから順に次のチャンクを受け取れるように、同時に投入するチャンクを 2×プロセス数 個までにして少しずつ投入し
+- 結果は投入した順番につなぎ直す
+ことで、重い段落があっても他のプロセスが残りのチャンクを処理し続けられるようにする。
+
+チャンクの大きさは AdaptiveChunkSizer が、完了したチャンクの処理速度(文字/秒)から
+1チャンクがおよそ target_chunk_seconds 秒になるように決め、残りが少なくなると小さくする
+(最後に1つのプロセスだけが大きなチャンクを処理している状態を避ける)。
+
+各チャンクの処理時間は {"chunk", "lines", "chars", "seconds", "process_id", "thread_id"} の辞書で返すので、
+summarize_chunk_timings でワーカーごとの負荷の偏りを確かめられる
+(chunk_function がワーカーで数えた回数の辞書も返す場合は、それも "counters" に入れる)。
+チャンクは esp_executor_module の executor (process / thread / inline) で実行する。
+
+progress_callback(済んだ文字数, 全体の文字数) を渡すと、チャンクが1つ終わるたびに (呼び出し元のスレッドで) 呼ぶ。
+直列で変換する場合は map_batches_with_progress で同じように進捗を返す。
+callback から例外 (ConversionCancelled や streamlit の rerun など) を送出すると変換はそこで止まり、
+executor の with 文を抜けるときに残りのタスクは捨てられる (esp_executor_module の cancel)。
+"""
+
+import os
+import time
+import threading
+from collections import deque
+from typing import List, Dict, Tuple, Callable, Optional
+
+# 進捗の callback: progress_callback(済んだ文字数, 全体の文字数)
+ProgressCallback = Callable[[int, int], None]
+
+class ConversionCancelled(Exception):
+    """progress_callback から送出して、変換を途中で止める。"""
+
+# ================================
+# 1) チャンクの大きさ
+# ================================
+DEFAULT_TARGET_CHUNK_SECONDS = 0.2
+MIN_CHUNK_CHARS = 2000
+MAX_CHUNK_CHARS = 512 * 1024
+
+class AdaptiveChunkSizer:
+    """
+    次のチャンクの文字数を決める。
+
+    sizer = AdaptiveChunkSizer(total_chars, num_processes)
+    chunk_chars = sizer.next_chunk_chars(remaining_chars)
+    sizer.record(num_chars, seconds)  # 完了したチャンクの処理時間を記録
+    """
+
+    def __init__(
+        self,
+        total_chars: int,
+        num_processes: int,
+        target_chunk_seconds: float = DEFAULT_TARGET_CHUNK_SECONDS,
+        min_chunk_chars: int = MIN_CHUNK_CHARS,
+        max_chunk_chars: int = MAX_CHUNK_CHARS
+    ):
+        if num_processes < 1:
+            raise ValueError("num_processes は1以上にしてください")
+        self.num_processes = num_processes
+        self.target_chunk_seconds = target_chunk_seconds
+        self.min_chunk_chars = min_chunk_chars
+        self.max_chunk_chars = max_chunk_chars
+        # 処理速度が分かるまでは、1プロセスあたり8チャンク程度になるように分ける
+        self.chunk_chars = self._clamp(total_chars // (8 * num_processes))
+        self.chars_per_second: Optional[float] = None
+
+    def _clamp(self, chunk_chars: float) -> int:
+        return int(min(max(chunk_chars, self.min_chunk_chars), self.max_chunk_chars))
+
+    def record(self, num_chars: int, seconds: float) -> None:
+        if num_chars <= 0 or seconds <= 0:
+            return
+        speed = num_chars / seconds
+        # 指数移動平均 (1つのチャンクの外れ値で大きく揺れないように)
+        if self.chars_per_second is None:
+            self.chars_per_second = speed
+        else:
+            self.chars_per_second = 0.7 * self.chars_per_second + 0.3 * speed
+        self.chunk_chars = self._clamp(self.chars_per_second * self.target_chunk_seconds)
+
+    def next_chunk_chars(self, remaining_chars: int) -> int:
+        # 残りの文字数をプロセス数で割った量より大きくしない (終盤ほどチャンクが小さくなる)
+        return self._clamp(min(self.chunk_chars, remaining_chars // self.num_processes))
+
+def take_lines_by_chars(lines: List[str], start: int, chunk_chars: int) -> int:
+    """lines[start:] の先頭から合計 chunk_chars 文字程度(少なくとも1行)を取り、チャンクの終わりの位置を返す。"""
+    end = start
+    num_chars = 0
+    num_lines = len(lines)
+    while end < num_lines and (end == start or num_chars + len(lines[end]) <= chunk_chars):
+        num_chars += len(lines[end])
+        end += 1
+    return end
+
+# ================================
+# 2) ワーカー側
+# ================================
+def _run_timed_chunk(
+    worker_state,
+    chunk_function: Callable[[object, List[str]], List[str]],
+    chunk: List[str]
+) -> Tuple[object, float, int, int]:
+    started = time.perf_counter()
+    results = chunk_function(worker_state, chunk)
+    return results, time.perf_counter() - started, os.getpid(), threading.get_ident()
+
+# ================================
+# 3) 投入と結果の並べ直し (親プロセス側)
+# ================================
+def map_chunks_in_order(
+    executor,
+    chunk_function: Callable[[object, List[str]], List[str]],
+    lines: List[str],
+    num_processes: int,
+    target_chunk_seconds: float = DEFAULT_TARGET_CHUNK_SECONDS,
+    progress_callback: Optional[ProgressCallback] = None,
+    returns_counters: bool = False
+) -> Tuple[List[str], List[Dict]]:
+    """
+    lines を文字数の予算ごとのチャンクに分けて executor (esp_executor_module.create_executor) で
+    chunk_function(ワーカーの状態, チャンク) を実行し、
+    (各行の結果を元の順番に並べたリスト, 各チャンクの処理時間のリスト) を返す。
+    chunk_function はモジュールの関数 (pickle できるもの) で、渡された行と同じ数の結果を返すこと
+    (規則などは executor の initializer でワーカーの状態として作っておく)。
+    progress_callback があれば、結果を受け取ったチャンクごとに (済んだ文字数, 全体の文字数) で呼ぶ。
+    returns_counters なら chunk_function は (結果のリスト, 回数の辞書) を返し、回数の辞書は各チャンクの "counters" に入る。
+    """
+    total_chars = sum(len(line) for line in lines)
+    sizer = AdaptiveChunkSizer(total_chars, num_processes, target_chunk_seconds)
+    # Pool.imap はタスクの iterable を別スレッドで先に全部読んでしまい、処理速度に応じて大きさを変えられないので、
+    # 同時に投入するチャンクの数を制限して、完了するたびに次のチャンクの大きさを決める
+    max_pending_chunks = 2 * num_processes
+    pending = deque()
+    results: List[str] = []
+    timings: List[Dict] = []
+    position = 0
+    remaining_chars = total_chars
+    done_chars = 0
+    while position < len(lines) or pending:
+        while position < len(lines) and len(pending) < max_pending_chunks:
+            end = take_lines_by_chars(lines, position, sizer.next_chunk_chars(remaining_chars))
+            chunk = lines[position:end]
+            num_chars = sum(len(line) for line in chunk)
+            remaining_chars -= num_chars
+            pending.append((len(timings) + len(pending), num_chars, executor.submit_with_state(_run_timed_chunk, chunk_function, chunk)))
+            position = end
+        chunk_index, num_chars, async_result = pending.popleft()
+        output, seconds, process_id, thread_id = async_result.get()
+        converted, counters = output if returns_counters else (output, None)
+        sizer.record(num_chars, seconds)
+        results.extend(converted)
+        timing = {
+            "chunk": chunk_index,
+            "lines": len(converted),
+            "chars": num_chars,
+            "seconds": seconds,
+            "process_id": process_id,
+            "thread_id": thread_id
+        }
+        if counters is not None:
+            timing["counters"] = counters
+        timings.append(timing)
+        done_chars += num_chars
+        if progress_callback is not None:
+            progress_callback(done_chars, total_chars)
+    return results, timings
+
+def summarize_chunk_timings(timings: List[Dict]) -> Dict:
+    """
+    チャンクの処理時間のリストから、ワーカー ((process_id, thread_id)) ごとの合計時間と偏り
+    (最も長く働いたワーカーの時間 / 平均, 1.0 に近いほど均等) を返す。
+    """
+    busy_seconds: Dict[Tuple[int, int], float] = {}
+    for timing in timings:
+        worker = (timing["process_id"], timing["thread_id"])
+        busy_seconds[worker] = busy_seconds.get(worker, 0.0) + timing["seconds"]
+    mean_seconds = sum(busy_seconds.values()) / len(busy_seconds) if busy_seconds else 0.0
+    return {
+        "chunks": len(timings),
+        "busy_seconds_by_worker": busy_seconds,
+        "imbalance": max(busy_seconds.values()) / mean_seconds if mean_seconds > 0 else 1.0
+    }
+
+# ================================
+# 4) 直列の場合の進捗
+# ================================
+# 直列で変換するとき、進捗を返す間隔 (文字数)
+SERIAL_PROGRESS_CHARS = 20000
+
+def map_batches_with_progress(
+    batch_function: Callable[[List[str]], List[str]],
+    lines: List[str],
+    progress_callback: Optional[ProgressCallback] = None,
+    batch_chars: int = SERIAL_PROGRESS_CHARS
+) -> List[str]:
+    """
+    直列版: lines を batch_chars 文字程度ずつ batch_function (行のリスト -> 同じ数の結果のリスト) で変換し、
+    各バッチの後で progress_callback(済んだ文字数, 全体の文字数) を呼ぶ。
+    progress_callback がなければ、lines 全体を1回で batch_function に渡す。
+    """
+    if progress_callback is None:
+        return batch_function(lines)
+    total_chars = sum(len(line) for line in lines)
+    results: List[str] = []
+    done_chars = 0
+    position = 0
+    while position < len(lines):
+        end = take_lines_by_chars(lines, position, batch_chars)
+        batch = lines[position:end]
+        results.extend(batch_function(batch))
+        done_chars += sum(len(line) for line in batch)
+        position = end
+        progress_callback(done_chars, total_chars)
+    return results
@@ -0,0 +1,178 @@
+## esp_parallel_planning_module.py
+
+"""
+直列(1プロセス)で処理するか、何プロセスで並列処理するかを自動で決めるためのモジュール。
+
+main.py / JSON 作成ページでは、これまで利用者がプロセス数 (2-4 / 2-6) を固定で選んでいたが、
+入力が小さい場合はプロセスの起動 (spawn なので Python の起動 + import + 規則の受け渡し) の方が
+変換そのものより長く、並列処理にするとかえって遅くなる。また CPU が1つしか使えない環境では、
+何プロセスにしても速くならない。
+
+ParallelismPlanner は
+- 使える CPU の数 (available_cpu_count: affinity と cgroup の CPU 制限)
+- 1単位 (1文字 / 1語根 など) あたりの直列の処理時間
+- ワーカー1つの起動にかかる時間 (起動済みの常駐プールなら0)
+- ワーカー1つあたりの受け渡しの時間
+から、直列の予測時間と n プロセスの予測時間
+  起動時間 + n × 受け渡しの時間 + 直列の予測時間 / n
+を比べて、最も速いもの (直列 / n プロセス) を選ぶ。
+処理時間と起動時間は measure_seconds_per_unit / measure_pool_startup_seconds で1回だけ測っておく。
+
+executor_backend が並列に動かない方式 (GIL のある CPython の "thread" / "inline", esp_executor_module) なら、
+CPU がいくつあっても直列を選ぶ。
+
+plan() の結果は辞書 {"mode", "num_processes", "predicted_seconds", "predicted_serial_seconds", "cpu_count", "reason"}
+で、実際にかかった時間を record_actual_seconds で書き加えて画面に表示する
+(なぜその方式を選んだのかを確かめられるように)。
+"""
+
+import os
+import time
+from typing import Dict, Callable, Iterable, Optional
+
+from esp_executor_module import DEFAULT_EXECUTOR_BACKEND, create_executor, backend_runs_in_parallel
+
+# ================================
+# 1) 使える CPU の数
+# ================================
+def _cgroup_cpu_limit() -> Optional[float]:
+    # cgroup v2: /sys/fs/cgroup/cpu.max = "<quota> <period>" (制限なしなら "max <period>")
+    try:
+        with open('/sys/fs/cgroup/cpu.max', 'r') as f:
+            quota, period = f.read().split()[:2]
+        if quota != 'max':
+            return int(quota) / int(period)
+        return None
+    except (OSError, ValueError):
+        pass
+    # cgroup v1: cpu.cfs_quota_us / cpu.cfs_period_us (制限なしなら quota = -1)
+    try:
+        with open('/sys/fs/cgroup/cpu/cpu.cfs_quota_us', 'r') as f:
+            quota = int(f.read())
+        with open('/sys/fs/cgroup/cpu/cpu.cfs_period_us', 'r') as f:
+            period = int(f.read())
+        if quota > 0 and period > 0:
+            return quota / period
+    except (OSError, ValueError):
+        pass
+    return None
+
+def available_cpu_count() -> int:
+    """このプロセスが実際に使える CPU の数 (os.cpu_count() を affinity と cgroup の CPU 制限で絞ったもの)。"""
+    if hasattr(os, 'sched_getaffinity'):
+        cpu_count = len(os.sched_getaffinity(0))
+    else:
+        cpu_count = os.cpu_count() or 1
+    cpu_limit = _cgroup_cpu_limit()
+    if cpu_limit is not None:
+        # 0.5 CPU などの端数は切り上げる (1未満にはしない)
+        cpu_count = min(cpu_count, max(int(-(-cpu_limit // 1)), 1))
+    return max(cpu_count, 1)
+
+# ================================
+# 2) 1回だけの計測
+# ================================
+def measure_seconds_per_unit(function: Callable[[], object], num_units: int) -> float:
+    """function() (num_units 単位分の直列の処理) を1回実行して、1単位あたりの秒数を返す。"""
+    started = time.perf_counter()
+    function()
+    return (time.perf_counter() - started) / max(num_units, 1)
+
+def _noop_task() -> None:
+    return None
+
+def measure_pool_startup_seconds(
+    initializer: Optional[Callable] = None,
+    initargs: tuple = (),
+    task: Callable = _noop_task,
+    task_args: tuple = (),
+    executor_backend: str = DEFAULT_EXECUTOR_BACKEND
+) -> float:
+    """
+    ワーカー1つの executor を起動して task(*task_args) が返ってくるまでの秒数を返す
+    ("process" ではプロセスの起動 + import + initializer + task の引数の受け渡し)。
+    """
+    started = time.perf_counter()
+    with create_executor(executor_backend, 1, initializer, initargs) as executor:
+        executor.submit(task, *task_args).get()
+        return time.perf_counter() - started
+
+# ================================
+# 3) 直列 / 並列の選択
+# ================================
+# 直列の予測時間がこれより短ければ、並列処理は検討しない
+MIN_PARALLEL_SERIAL_SECONDS = 0.3
+# ワーカー1つあたりの受け渡し(タスクの送受信と結果の結合)の既定の秒数
+DEFAULT_DISPATCH_SECONDS_PER_PROCESS = 0.02
+
+class ParallelismPlanner:
+    """
+    planner = ParallelismPlanner(seconds_per_unit, worker_startup_seconds)
+    plan = planner.plan(num_units)
+    plan = planner.plan(num_units, warm_process_counts={4})  # 4プロセスの常駐プールは起動済み (起動時間0)
+    ... plan["mode"] ("serial" / "parallel") と plan["num_processes"] で処理する ...
+    record_actual_seconds(plan, elapsed)
+    """
+
+    def __init__(
+        self,
+        seconds_per_unit: float,
+        worker_startup_seconds: float,
+        dispatch_seconds_per_process: float = DEFAULT_DISPATCH_SECONDS_PER_PROCESS,
+        max_processes: Optional[int] = None,
+        cpu_count: Optional[int] = None,
+        executor_backend: str = DEFAULT_EXECUTOR_BACKEND
+    ):
+        self.seconds_per_unit = seconds_per_unit
+        self.worker_startup_seconds = worker_startup_seconds
+        self.dispatch_seconds_per_process = dispatch_seconds_per_process
+        self.cpu_count = cpu_count if cpu_count is not None else available_cpu_count()
+        self.max_processes = min(max_processes, self.cpu_count) if max_processes is not None else self.cpu_count
+        self.executor_backend = executor_backend
+
+    def predict_seconds(self, num_units: int, num_processes: int, warm_workers: bool = False) -> float:
+        serial_seconds = num_units * self.seconds_per_unit
+        if num_processes <= 1:
+            return serial_seconds
+        startup_seconds = 0.0 if warm_workers else self.worker_startup_seconds
+        return startup_seconds + num_processes * self.dispatch_seconds_per_process + serial_seconds / num_processes
+
+    def plan(self, num_units: int, warm_process_counts: Iterable[int] = ()) -> Dict:
+        serial_seconds = self.predict_seconds(num_units, 1)
+        plan = {
+            "mode": "serial",
+            "num_processes": 1,
+            "predicted_seconds": serial_seconds,
+            "predicted_serial_seconds": serial_seconds,
+            "cpu_count": self.cpu_count,
+            "reason": "overhead"
+        }
+        if self.max_processes < 2:
+            plan["reason"] = "single_cpu"
+            return plan
+        if not backend_runs_in_parallel(self.executor_backend):
+            plan["reason"] = "serial_backend"
+            return plan
+        if serial_seconds < MIN_PARALLEL_SERIAL_SECONDS:
+            plan["reason"] = "small_input"
+            return plan
+
+        warm_process_counts = set(warm_process_counts)
+        best_processes = min(
+            range(2, self.max_processes + 1),
+            key=lambda n: self.predict_seconds(num_units, n, n in warm_process_counts)
+        )
+        best_seconds = self.predict_seconds(num_units, best_processes, best_processes in warm_process_counts)
+        if best_seconds < serial_seconds:
+            plan.update({
+                "mode": "parallel",
+                "num_processes": best_processes,
+                "predicted_seconds": best_seconds,
+                "reason": "faster"
+            })
+        return plan
+
+def record_actual_seconds(plan: Dict, actual_seconds: float) -> Dict:
+    """plan に実際にかかった秒数を書き加えて返す。"""
+    plan["actual_seconds"] = actual_seconds
+    return plan
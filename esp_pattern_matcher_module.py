@@ -0,0 +1,455 @@
+## esp_pattern_matcher_module.py
+
+"""
+大域置換(replacements_final_list)を「1回の走査」で行うための多パターン照合モジュール。
+
+orchestrate_comprehensive_esperanto_text_replacement の 5) 大域置換は、
+(old, new, placeholder) を優先順位順に1件ずつ `old in text` → `text.replace()` していくため、
+計算量は O(規則数 × テキスト長) になる (規則数は30万件前後)。
+
+ここでは全ての old から前缀(prefix)辞書型の trie automaton を作り、
+1) テキストを1回走査して全ての出現位置 (規則番号, 開始位置) を集める
+2) 規則番号(=優先順位)順・位置順に並べ、既に確定した置換箇所と重ならないものだけを採用する
+ことで、従来の逐次ループと同じ置換結果(同じ placeholder 入りテキスト)を得る。
+
+【逐次ループと同じ結果になる理由】
+- placeholder は '$数字$' (＋ 'up'/'cap') なので、後続の old が placeholder の内部に一致することはない。
+  → 後の規則は「まだ置換されていない部分」だけに一致する。
+- old の先頭/末尾の空白は placeholder 側にもそのまま残る(' $123$ ' の形)ので、
+  空白部分は「未置換の文字」として扱い、他の規則からも再利用できるようにしている。
+- 同じ規則の中では str.replace() と同様に、左から順に重ならない出現だけを採用する。
+"""
+
+import re
+import math
+import zlib
+from typing import List, Tuple, Dict, Optional, Set, Union
+
+# ================================
+# 1) trie automaton 本体
+# ================================
+class ReplacementAutomaton:
+    """
+    (old, new, placeholder) のリストから作る trie automaton。
+
+    prefix_table は「全ての old の接頭辞 → その接頭辞で終わる規則番号のタプル」の辞書で、
+    各 trie ノードを接頭辞文字列そのもので表している (途中ノードは空タプル)。
+    """
+
+    def __init__(self, replacements: List[Tuple[str, str, str]]):
+        self.replacements = replacements
+        self.rule_lengths: List[int] = []
+        # 各規則の (先頭空白数, 末尾空白数)。空白は placeholder 側にも残る。
+        self.rule_margins: List[Tuple[int, int]] = []
+
+        terminal_rules: Dict[str, List[int]] = {}
+        for rule_index, (old, new, placeholder) in enumerate(replacements):
+            lead = len(old) - len(old.lstrip(' '))
+            trail = len(old) - len(old.rstrip(' ')) if lead < len(old) else 0
+            self.rule_lengths.append(len(old))
+            self.rule_margins.append((lead, trail))
+            if old:
+                terminal_rules.setdefault(old, []).append(rule_index)
+
+        # 最短の old より短い接頭辞は照合に不要なので登録しない
+        self.min_length = min((len(old) for old in terminal_rules), default=0)
+        prefix_table: Dict[str, Tuple[int, ...]] = {}
+        for old, rule_indices in terminal_rules.items():
+            for end in range(self.min_length, len(old)):
+                prefix_table.setdefault(old[:end], ())
+            prefix_table[old] = tuple(rule_indices)
+        self.prefix_table = prefix_table
+
+    def find_occurrences(self, text: str) -> List[Tuple[int, int]]:
+        """
+        text 中の全ての old の出現を (規則番号, 開始位置) のリストで返す(重なりも含む)。
+        各開始位置から trie を辿れるところまで辿る。
+        """
+        occurrences = []
+        if not self.prefix_table:
+            return occurrences
+        get = self.prefix_table.get
+        text_length = len(text)
+        min_length = self.min_length
+        for start in range(text_length - min_length + 1):
+            end = start + min_length
+            rule_indices = get(text[start:end])
+            while rule_indices is not None:
+                for rule_index in rule_indices:
+                    occurrences.append((rule_index, start))
+                end += 1
+                if end > text_length:
+                    break
+                rule_indices = get(text[start:end])
+        return occurrences
+
+    def resolve_matches(self, text: str) -> List[Tuple[int, int]]:
+        """
+        逐次ループと同じ優先順位で採用される置換箇所を (開始位置, 規則番号) のリストで返す(位置順)。
+        """
+        occurrences = self.find_occurrences(text)
+        occurrences.sort()
+        # 置換済み(placeholder化済み)の文字位置を 1 で記録する
+        replaced_mask = bytearray(len(text))
+        accepted = []
+        previous_rule = -1
+        previous_end = 0
+        for rule_index, start in occurrences:
+            end = start + self.rule_lengths[rule_index]
+            if rule_index == previous_rule and start < previous_end:
+                continue  # str.replace() と同じく、同一規則内の重なりは無視
+            if replaced_mask.find(1, start, end) != -1:
+                continue  # 優先順位の高い規則が既に置換した部分と重なる
+            lead, trail = self.rule_margins[rule_index]
+            replaced_mask[start + lead:end - trail] = b'\x01' * (end - trail - start - lead)
+            accepted.append((start, rule_index))
+            previous_rule = rule_index
+            previous_end = end
+        accepted.sort()
+        return accepted
+
+    def replace_with_placeholders(self, text: str) -> Tuple[str, Dict[str, str]]:
+        """
+        逐次ループ
+            for old, new, placeholder in replacements:
+                if old in text:
+                    text = text.replace(old, placeholder)
+                    valid_replacements[placeholder] = new
+        と同じ (text, valid_replacements) を1回の走査で作る。
+        """
+        accepted = self.resolve_matches(text)
+
+        valid_replacements = {}
+        for rule_index in sorted({rule_index for _, rule_index in accepted}):
+            old, new, placeholder = self.replacements[rule_index]
+            valid_replacements[placeholder] = new
+
+        # 空白は両側に残るので、old/placeholder の「空白を除いた中心部分」だけを入れ替える
+        pieces = []
+        cursor = 0
+        for start, rule_index in accepted:
+            lead, trail = self.rule_margins[rule_index]
+            placeholder = self.replacements[rule_index][2]
+            pieces.append(text[cursor:start + lead])
+            pieces.append(placeholder[lead:len(placeholder) - trail])
+            cursor = start + self.rule_lengths[rule_index] - trail
+        pieces.append(text[cursor:])
+        return ''.join(pieces), valid_replacements
+
+# ================================
+# 2) n-gram による候補規則の絞り込み
+# ================================
+# このアプリの placeholder ('$…$', '@…@', '%…%', '!…!') で使われる文字
+_KNOWN_PLACEHOLDER_DELIMITERS = set('$@%!')
+_KNOWN_PLACEHOLDER_INTERIOR_CHARS = set('0123456789')
+
+def analyze_placeholder_chars(replacements: List[Tuple[str, str, str]]) -> Tuple[Set[str], Set[str]]:
+    """
+    placeholder の区切り文字 ('$', '@' など) と内部の文字 (数字, 'up'/'cap' など) を返す。
+    置換の途中で挿入される他の段階の placeholder の文字も含める。
+    """
+    delimiter_chars = set(_KNOWN_PLACEHOLDER_DELIMITERS)
+    interior_chars = set(_KNOWN_PLACEHOLDER_INTERIOR_CHARS)
+    for old, new, placeholder in replacements:
+        core = placeholder.strip(' ')
+        if core:
+            delimiter_chars.update((core[0], core[-1]))
+            interior_chars.update(core[1:-1])
+    interior_chars -= delimiter_chars
+    return delimiter_chars, interior_chars
+
+class NgramRuleIndex:
+    """
+    逐次ループ (`old in text` → `text.replace()`) の前に、調べる必要のある規則だけを絞り込む索引。
+
+    各 old の先頭 n 文字 (n-gram) → 規則番号 の辞書を作っておき、
+    入力テキストに現れる n-gram から候補の規則を引く(規則番号順 = 元の優先順位のまま)。
+
+    置換の途中で placeholder が挿入されても、placeholder にかからない old の出現は
+    元のテキストにも既に存在していたはずなので、候補から漏れることはない。
+    placeholder にかかりうる old (placeholder の区切り文字を含むもの、placeholder の内部の文字だけで
+    できているもの) と、n 文字未満の old は常に候補に含める。
+    """
+
+    def __init__(self, replacements: List[Tuple[str, str, str]], ngram_size: int = 3):
+        self.ngram_size = ngram_size
+        self.rule_count = len(replacements)
+        delimiter_chars, interior_chars = analyze_placeholder_chars(replacements)
+
+        self.leading_ngram_rules: Dict[str, List[int]] = {}
+        self.always_candidate_rules: List[int] = []
+        for rule_index, (old, new, placeholder) in enumerate(replacements):
+            if (len(old) < ngram_size
+                    or not delimiter_chars.isdisjoint(old)
+                    or set(old) <= interior_chars):
+                self.always_candidate_rules.append(rule_index)
+            else:
+                self.leading_ngram_rules.setdefault(old[:ngram_size], []).append(rule_index)
+        self.reset_counters()
+
+    def reset_counters(self):
+        # 調べた規則数 / 調べずに飛ばした規則数 (累計)
+        self.rules_scanned = 0
+        self.rules_skipped = 0
+
+    def candidate_rule_indices(self, text: str) -> List[int]:
+        """text に対して調べる必要のある規則番号を、元の順番で返す。"""
+        n = self.ngram_size
+        get = self.leading_ngram_rules.get
+        rule_indices = list(self.always_candidate_rules)
+        for ngram in {text[i:i + n] for i in range(len(text) - n + 1)}:
+            found = get(ngram)
+            if found:
+                rule_indices.extend(found)
+        rule_indices.sort()
+        self.rules_scanned += len(rule_indices)
+        self.rules_skipped += self.rule_count - len(rule_indices)
+        return rule_indices
+
+class KgramBitsetRuleFilter:
+    """
+    入力テキストの k-gram から作る bitset (ハッシュ関数1つの Bloom filter) で、
+    `old in text` を調べる前に「明らかに一致しない規則」を除外する軽量フィルタ。
+
+    - 各規則の old から、placeholder の文字を含まない部分の先頭 k 文字 (probe) を選び、
+      その CRC32 を m で割った余り(ビット位置)ごとに規則番号をまとめておく (リストごとに1回)。
+    - テキストごとに、全ての k-gram のビット位置の集合 (bitset) を作り、
+      立っているビットに属する規則だけを候補にする (規則番号順)。
+    ビット数 m は false_positive_rate と expected_text_kgrams (想定する入力の k-gram 数) から決める。
+    一致しない規則が候補に残る割合 ≒ 入力の k-gram 数 / m。一致する規則が除外されることはない。
+    ハッシュは CRC32 なので、プロセスをまたいでも同じビット位置になる。
+    """
+
+    def __init__(
+        self,
+        replacements: List[Tuple[str, str, str]],
+        kgram_length: int = 3,
+        false_positive_rate: float = 0.01,
+        expected_text_kgrams: int = 4096
+    ):
+        if not 0 < false_positive_rate < 1:
+            raise ValueError(f"false_positive_rate は 0 と 1 の間で指定してください: {false_positive_rate}")
+        self.kgram_length = kgram_length
+        self.false_positive_rate = false_positive_rate
+        self.bit_count = max(1, math.ceil(expected_text_kgrams / false_positive_rate))
+        self.rule_count = len(replacements)
+        delimiter_chars, interior_chars = analyze_placeholder_chars(replacements)
+        delimiter_pattern = re.compile('[' + re.escape(''.join(sorted(delimiter_chars))) + ']')
+
+        self.bit_rules: Dict[int, List[int]] = {}
+        self.always_candidate_rules: List[int] = []
+        probe_lengths = set()
+        for rule_index, (old, new, placeholder) in enumerate(replacements):
+            # placeholder の内部にも一致しうる部分は probe にできない
+            probe = next((segment for segment in delimiter_pattern.split(old)
+                          if segment and not set(segment) <= interior_chars), '')[:kgram_length]
+            if not probe:
+                self.always_candidate_rules.append(rule_index)
+                continue
+            probe_lengths.add(len(probe))
+            self.bit_rules.setdefault(self._bit(probe), []).append(rule_index)
+        self.probe_lengths = sorted(probe_lengths)
+        self.reset_counters()
+
+    def _bit(self, kgram: str) -> int:
+        return zlib.crc32(kgram.encode('utf-8')) % self.bit_count
+
+    def reset_counters(self):
+        # 調べた規則数 / 調べずに飛ばした規則数 (累計)
+        self.rules_scanned = 0
+        self.rules_skipped = 0
+
+    def text_bitset(self, text: str) -> Set[int]:
+        """text の k-gram (probe と同じ長さ) が立てるビット位置の集合。"""
+        bit = self._bit
+        kgrams = set()
+        for length in self.probe_lengths:
+            kgrams.update(text[i:i + length] for i in range(len(text) - length + 1))
+        return {bit(kgram) for kgram in kgrams}
+
+    def candidate_rule_indices(self, text: str) -> List[int]:
+        """text に対して調べる必要のある規則番号を、元の順番で返す。"""
+        get = self.bit_rules.get
+        rule_indices = list(self.always_candidate_rules)
+        for bit in self.text_bitset(text):
+            found = get(bit)
+            if found:
+                rule_indices.extend(found)
+        rule_indices.sort()
+        self.rules_scanned += len(rule_indices)
+        self.rules_skipped += self.rule_count - len(rule_indices)
+        return rule_indices
+
+# 逐次ループで使える候補規則の絞り込み (candidate_rule_indices / rules_scanned / rules_skipped を持つ)
+RuleFilter = Union[NgramRuleIndex, KgramBitsetRuleFilter]
+
+# ================================
+# 3) 2文字語根用の境界照合
+# ================================
+class TwoCharRootMatcher:
+    """
+    2文字語根置換 (replacements_list_for_2char) 専用の照合器。
+
+    従来は規則リストを2回ループし、毎回 `old in text` → `text.replace()` で全文を走査していた。
+    規則は
+      - ' al ' の形 (前後が空白: 単独の語)
+      - '$ad' / 'al$' の形 (placeholder の '$' に接する接尾辞/接頭辞)
+    のどちらかで、置換が連鎖しうるのは
+      - 空白1つで区切られた「規則に一致する語」の並び (' la al ' など)
+      - '$' を含む「規則の文字 + '$'」の連続部分 ('$adig' など)
+    の内部に限られる(両者は重ならず、互いに影響しない)。
+    そこで、この2種類の区間だけを1回の正規表現走査で取り出し、区間ごとに従来の2回のループを
+    (その区間に現れうる規則だけで)実行する。同じ区間の結果は使い回す。
+    形の合わない規則を含む場合は、全文に対して従来のループを行う。
+    """
+
+    # 区間ごとの結果を保持する上限 (超えたら作り直す)
+    _SEGMENT_CACHE_SIZE = 100000
+
+    def __init__(
+        self,
+        replacements_list_for_2char: List[Tuple[str, str, str]],
+        placeholders: Optional[List[str]] = None,
+        second_pass_wrapper: str = "!"
+    ):
+        self.olds = [old for old, new, placeholder in replacements_list_for_2char]
+        if placeholders is None:
+            placeholders = [placeholder for old, new, placeholder in replacements_list_for_2char]
+        self.first_pass_placeholders = placeholders
+        self.second_pass_placeholders = [second_pass_wrapper + placeholder + second_pass_wrapper for placeholder in placeholders]
+
+        # 規則の中心部分(空白/'$'を除いた文字列) → 規則番号 を、単独の語/接尾辞・接頭辞 に分けて持つ
+        self.word_rule_index: Dict[str, List[int]] = {}
+        self.boundary_rule_index: Dict[str, List[int]] = {}
+        self.is_supported = True
+        for rule_index, old in enumerate(self.olds):
+            core = old.strip(' $')
+            lead = old[:len(old) - len(old.lstrip(' $'))]
+            trail = old[len(old.rstrip(' $')):]
+            if not core or re.search(r'[\s$\d]', core) or second_pass_wrapper in core:
+                self.is_supported = False
+            elif lead == ' ' and trail == ' ':
+                self.word_rule_index.setdefault(core, []).append(rule_index)
+            elif (lead, trail) in (('$', ''), ('', '$'), ('$', '$')):
+                self.boundary_rule_index.setdefault(core, []).append(rule_index)
+            else:
+                self.is_supported = False
+
+        self.segment_pattern = None
+        if self.is_supported and (self.word_rule_index or self.boundary_rule_index):
+            alternatives = []
+            if self.word_rule_index:
+                words = '|'.join(re.escape(core) for core in sorted(self.word_rule_index, key=len, reverse=True))
+                alternatives.append(r' (?:(?:' + words + r') )+')
+            if self.boundary_rule_index:
+                chars = re.escape(''.join(sorted(set(''.join(self.boundary_rule_index)))))
+                alternatives.append(r'[' + chars + r']*\$[' + chars + r'$]*')
+            self.segment_pattern = re.compile('|'.join(alternatives))
+        self.core_lengths = sorted({len(core) for core in list(self.word_rule_index) + list(self.boundary_rule_index)})
+        self._segment_cache: Dict[str, Tuple[str, Tuple[int, ...], Tuple[int, ...]]] = {}
+
+    def _candidate_rules(self, segment: str) -> List[int]:
+        # 区間に中心部分が現れる規則だけを、リストの順番で返す
+        rule_indices: Set[int] = set()
+        rule_index_of = self.word_rule_index if segment.startswith(' ') else self.boundary_rule_index
+        for length in self.core_lengths:
+            for start in range(len(segment) - length + 1):
+                found = rule_index_of.get(segment[start:start + length])
+                if found:
+                    rule_indices.update(found)
+        return sorted(rule_indices)
+
+    def _replace_sequentially(self, text: str, rule_indices) -> Tuple[str, Tuple[int, ...], Tuple[int, ...]]:
+        # 従来の2回のループそのもの
+        first_pass = []
+        for rule_index in rule_indices:
+            old = self.olds[rule_index]
+            if old in text:
+                text = text.replace(old, self.first_pass_placeholders[rule_index])
+                first_pass.append(rule_index)
+        second_pass = []
+        for rule_index in rule_indices:
+            old = self.olds[rule_index]
+            if old in text:
+                text = text.replace(old, self.second_pass_placeholders[rule_index])
+                second_pass.append(rule_index)
+        return text, tuple(first_pass), tuple(second_pass)
+
+    def replace(self, text: str) -> Tuple[str, List[int], List[int]]:
+        """
+        従来の2回のループと同じ置換を行い、
+        (置換後のtext, 1回目に使われた規則番号, 2回目に使われた規則番号) を返す (規則番号はリストの順番)。
+        """
+        if not self.is_supported:
+            text, first_pass, second_pass = self._replace_sequentially(text, range(len(self.olds)))
+            return text, list(first_pass), list(second_pass)
+        if self.segment_pattern is None:
+            return text, [], []
+
+        if len(self._segment_cache) > self._SEGMENT_CACHE_SIZE:
+            self._segment_cache.clear()
+        cache = self._segment_cache
+        first_pass_rules: Set[int] = set()
+        second_pass_rules: Set[int] = set()
+        pieces = []
+        cursor = 0
+        for match in self.segment_pattern.finditer(text):
+            segment = match.group(0)
+            result = cache.get(segment)
+            if result is None:
+                result = self._replace_sequentially(segment, self._candidate_rules(segment))
+                cache[segment] = result
+            replaced_segment, first_pass, second_pass = result
+            if not (first_pass or second_pass):
+                continue
+            pieces.append(text[cursor:match.start()])
+            pieces.append(replaced_segment)
+            cursor = match.end()
+            first_pass_rules.update(first_pass)
+            second_pass_rules.update(second_pass)
+        if not pieces:
+            return text, [], []
+        pieces.append(text[cursor:])
+        return ''.join(pieces), sorted(first_pass_rules), sorted(second_pass_rules)
+
+# ================================
+# 4) automaton / 索引のキャッシュ
+# ================================
+# 同じリストオブジェクトに対しては automaton を作り直さない。
+# (リスト自体への参照も保持するので、id が別のリストに再利用されることはない)
+_AUTOMATON_CACHE_SIZE = 4
+_automaton_cache: List[Tuple[list, ReplacementAutomaton]] = []
+
+def get_replacement_automaton(replacements: List[Tuple[str, str, str]]) -> ReplacementAutomaton:
+    for cached_list, automaton in _automaton_cache:
+        if cached_list is replacements:
+            return automaton
+    automaton = ReplacementAutomaton(replacements)
+    _automaton_cache.append((replacements, automaton))
+    if len(_automaton_cache) > _AUTOMATON_CACHE_SIZE:
+        _automaton_cache.pop(0)
+    return automaton
+
+_ngram_rule_index_cache: List[Tuple[list, NgramRuleIndex]] = []
+
+def get_ngram_rule_index(replacements: List[Tuple[str, str, str]]) -> NgramRuleIndex:
+    for cached_list, rule_index in _ngram_rule_index_cache:
+        if cached_list is replacements:
+            return rule_index
+    rule_index = NgramRuleIndex(replacements)
+    _ngram_rule_index_cache.append((replacements, rule_index))
+    if len(_ngram_rule_index_cache) > _AUTOMATON_CACHE_SIZE:
+        _ngram_rule_index_cache.pop(0)
+    return rule_index
+
+_two_char_matcher_cache: List[Tuple[list, TwoCharRootMatcher]] = []
+
+def get_two_char_root_matcher(replacements_list_for_2char: List[Tuple[str, str, str]]) -> TwoCharRootMatcher:
+    for cached_list, matcher in _two_char_matcher_cache:
+        if cached_list is replacements_list_for_2char:
+            return matcher
+    matcher = TwoCharRootMatcher(replacements_list_for_2char)
+    _two_char_matcher_cache.append((replacements_list_for_2char, matcher))
+    if len(_two_char_matcher_cache) > _AUTOMATON_CACHE_SIZE:
+        _two_char_matcher_cache.pop(0)
+    return matcher
@@ -0,0 +1,838 @@
+## esp_replacement_engine_module.py
+
+"""
+置換用JSON(合并3个JSON文件)から「変換エンジン」を1回だけ組み立て、何度でも使い回すためのモジュール。
+
+orchestrate_comprehensive_esperanto_text_replacement / process_segment / parallel_process は
+呼び出しのたびに 3種類の置換リスト・2種類の placeholder リスト・format_type の7引数を受け取り、
+必要な前処理をその都度やり直している。
+
+ReplacementEngine はこれらを1つにまとめて保持し、
+- 大域置換用の trie automaton (esp_pattern_matcher_module)
+- 局所置換用 / 2文字語根用の規則表
+- %...% / @...@ 用の placeholder
+- HTML形式の後処理設定 (format_type)
+を構築時に1回だけ用意する。main.py や一括変換スクリプトでは、
+規則ごとに1つのインスタンスを保持しておけばよい。
+
+pipeline="span" を指定すると placeholder を使わない置換 (esp_span_replacement_module) を使う。
+この場合 placeholder ファイルは読み込まない。
+
+result_cache (esp_conversion_cache_module.ConversionCache) を渡すと、行単位で変換結果を再利用する。
+
+output_orthography ("circumflex" / "hat" / "x", esp_orthography_module.OUTPUT_ORTHOGRAPHIES) を指定すると、
+出力の表記 (main.py の letter_type) を変換の中で区間ごとにそろえる (規則の new の中身は、表記を変えたものを
+1回だけ作ってキャッシュする)。変換後の文書全体をもう1回走査しなくてよく、行単位のキャッシュや並列処理にも含まれる。
+with_output_orthography で、同じ規則のまま表記だけを差し替えたエンジンを作れる。
+
+executor_backend ("process" / "thread" / "inline", esp_executor_module) で、
+convert_parallel / convert_lines_parallel の並列処理をプロセス / スレッド / インラインのどれで実行するかを選ぶ。
+convert_lines / convert_parallel / convert_lines_parallel に progress_callback(済んだ文字数, 全体の文字数) を渡すと
+変換の進捗を受け取れ、callback から例外 (ConversionCancelled など) を送出すると途中で止められる。
+
+convert_stream / convert_file_streaming は、入力を一定の大きさの窓(行の束)ごとに変換して
+少しずつ返すので、非常に大きなファイルでもメモリ使用量が入力の大きさに比例しない。
+convert_file_mmap は入力ファイルを mmap し、行の境界で分けたバイト範囲を各プロセスが直接読んで変換する。
+
+forkserver のサーバープロセスで preload_engine を呼んでおくと (esp_forkserver_preload_module)、
+そこから fork されたワーカーは build_worker_engine で、同じ規則のエンジンを組み立て直さずに使う。
+"""
+
+import os
+import re
+import io
+import copy
+import json
+import mmap
+import shutil
+import tempfile
+from collections import deque
+from typing import List, Tuple, Dict, Iterable, Iterator, Optional
+
+from esp_text_replacement_module import (
+    DEFAULT_GLOBAL_REPLACEMENT_BACKEND,
+    import_placeholders,
+    protect_intact_and_localized_parts,
+    apply_global_replacements,
+    apply_2char_replacements,
+    restore_placeholders,
+    apply_html_formatting,
+    parallel_process,
+    parallel_process_lines,
+    apply_ruby_html_header_and_footer,
+    get_ruby_html_header_and_footer
+)
+from esp_input_normalization_module import normalize_input
+from esp_pattern_matcher_module import get_replacement_automaton, get_ngram_rule_index, KgramBitsetRuleFilter
+from esp_span_replacement_module import (
+    SpanReplacementPipeline,
+    parallel_process_with_span_pipeline,
+    parallel_process_lines_with_span_pipeline
+)
+from esp_orthography_module import OUTPUT_ORTHOGRAPHIES, OutputOrthography, create_output_orthography
+from esp_conversion_cache_module import ConversionCache, compute_ruleset_fingerprint, convert_unique_lines, output_format_key
+from esp_parallel_chunking_module import ProgressCallback, map_batches_with_progress
+from esp_shared_ruleset_module import SharedRuleLists
+from esp_executor_module import (
+    EXECUTOR_BACKENDS,
+    DEFAULT_EXECUTOR_BACKEND,
+    create_worker_pool,
+    ruleset_preload_configured
+)
+
+# ================================
+# 1) 置換用JSONのキー / 既定のファイルパス
+# ================================
+KEY_REPLACEMENTS_FINAL_LIST = "全域替换用のリスト(列表)型配列(replacements_final_list)"
+KEY_REPLACEMENTS_LIST_FOR_LOCALIZED_STRING = "局部文字替换用のリスト(列表)型配列(replacements_list_for_localized_string)"
+KEY_REPLACEMENTS_LIST_FOR_2CHAR = "二文字词根替换用のリスト(列表)型配列(replacements_list_for_2char)"
+
+DEFAULT_PLACEHOLDER_SKIP_FILE = './Appの运行に使用する各类文件/占位符(placeholders)_%1854%-%4934%_文字列替换skip用.txt'
+DEFAULT_PLACEHOLDER_LOCAL_FILE = './Appの运行に使用する各类文件/占位符(placeholders)_@5134@-@9728@_局部文字列替换结果捕捉用.txt'
+
+# 変換パイプラインの種類
+#   "placeholder": old → placeholder → new (従来の方式)
+#   "span"       : placeholder を使わず、置換済み区間から new を直接出力する
+REPLACEMENT_PIPELINES = ("placeholder", "span")
+DEFAULT_REPLACEMENT_PIPELINE = "placeholder"
+
+# 逐次ループ (大域置換の "sequential" / @…@ の局所置換) の候補規則の絞り込み方
+#   "ngram" : 先頭 n-gram の索引 (NgramRuleIndex, 誤検出なし)
+#   "bitset": 入力の k-gram の bitset (KgramBitsetRuleFilter, 誤検出率を指定できる軽量版)
+RULE_FILTERS = ("ngram", "bitset")
+DEFAULT_RULE_FILTER = "ngram"
+
+# convert_stream で1度に変換する窓の大きさ (文字数の目安)
+DEFAULT_STREAM_WINDOW_CHARS = 256 * 1024
+
+def split_combined_replacements_data(combined_data: Dict[str, list]) -> Tuple[List, List, List]:
+    """
+    合并3个JSON文件 の辞書から、
+    (replacements_final_list, replacements_list_for_localized_string, replacements_list_for_2char)
+    を取り出す。
+    """
+    return (
+        combined_data.get(KEY_REPLACEMENTS_FINAL_LIST, []),
+        combined_data.get(KEY_REPLACEMENTS_LIST_FOR_LOCALIZED_STRING, []),
+        combined_data.get(KEY_REPLACEMENTS_LIST_FOR_2CHAR, []),
+    )
+
+# ================================
+# 2) 変換エンジン本体
+# ================================
+class ReplacementEngine:
+    """
+    1組の置換規則 + format_type に対応する変換エンジン。
+
+    engine = ReplacementEngine.from_json_file(json_path, format_type)
+    engine.convert(text)            # 文字列を変換
+    engine.convert_lines(lines)     # 行ごとに変換結果を返す(ジェネレータ)
+    engine.convert_file(path)       # ファイルを読み込んで変換
+    engine.convert_stream(lines)    # 行の iterable を窓ごとに変換して返す(ジェネレータ)
+
+    result_cache を渡した場合、convert / convert_lines / convert_parallel は行ごとに
+    キャッシュを引き、キャッシュにない行だけを変換する。
+    output_orthography を指定した場合、変換結果の表記 (ĉ / c^ / cx) もそろえて返す。
+    """
+
+    def __init__(
+        self,
+        replacements_final_list: List[Tuple[str, str, str]],
+        replacements_list_for_localized_string: List[Tuple[str, str, str]],
+        replacements_list_for_2char: List[Tuple[str, str, str]],
+        placeholders_for_skipping_replacements: List[str],
+        placeholders_for_localized_replacement: List[str],
+        format_type: str,
+        global_replacement_backend: str = DEFAULT_GLOBAL_REPLACEMENT_BACKEND,
+        pipeline: str = DEFAULT_REPLACEMENT_PIPELINE,
+        rule_filter: str = DEFAULT_RULE_FILTER,
+        rule_filter_false_positive_rate: float = 0.01,
+        result_cache: Optional[ConversionCache] = None,
+        executor_backend: str = DEFAULT_EXECUTOR_BACKEND,
+        output_orthography: Optional[str] = None
+    ):
+        if pipeline not in REPLACEMENT_PIPELINES:
+            raise ValueError(f"未知の pipeline です: {pipeline}")
+        if rule_filter not in RULE_FILTERS:
+            raise ValueError(f"未知の rule_filter です: {rule_filter}")
+        if executor_backend not in EXECUTOR_BACKENDS:
+            raise ValueError(f"未知の executor_backend です: {executor_backend}")
+        if output_orthography is not None and output_orthography not in OUTPUT_ORTHOGRAPHIES:
+            raise ValueError(f"未知の output_orthography です: {output_orthography}")
+        # リストはコピーせずにそのまま保持する
+        # (同じリストから作った別の format_type のエンジンと automaton を共有するため)
+        self.replacements_final_list = replacements_final_list
+        self.replacements_list_for_localized_string = replacements_list_for_localized_string
+        self.replacements_list_for_2char = replacements_list_for_2char
+        self.placeholders_for_skipping_replacements = placeholders_for_skipping_replacements
+        self.placeholders_for_localized_replacement = placeholders_for_localized_replacement
+        self.format_type = format_type
+        self.is_html_format = "HTML" in format_type
+        self.global_replacement_backend = global_replacement_backend
+        self.pipeline = pipeline
+        self.rule_filter = rule_filter
+        self.rule_filter_false_positive_rate = rule_filter_false_positive_rate
+        self.executor_backend = executor_backend
+        self.output_orthography = output_orthography
+        # 出力の表記の変換器 (規則の new の中身の変換結果のキャッシュ) はこのエンジン専用にする。
+        # with_format_type / with_output_orthography で作ったエンジンとは、同じ規則なので共有する
+        self._output_orthographies: Dict[str, OutputOrthography] = {}
+        self._output_orthography_converter = self._get_output_orthography_converter(output_orthography)
+
+        # 大域置換用の automaton はここで1回だけ作る
+        self.global_replacement_automaton = None
+        if global_replacement_backend == "automaton" or pipeline == "span":
+            self.global_replacement_automaton = get_replacement_automaton(replacements_final_list)
+
+        # 逐次ループ用の候補規則の絞り込みも、ここで作っておく
+        def build_rule_filter(replacements):
+            if rule_filter == "bitset":
+                return KgramBitsetRuleFilter(replacements, false_positive_rate=rule_filter_false_positive_rate)
+            return get_ngram_rule_index(replacements)
+        self.global_rule_filter = None
+        self.localized_rule_filter = None
+        if global_replacement_backend == "sequential" and pipeline != "span":
+            self.global_rule_filter = build_rule_filter(replacements_final_list)
+        if pipeline != "span":
+            self.localized_rule_filter = build_rule_filter(replacements_list_for_localized_string)
+
+        self.span_pipeline = None
+        if pipeline == "span":
+            self.span_pipeline = SpanReplacementPipeline(
+                replacements_final_list,
+                replacements_list_for_localized_string,
+                replacements_list_for_2char,
+                self.global_replacement_automaton
+            )
+
+        # 行単位の変換結果のキャッシュ (キーには規則の内容から作った fingerprint を使う)
+        self.result_cache = result_cache
+        self._ruleset_fingerprint: Optional[str] = None
+        if result_cache is not None:
+            self._ruleset_fingerprint = self._compute_ruleset_fingerprint()
+
+        # 直前の convert_parallel / convert_lines_parallel の各チャンクの処理時間
+        # (esp_parallel_chunking_module.summarize_chunk_timings で偏りを確かめられる)
+        self.last_chunk_timings: List[Dict] = []
+
+    def _compute_ruleset_fingerprint(self) -> str:
+        return compute_ruleset_fingerprint(
+            self.pipeline,
+            self.replacements_final_list,
+            self.replacements_list_for_localized_string,
+            self.replacements_list_for_2char,
+            self.placeholders_for_skipping_replacements,
+            self.placeholders_for_localized_replacement
+        )
+
+    @property
+    def ruleset_fingerprint(self) -> str:
+        """
+        規則の内容 (pipeline + 3種類の置換リスト + placeholder) から作った fingerprint。
+        (result_cache がなければ、初めて使うときに1回だけ計算する)
+        """
+        if self._ruleset_fingerprint is None:
+            self._ruleset_fingerprint = self._compute_ruleset_fingerprint()
+        return self._ruleset_fingerprint
+
+    @classmethod
+    def from_combined_data(
+        cls,
+        combined_data: Dict[str, list],
+        format_type: str,
+        placeholders_for_skipping_replacements: Optional[List[str]] = None,
+        placeholders_for_localized_replacement: Optional[List[str]] = None,
+        global_replacement_backend: str = DEFAULT_GLOBAL_REPLACEMENT_BACKEND,
+        pipeline: str = DEFAULT_REPLACEMENT_PIPELINE,
+        rule_filter: str = DEFAULT_RULE_FILTER,
+        rule_filter_false_positive_rate: float = 0.01,
+        result_cache: Optional[ConversionCache] = None,
+        executor_backend: str = DEFAULT_EXECUTOR_BACKEND,
+        output_orthography: Optional[str] = None
+    ) -> "ReplacementEngine":
+        """
+        json.load() 済みの「合并3个JSON文件」の辞書からエンジンを作る。
+        placeholder を省略した場合は既定のファイルから読み込む (pipeline="span" では不要)。
+        """
+        if placeholders_for_skipping_replacements is None:
+            placeholders_for_skipping_replacements = [] if pipeline == "span" else import_placeholders(DEFAULT_PLACEHOLDER_SKIP_FILE)
+        if placeholders_for_localized_replacement is None:
+            placeholders_for_localized_replacement = [] if pipeline == "span" else import_placeholders(DEFAULT_PLACEHOLDER_LOCAL_FILE)
+        (replacements_final_list,
+         replacements_list_for_localized_string,
+         replacements_list_for_2char) = split_combined_replacements_data(combined_data)
+        return cls(
+            replacements_final_list,
+            replacements_list_for_localized_string,
+            replacements_list_for_2char,
+            placeholders_for_skipping_replacements,
+            placeholders_for_localized_replacement,
+            format_type,
+            global_replacement_backend,
+            pipeline,
+            rule_filter,
+            rule_filter_false_positive_rate,
+            result_cache,
+            executor_backend,
+            output_orthography
+        )
+
+    @classmethod
+    def from_json_file(
+        cls,
+        json_path: str,
+        format_type: str,
+        placeholders_for_skipping_replacements: Optional[List[str]] = None,
+        placeholders_for_localized_replacement: Optional[List[str]] = None,
+        global_replacement_backend: str = DEFAULT_GLOBAL_REPLACEMENT_BACKEND,
+        pipeline: str = DEFAULT_REPLACEMENT_PIPELINE,
+        rule_filter: str = DEFAULT_RULE_FILTER,
+        rule_filter_false_positive_rate: float = 0.01,
+        result_cache: Optional[ConversionCache] = None,
+        executor_backend: str = DEFAULT_EXECUTOR_BACKEND,
+        output_orthography: Optional[str] = None
+    ) -> "ReplacementEngine":
+        """置換用JSONファイル(合并3个JSON文件)のパスからエンジンを作る。"""
+        with open(json_path, 'r', encoding='utf-8') as f:
+            combined_data = json.load(f)
+        return cls.from_combined_data(
+            combined_data, format_type,
+            placeholders_for_skipping_replacements,
+            placeholders_for_localized_replacement,
+            global_replacement_backend,
+            pipeline,
+            rule_filter,
+            rule_filter_false_positive_rate,
+            result_cache,
+            executor_backend,
+            output_orthography
+        )
+
+    # ----------------------------------------
+    # 変換
+    # ----------------------------------------
+    def convert(self, text: str) -> str:
+        """
+        orchestrate_comprehensive_esperanto_text_replacement と同じ変換を行う。
+        (result_cache がある場合は行ごとに変換する。convert_lines を参照)
+        """
+        if self.result_cache is not None:
+            return ''.join(self.convert_lines(re.findall(r'.*?\n|.+$', text)))
+        return self._convert_text(text)
+
+    def _get_output_orthography_converter(self, output_orthography: Optional[str]) -> Optional[OutputOrthography]:
+        if output_orthography is None:
+            return None
+        if output_orthography not in self._output_orthographies:
+            self._output_orthographies[output_orthography] = create_output_orthography(output_orthography)
+        return self._output_orthographies[output_orthography]
+
+    def _convert_text(self, text: str, normalization_counters: Optional[Dict[str, int]] = None) -> str:
+        if self.span_pipeline is not None:
+            return self.span_pipeline.convert(text, self.format_type, self._output_orthography_converter, normalization_counters)
+
+        # 1, 2) 空白の正規化 + エスペラント字上符への変換 (%...% / @...@ の区間も同じ走査で求める)
+        text, percent_spans, at_spans = normalize_input(text, normalization_counters)
+
+        # 3, 4) %...% スキップ部 / @...@ 局所置換部 の一時置換
+        text, sorted_replacements_list_for_intact_parts, sorted_replacements_list_for_localized_string = protect_intact_and_localized_parts(
+            text, self.placeholders_for_skipping_replacements,
+            self.replacements_list_for_localized_string, self.placeholders_for_localized_replacement,
+            self.localized_rule_filter, (percent_spans, at_spans)
+        )
+
+        # 5) 大域置換
+        if self.global_replacement_automaton is not None:
+            text, valid_replacements = self.global_replacement_automaton.replace_with_placeholders(text)
+        else:
+            text, valid_replacements = apply_global_replacements(
+                text, self.replacements_final_list, self.global_replacement_backend, self.global_rule_filter
+            )
+
+        # 6) 2文字語根置換(2回)
+        text, valid_replacements_for_2char_roots, valid_replacements_for_2char_roots_2 = apply_2char_replacements(
+            text, self.replacements_list_for_2char
+        )
+
+        # 7) placeholder の復元 (出力の表記も同時にそろえる)
+        text = restore_placeholders(
+            text, valid_replacements, valid_replacements_for_2char_roots, valid_replacements_for_2char_roots_2,
+            sorted_replacements_list_for_intact_parts, sorted_replacements_list_for_localized_string,
+            self._output_orthography_converter
+        )
+
+        # 8) HTML形式の追加整形
+        return apply_html_formatting(text, self.format_type)
+
+    def convert_lines(
+        self,
+        lines: Iterable[str],
+        progress_callback: Optional[ProgressCallback] = None,
+        normalization_counters: Optional[Dict[str, int]] = None
+    ) -> Iterator[str]:
+        """
+        行(改行込み)ごとに変換結果を返すジェネレータ。
+        %...% / @...@ / 置換規則はいずれも改行をまたがないので、
+        ''.join(engine.convert_lines(lines)) は engine.convert(''.join(lines)) と同じになる。
+        (例外: 文書全体では同じ '@xxx@' の text.replace() が別の行の placeholder を壊すような
+         不正な %/@ の組み合わせがある場合。行単位の方が壊れにくい)
+        result_cache がある場合は、同じ内容の行を1回だけ変換し、変換済みの行は再利用する。
+        progress_callback があれば、変換する行 (result_cache にない行) の一定の文字数ごとに進捗を返す。
+        (どちらの場合も lines は最初にまとめて読み込む)
+        normalization_counters (esp_input_normalization_module.new_normalization_counters) を渡すと、
+        変換した行 (result_cache にあった行は除く) で飛ばした正規化の段階の数をそこに足す。
+        """
+        if self.result_cache is None and progress_callback is None:
+            for line in lines:
+                yield self._convert_text(line, normalization_counters)
+            return
+        yield from convert_unique_lines(
+            list(lines),
+            lambda missing_lines: map_batches_with_progress(
+                lambda batch: [self._convert_text(line, normalization_counters) for line in batch],
+                missing_lines, progress_callback
+            ),
+            self.result_cache,
+            self._cache_fingerprint(),
+            self.output_format_key
+        )
+
+    def convert_file(self, path: str, encoding: str = 'utf-8') -> str:
+        """テキストファイルを読み込み、行ごとに変換して結合した結果を返す。"""
+        with open(path, 'r', encoding=encoding) as f:
+            return ''.join(self.convert_lines(f))
+
+    def rule_filter_counters(self) -> Dict[str, Tuple[int, int]]:
+        """
+        候補規則の絞り込みの累計 {リスト名: (調べた規則数, 飛ばした規則数)} を返す
+        (このプロセスの convert / convert_lines / convert_file の分)。
+        """
+        counters = {}
+        if self.global_rule_filter is not None:
+            counters["replacements_final_list"] = (self.global_rule_filter.rules_scanned, self.global_rule_filter.rules_skipped)
+        if self.localized_rule_filter is not None:
+            counters["replacements_list_for_localized_string"] = (self.localized_rule_filter.rules_scanned, self.localized_rule_filter.rules_skipped)
+        return counters
+
+    def _cache_fingerprint(self) -> str:
+        # キャッシュを使わない場合は fingerprint を計算しない
+        return self.ruleset_fingerprint if self.result_cache is not None else ""
+
+    @property
+    def output_format_key(self) -> str:
+        """result_cache のキーに使う format_type (出力の表記を指定していれば、その名前も含む)。"""
+        return output_format_key(self.format_type, self.output_orthography)
+
+    def cache_counters(self) -> Dict[str, int]:
+        """result_cache のヒット/ミスの回数を返す (キャッシュがなければ空の辞書)。"""
+        if self.result_cache is None:
+            return {}
+        return self.result_cache.counters()
+
+    def with_format_type(self, format_type: str) -> "ReplacementEngine":
+        """
+        同じ規則で format_type だけが違うエンジンを返す。
+        (automaton などの前処理と result_cache は作り直さずに共有する。キャッシュのキーには format_type が含まれる)
+        """
+        engine = copy.copy(self)
+        engine.format_type = format_type
+        engine.is_html_format = "HTML" in format_type
+        engine.last_chunk_timings = []
+        return engine
+
+    def with_output_orthography(self, output_orthography: Optional[str]) -> "ReplacementEngine":
+        """
+        同じ規則で出力の表記 (OUTPUT_ORTHOGRAPHIES のどれか / None なら表記を変えない) だけが違うエンジンを返す。
+        (with_format_type と同じく前処理と result_cache を共有する。キャッシュのキーには表記の名前が含まれる)
+        """
+        if output_orthography is not None and output_orthography not in OUTPUT_ORTHOGRAPHIES:
+            raise ValueError(f"未知の output_orthography です: {output_orthography}")
+        engine = copy.copy(self)
+        engine.output_orthography = output_orthography
+        engine._output_orthography_converter = self._get_output_orthography_converter(output_orthography)
+        engine.last_chunk_timings = []
+        return engine
+
+    def convert_parallel(
+        self,
+        text: str,
+        num_processes: int,
+        progress_callback: Optional[ProgressCallback] = None
+    ) -> str:
+        """
+        parallel_process を使って行単位で並列に変換する。
+        (各プロセスでは既定の n-gram 索引を使う。rule_filter_counters には含まれない)
+        同じ内容の行と result_cache にある行は、各プロセスには送らない。
+        各チャンクの処理時間は last_chunk_timings に残る。
+        プロセス / スレッド / インラインのどれで実行するかは executor_backend による。
+        progress_callback があれば、チャンクごとに進捗を返す (parallel_process を参照)。
+        """
+        self.last_chunk_timings = []
+        if self.span_pipeline is not None:
+            return parallel_process_with_span_pipeline(
+                text,
+                num_processes,
+                self.replacements_final_list,
+                self.replacements_list_for_localized_string,
+                self.replacements_list_for_2char,
+                self.format_type,
+                self.result_cache,
+                self._cache_fingerprint(),
+                self.last_chunk_timings,
+                self.executor_backend,
+                progress_callback,
+                self.output_orthography
+            )
+        return parallel_process(
+            text,
+            num_processes,
+            self.placeholders_for_skipping_replacements,
+            self.replacements_list_for_localized_string,
+            self.placeholders_for_localized_replacement,
+            self.replacements_final_list,
+            self.replacements_list_for_2char,
+            self.format_type,
+            self.global_replacement_backend,
+            self.result_cache,
+            self._cache_fingerprint(),
+            self.last_chunk_timings,
+            self.executor_backend,
+            progress_callback,
+            self.output_orthography
+        )
+
+    def convert_lines_parallel(
+        self,
+        lines: List[str],
+        num_processes: int,
+        progress_callback: Optional[ProgressCallback] = None
+    ) -> List[str]:
+        """
+        convert_parallel の行単位版: lines (改行込み) の各行の変換結果を同じ順番のリストで返す。
+        """
+        self.last_chunk_timings = []
+        if self.span_pipeline is not None:
+            return parallel_process_lines_with_span_pipeline(
+                lines,
+                num_processes,
+                self.replacements_final_list,
+                self.replacements_list_for_localized_string,
+                self.replacements_list_for_2char,
+                self.format_type,
+                self.result_cache,
+                self._cache_fingerprint(),
+                self.last_chunk_timings,
+                self.executor_backend,
+                progress_callback,
+                self.output_orthography
+            )
+        return parallel_process_lines(
+            lines,
+            num_processes,
+            self.placeholders_for_skipping_replacements,
+            self.replacements_list_for_localized_string,
+            self.placeholders_for_localized_replacement,
+            self.replacements_final_list,
+            self.replacements_list_for_2char,
+            self.format_type,
+            self.global_replacement_backend,
+            self.result_cache,
+            self._cache_fingerprint(),
+            self.last_chunk_timings,
+            self.executor_backend,
+            progress_callback,
+            self.output_orthography
+        )
+
+    # ----------------------------------------
+    # 逐次(ストリーミング)変換
+    # ----------------------------------------
+    def _rule_lists(self) -> list:
+        # 置換リスト3種類 + placeholder リスト2種類 (コンストラクタの引数の順番)
+        return [
+            self.replacements_final_list,
+            self.replacements_list_for_localized_string,
+            self.replacements_list_for_2char,
+            self.placeholders_for_skipping_replacements,
+            self.placeholders_for_localized_replacement
+        ]
+
+    def _engine_arguments(self, rule_lists: Optional[list] = None) -> tuple:
+        # 別プロセスで同じエンジンを作り直すための引数 (result_cache は渡さない)
+        # rule_lists に SharedRuleLists.views を渡すと、リストの代わりに共有メモリのビューを送る
+        if rule_lists is None:
+            rule_lists = self._rule_lists()
+        return (
+            *rule_lists,
+            self.format_type,
+            self.global_replacement_backend,
+            self.pipeline,
+            self.rule_filter,
+            self.rule_filter_false_positive_rate
+        )
+
+    def _preload_key(self) -> tuple:
+        # forkserver で読み込み済みのエンジンと同じ規則・設定かどうかを見分けるためのキー (format_type は含めない)
+        return (
+            self.ruleset_fingerprint,
+            self.global_replacement_backend,
+            self.pipeline,
+            self.rule_filter,
+            self.rule_filter_false_positive_rate
+        )
+
+    def _worker_rules(self, share_rules: bool = True) -> Tuple[tuple, Optional[SharedRuleLists]]:
+        """
+        ワーカーの build_worker_engine に渡す引数 (format_type と出力の表記は規則とは別に渡す) と、そのために作った共有メモリ (使い終わったら close する) を返す。
+        forkserver で同じ規則のエンジンを読み込み済みなら、規則は送らない (共有メモリも作らない)。
+        そうでなければ、share_rules なら規則を共有メモリに書き込んでビューを送り、そうでなければリストを pickle して送る。
+        """
+        if ruleset_preload_configured() and self._preload_key() in forkserver_preloaded_engine_keys():
+            return (None, self._preload_key(), self.format_type, self.output_orthography), None
+        shared_rules = SharedRuleLists(self._rule_lists()) if share_rules else None
+        engine_arguments = self._engine_arguments(shared_rules.views if shared_rules is not None else None)
+        return (engine_arguments, None, self.format_type, self.output_orthography), shared_rules
+
+    def convert_stream(
+        self,
+        lines: Iterable[str],
+        window_chars: int = DEFAULT_STREAM_WINDOW_CHARS,
+        num_processes: int = 1
+    ) -> Iterator[str]:
+        """
+        行(改行込み)の iterable (開いたファイルなど) を、window_chars 文字程度の窓ごとに変換して
+        変換結果を順番に返すジェネレータ。''.join(engine.convert_stream(lines)) は
+        engine.convert(''.join(lines)) と同じになる (convert_lines と同じく、行をまたぐ規則はないため)。
+        入力は必要な分だけ読み進め、保持するのは変換中の窓 (num_processes > 1 なら 2×プロセス数 個まで) だけ。
+        """
+        windows = iter_line_windows(lines, window_chars)
+        if num_processes <= 1:
+            for window in windows:
+                yield self.convert(window)
+            return
+
+        # 各プロセスでは1回だけエンジンを作り、窓(文字列)だけを送る
+        # (規則は共有メモリに1回だけ書き込み、各プロセスはそれを参照する。forkserver で読み込み済みなら送らない)
+        max_pending_windows = 2 * num_processes
+        initargs, shared_rules = self._worker_rules()
+        try:
+            with create_worker_pool(num_processes, _initialize_stream_worker, initargs) as pool:
+                pending = deque()
+                for window in windows:
+                    pending.append(pool.apply_async(_convert_stream_window, (window,)))
+                    if len(pending) >= max_pending_windows:
+                        yield pending.popleft().get()
+                while pending:
+                    yield pending.popleft().get()
+        finally:
+            if shared_rules is not None:
+                shared_rules.close()
+
+    def convert_file_streaming(
+        self,
+        input_path: str,
+        output_path: str,
+        window_chars: int = DEFAULT_STREAM_WINDOW_CHARS,
+        num_processes: int = 1,
+        encoding: str = 'utf-8',
+        add_html_header_and_footer: bool = True
+    ) -> int:
+        """
+        input_path を読み込みながら変換し、output_path に少しずつ書き出す。
+        (add_html_header_and_footer なら apply_html_header_and_footer と同じヘッダー/フッターを付ける)
+        読み込んだ文字数を返す。
+        """
+        num_chars = 0
+        head, tail = get_ruby_html_header_and_footer(self.format_type) if add_html_header_and_footer else ("", "")
+
+        def counted_lines(f) -> Iterator[str]:
+            nonlocal num_chars
+            for line in f:
+                num_chars += len(line)
+                yield line
+
+        with open(input_path, 'r', encoding=encoding) as f, open(output_path, 'w', encoding=encoding) as h:
+            h.write(head)
+            for converted in self.convert_stream(counted_lines(f), window_chars, num_processes):
+                h.write(converted)
+            h.write(tail)
+        return num_chars
+
+    def convert_file_mmap(
+        self,
+        input_path: str,
+        output_path: str,
+        num_processes: int,
+        window_chars: int = DEFAULT_STREAM_WINDOW_CHARS,
+        encoding: str = 'utf-8',
+        add_html_header_and_footer: bool = True
+    ) -> int:
+        """
+        入力ファイルを mmap して並列に変換し、output_path に書き出す (一括変換用)。
+        親プロセスは mmap 上で行の境界になるバイト位置を探すだけで、本文を読み込んだり
+        pickle して送ったりはしない。各プロセスは自分のバイト範囲だけをデコード・変換し、
+        プロセスごとの一時ファイルに書き出す。最後に一時ファイルを順番に連結する。
+        読み込んだバイト数を返す。
+        """
+        if num_processes <= 1:
+            self.convert_file_streaming(input_path, output_path, window_chars, 1, encoding, add_html_header_and_footer)
+            return os.path.getsize(input_path)
+
+        head, tail = get_ruby_html_header_and_footer(self.format_type) if add_html_header_and_footer else ("", "")
+        byte_ranges = find_line_aligned_byte_ranges(input_path, num_processes)
+        output_dir = os.path.dirname(os.path.abspath(output_path))
+        temp_paths: List[str] = []
+        shared_rules: Optional[SharedRuleLists] = None
+        try:
+            for _ in byte_ranges:
+                fd, temp_path = tempfile.mkstemp(suffix='.part', dir=output_dir)
+                os.close(fd)
+                temp_paths.append(temp_path)
+            initargs, shared_rules = self._worker_rules()
+            with create_worker_pool(num_processes, _initialize_stream_worker, initargs) as pool:
+                pool.starmap(
+                    _convert_file_byte_range,
+                    [
+                        (input_path, start, end, temp_path, window_chars, encoding)
+                        for (start, end), temp_path in zip(byte_ranges, temp_paths)
+                    ]
+                )
+            with open(output_path, 'w', encoding=encoding) as h:
+                h.write(head)
+                h.flush()
+                for temp_path in temp_paths:
+                    with open(temp_path, 'rb') as part:
+                        shutil.copyfileobj(part, h.buffer)
+                h.write(tail)
+        finally:
+            if shared_rules is not None:
+                shared_rules.close()
+            for temp_path in temp_paths:
+                if os.path.exists(temp_path):
+                    os.remove(temp_path)
+        return byte_ranges[-1][1] if byte_ranges else 0
+
+    def apply_html_header_and_footer(self, processed_text: str) -> str:
+        """format_type に応じたHTMLヘッダー/フッターを付ける。"""
+        return apply_ruby_html_header_and_footer(processed_text, self.format_type)
+
+# ================================
+# 3) 逐次(ストリーミング)変換の下請け
+# ================================
+def iter_line_windows(lines: Iterable[str], window_chars: int = DEFAULT_STREAM_WINDOW_CHARS) -> Iterator[str]:
+    """
+    行(改行込み)を順に束ね、window_chars 文字以上になったら1つの窓(文字列)として返す。
+    (1行が window_chars より長い場合は、その行だけで1つの窓になる)
+    """
+    window: List[str] = []
+    window_length = 0
+    for line in lines:
+        window.append(line)
+        window_length += len(line)
+        if window_length >= window_chars:
+            yield ''.join(window)
+            window = []
+            window_length = 0
+    if window:
+        yield ''.join(window)
+
+# 各ワーカープロセスで1つだけ作るエンジン
+_stream_worker_engine: Optional[ReplacementEngine] = None
+
+def _initialize_stream_worker(
+    engine_arguments: Optional[tuple],
+    preload_key: Optional[tuple] = None,
+    format_type: str = "",
+    output_orthography: Optional[str] = None
+) -> None:
+    global _stream_worker_engine
+    _stream_worker_engine = build_worker_engine(engine_arguments, preload_key, format_type, output_orthography)
+
+def _convert_stream_window(window: str) -> str:
+    return _stream_worker_engine.convert(window)
+
+def find_line_aligned_byte_ranges(input_path: str, num_ranges: int) -> List[Tuple[int, int]]:
+    """
+    ファイルをおよそ等しい大きさの num_ranges 個のバイト範囲 [start, end) に分ける。
+    各範囲の境界は改行(b'\\n')の直後に合わせるので、範囲ごとに独立してデコード・変換できる。
+    (UTF-8 などでは b'\\n' が多バイト文字の途中に現れることはない)
+    """
+    file_size = os.path.getsize(input_path)
+    if file_size == 0:
+        return []
+    boundaries = [0]
+    with open(input_path, 'rb') as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mapped:
+        for k in range(1, num_ranges):
+            target = max(file_size * k // num_ranges, boundaries[-1])
+            newline = mapped.find(b'\n', target)
+            boundary = file_size if newline == -1 else newline + 1
+            if boundary >= file_size:
+                break
+            if boundary > boundaries[-1]:
+                boundaries.append(boundary)
+    boundaries.append(file_size)
+    return list(zip(boundaries[:-1], boundaries[1:]))
+
+def _convert_file_byte_range(
+    input_path: str,
+    start: int,
+    end: int,
+    temp_path: str,
+    window_chars: int,
+    encoding: str
+) -> None:
+    # 自分の範囲だけを mmap から読み、open(…, 'r') と同じく改行を '\n' にそろえてから変換する
+    with open(input_path, 'rb') as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mapped:
+        text = mapped[start:end].decode(encoding)
+    text = text.replace('\r\n', '\n').replace('\r', '\n')
+    with open(temp_path, 'w', encoding=encoding) as h:
+        for converted in _stream_worker_engine.convert_stream(io.StringIO(text, newline='\n'), window_chars):
+            h.write(converted)
+
+# ================================
+# 4) forkserver での事前読み込み
+# ================================
+# forkserver のサーバープロセスで組み立てておいたエンジン (_preload_key() → エンジン)。
+# fork されたワーカーはサーバープロセスのメモリをそのまま引き継ぐので、automaton などを作り直さずに使える。
+_preloaded_engines: Dict[tuple, ReplacementEngine] = {}
+# 親プロセス側: forkserver で読み込み済みのエンジンのキー (サーバープロセスから fork したワーカーに1回だけ問い合わせる)
+_forkserver_preloaded_keys: Optional[set] = None
+
+def preload_engine(json_path: str, pipeline: str = DEFAULT_REPLACEMENT_PIPELINE) -> ReplacementEngine:
+    """
+    置換用JSONからエンジンを組み立てて、このプロセスに登録する (esp_forkserver_preload_module から呼ぶ)。
+    format_type はワーカーで with_format_type によって差し替える。
+    """
+    engine = ReplacementEngine.from_json_file(json_path, "", pipeline=pipeline)
+    _preloaded_engines[engine._preload_key()] = engine
+    return engine
+
+def _preloaded_engine_keys() -> list:
+    return list(_preloaded_engines)
+
+def forkserver_preloaded_engine_keys() -> set:
+    """forkserver のサーバープロセスで読み込み済みのエンジンのキー (ReplacementEngine._preload_key) の集合。"""
+    global _forkserver_preloaded_keys
+    if not ruleset_preload_configured():
+        return set()
+    if _forkserver_preloaded_keys is None:
+        with create_worker_pool(1) as pool:
+            _forkserver_preloaded_keys = set(pool.apply(_preloaded_engine_keys))
+    return _forkserver_preloaded_keys
+
+def build_worker_engine(
+    engine_arguments: Optional[tuple],
+    preload_key: Optional[tuple] = None,
+    format_type: str = "",
+    output_orthography: Optional[str] = None
+) -> ReplacementEngine:
+    """
+    ワーカーでエンジンを用意する。preload_key と同じ規則・設定のエンジンが読み込み済みならそれを使い、
+    なければ engine_arguments (ReplacementEngine._engine_arguments) から組み立てる
+    (読み込み済みのときは、親プロセスは engine_arguments に None を渡して規則を送らない)。
+    出力の表記 (output_orthography) は engine_arguments に含めず、ここで指定する。
+    """
+    preloaded = _preloaded_engines.get(preload_key) if preload_key is not None else None
+    if preloaded is not None:
+        return preloaded.with_format_type(format_type).with_output_orthography(output_orthography)
+    return ReplacementEngine(*engine_arguments, output_orthography=output_orthography)
@@ -6,49 +6,46 @@
 
 【構成】
 1) 文字変換用の辞書定義 (字上符形式への変換など)
-2) 基本の文字形式変換関数 (replace_esperanto_chars, convert_to_circumflex, など)
+2) 基本の文字形式変換関数 (replace_esperanto_chars, convert_to_circumflex, など → esp_orthography_module)
 3) 文字幅計測＆<br>挿入関数 (measure_text_width_Arial16, insert_br_at_half_width, insert_br_at_third_width)
 4) 出力フォーマット (output_format) 関連
 5) 文字列判定・placeholder インポートなどの補助関数
-6) multiprocessing 関連の並列置換用関数 (process_chunk_for_pre_replacements, parallel_build_pre_replacements_dict)
+6) multiprocessing 関連の並列置換用関数 (process_chunk_for_pre_replacements, parallel_build_pre_replacements_dict,
+   直列/並列の自動選択用の calibrate_pre_replacements_planner。
+   プロセス / スレッド / インラインのどれで実行するかは executor_backend で選ぶ → esp_executor_module)
 """
 
 import re
 import json
-import multiprocessing
 import pandas as pd
 import os
 from typing import List, Dict, Tuple, Optional
 
-#=================================================================
-# 1) エスペラント文字変換用の辞書 (同様のものが他のファイルにもある)
-#=================================================================
-x_to_circumflex = {'cx': 'ĉ', 'gx': 'ĝ', 'hx': 'ĥ', 'jx': 'ĵ', 'sx': 'ŝ', 'ux': 'ŭ',
-                   'Cx': 'Ĉ', 'Gx': 'Ĝ', 'Hx': 'Ĥ', 'Jx': 'Ĵ', 'Sx': 'Ŝ', 'Ux': 'Ŭ'}
-circumflex_to_x = {'ĉ': 'cx', 'ĝ': 'gx', 'ĥ': 'hx', 'ĵ': 'jx', 'ŝ': 'sx', 'ŭ': 'ux',
-                   'Ĉ': 'Cx', 'Ĝ': 'Gx', 'Ĥ': 'Hx', 'Ĵ': 'Jx', 'Ŝ': 'Sx', 'Ŭ': 'Ux'}
-x_to_hat = {'cx': 'c^', 'gx': 'g^', 'hx': 'h^', 'jx': 'j^', 'sx': 's^', 'ux': 'u^',
-            'Cx': 'C^', 'Gx': 'G^', 'Hx': 'H^', 'Jx': 'J^', 'Sx': 'S^', 'Ux': 'U^'}
-hat_to_x = {'c^': 'cx', 'g^': 'gx', 'h^': 'hx', 'j^': 'jx', 's^': 'sx', 'u^': 'ux',
-            'C^': 'Cx', 'G^': 'Gx', 'H^': 'Hx', 'J^': 'Jx', 'S^': 'Sx', 'U^': 'Ux'}
-hat_to_circumflex = {'c^': 'ĉ', 'g^': 'ĝ', 'h^': 'ĥ', 'j^': 'ĵ', 's^': 'ŝ', 'u^': 'ŭ',
-                     'C^': 'Ĉ', 'G^': 'Ĝ', 'H^': 'Ĥ', 'J^': 'Ĵ', 'S^': 'Ŝ', 'U^': 'Ŭ'}
-circumflex_to_hat = {'ĉ': 'c^', 'ĝ': 'g^', 'ĥ': 'h^', 'ĵ': 'j^', 'ŝ': 's^', 'ŭ': 'u^',
-                     'Ĉ': 'C^', 'Ĝ': 'G^', 'Ĥ': 'H^', 'Ĵ': 'J^', 'Ŝ': 'S^', 'Ŭ': 'U^'}
+from esp_pattern_matcher_module import KgramBitsetRuleFilter
+from esp_parallel_planning_module import (
+    ParallelismPlanner,
+    available_cpu_count,
+    measure_seconds_per_unit,
+    measure_pool_startup_seconds
+)
+from esp_executor_module import DEFAULT_EXECUTOR_BACKEND, create_executor, backend_runs_in_parallel
+from esp_orthography_module import (
+    x_to_circumflex,
+    circumflex_to_x,
+    x_to_hat,
+    hat_to_x,
+    hat_to_circumflex,
+    circumflex_to_hat,
+    replace_esperanto_chars,
+    convert_to_circumflex
+)
 
 #=================================================================
+# 1) エスペラント文字変換用の辞書
 # 2) 基本の文字形式変換関数
+#    (esp_text_replacement_module と重複していたので、esp_orthography_module にまとめた。
+#     このモジュールからも従来どおり import できる)
 #=================================================================
-def replace_esperanto_chars(text, char_dict: Dict[str, str]) -> str:
-    for original_char, converted_char in char_dict.items():
-        text = text.replace(original_char, converted_char)
-    return text
-
-def convert_to_circumflex(text: str) -> str:
-    # c^, g^... → ĉ, ĝ...  および cx, gx... → ĉ, ĝ... に変換
-    text = replace_esperanto_chars(text, hat_to_circumflex)
-    text = replace_esperanto_chars(text, x_to_circumflex)
-    return text
 
 #=================================================================
 # 3) 文字幅計測 & <br> 挿入関数
@@ -228,12 +225,19 @@ def capitalize_ruby_and_rt(text: str) -> str:
 #=================================================================
 # 6) multiprocessing 関連
 #=================================================================
-def safe_replace(text: str, replacements: List[Tuple[str, str, str]]) -> str:
+def safe_replace(
+    text: str,
+    replacements: List[Tuple[str, str, str]],
+    rule_filter: Optional[KgramBitsetRuleFilter] = None
+) -> str:
     """
     こちらにも safe_replace が定義されている (同名関数)
     (mainページ用のesp_text_replacement_module.pyと重複しているが別ファイル)
+    rule_filter を渡すと、text に現れうる規則だけを調べる (結果は同じ)。
     """
     valid_replacements = {}
+    if rule_filter is not None:
+        replacements = [replacements[i] for i in rule_filter.candidate_rule_indices(text)]
     for old, new, placeholder in replacements:
         if old in text:
             text = text.replace(old, placeholder)
@@ -244,7 +248,8 @@ def safe_replace(text: str, replacements: List[Tuple[str, str, str]]) -> str:
 
 def process_chunk_for_pre_replacements(
     chunk: List[List[str]],
-    replacements: List[Tuple[str, str, str]]
+    replacements: List[Tuple[str, str, str]],
+    rule_filter: Optional[KgramBitsetRuleFilter] = None
 ) -> Dict[str, List[str]]:
     """
     chunk: [[E_root, pos], ...] の部分リスト
@@ -265,18 +270,38 @@ def process_chunk_for_pre_replacements(
                 merged_pos_str = ",".join(existing_pos_list)
                 local_dict[E_root] = [replaced_stem, merged_pos_str]
         else:
-            replaced = safe_replace(E_root, replacements)
+            replaced = safe_replace(E_root, replacements, rule_filter)
             local_dict[E_root] = [replaced, pos_info]
     return local_dict
 
+def process_chunk_for_pre_replacements_with_rule_filter(
+    chunk: List[List[str]],
+    replacements: List[Tuple[str, str, str]],
+    false_positive_rate: float
+) -> Tuple[Dict[str, List[str]], int, int]:
+    """
+    process_chunk_for_pre_replacements の KgramBitsetRuleFilter 付き版 (各プロセスでフィルタを作る)。
+    戻り値: (結果の辞書, 調べた規則数, 飛ばした規則数)
+    """
+    rule_filter = KgramBitsetRuleFilter(replacements, false_positive_rate=false_positive_rate)
+    local_dict = process_chunk_for_pre_replacements(chunk, replacements, rule_filter)
+    return local_dict, rule_filter.rules_scanned, rule_filter.rules_skipped
+
 def parallel_build_pre_replacements_dict(
     E_stem_with_Part_Of_Speech_list: List[List[str]],
     replacements: List[Tuple[str, str, str]],
-    num_processes: int = 4
+    num_processes: int = 4,
+    false_positive_rate: Optional[float] = None,
+    rule_filter_counters: Optional[Dict[str, int]] = None,
+    executor_backend: str = DEFAULT_EXECUTOR_BACKEND
 ) -> Dict[str, List[str]]:
     """
     データを num_processes 個に分割し、process_chunk_for_pre_replacements を並列実行
     最終的に辞書をマージして返す。
+    false_positive_rate を指定すると、各プロセスで KgramBitsetRuleFilter を使って規則を絞り込み、
+    rule_filter_counters (辞書) に 'scanned' / 'skipped' の規則数を加算する。
+    executor_backend で並列処理の実行方式 ("process" / "thread" / "inline") を選ぶ
+    ("thread" / "inline" では replacements を pickle せずにそのまま渡す)。
     """
     total_len = len(E_stem_with_Part_Of_Speech_list)
     if total_len == 0:
@@ -293,11 +318,22 @@ def parallel_build_pre_replacements_dict(
         if start_index >= total_len:
             break
 
-    with multiprocessing.Pool(num_processes) as pool:
-        partial_dicts = pool.starmap(
-            process_chunk_for_pre_replacements,
-            [(chunk, replacements) for chunk in chunks]
-        )
+    with create_executor(executor_backend, num_processes) as executor:
+        if false_positive_rate is None:
+            partial_dicts = executor.starmap(
+                process_chunk_for_pre_replacements,
+                [(chunk, replacements) for chunk in chunks]
+            )
+        else:
+            partial_results = executor.starmap(
+                process_chunk_for_pre_replacements_with_rule_filter,
+                [(chunk, replacements, false_positive_rate) for chunk in chunks]
+            )
+            partial_dicts = [partial_d for partial_d, scanned, skipped in partial_results]
+            if rule_filter_counters is not None:
+                for partial_d, scanned, skipped in partial_results:
+                    rule_filter_counters['scanned'] = rule_filter_counters.get('scanned', 0) + scanned
+                    rule_filter_counters['skipped'] = rule_filter_counters.get('skipped', 0) + skipped
 
     merged_dict = {}
     for partial_d in partial_dicts:
@@ -315,6 +351,45 @@ def parallel_build_pre_replacements_dict(
 
     return merged_dict
 
+def calibrate_pre_replacements_planner(
+    E_stem_with_Part_Of_Speech_list: List[List[str]],
+    replacements: List[Tuple[str, str, str]],
+    false_positive_rate: Optional[float] = None,
+    max_processes: Optional[int] = None,
+    sample_size: int = 2000,
+    executor_backend: str = DEFAULT_EXECUTOR_BACKEND
+) -> ParallelismPlanner:
+    """
+    parallel_build_pre_replacements_dict を使うかどうか(何プロセスか)を決めるための ParallelismPlanner を作る。
+    - 1語根あたりの時間: リスト全体から等間隔に取った sample_size 個を直列で処理して測る
+    - ワーカーの起動時間: CPU が2つ以上使えるなら、1ワーカーの executor で replacements を受け取るまでを測る
+      (並列版は各タスクに replacements を pickle して送り、false_positive_rate があればフィルタも作るので、それも含める)
+    executor_backend が並列に動かない方式なら、起動時間は測らずに常に直列を選ぶ planner になる。
+    """
+    step = max(len(E_stem_with_Part_Of_Speech_list) // sample_size, 1)
+    sample = E_stem_with_Part_Of_Speech_list[::step][:sample_size]
+    rule_filter = None
+    if false_positive_rate is not None:
+        rule_filter = KgramBitsetRuleFilter(replacements, false_positive_rate=false_positive_rate)
+    seconds_per_item = measure_seconds_per_unit(
+        lambda: process_chunk_for_pre_replacements(sample, replacements, rule_filter), len(sample)
+    )
+    worker_startup_seconds = 0.0
+    if available_cpu_count() >= 2 and backend_runs_in_parallel(executor_backend):
+        if false_positive_rate is None:
+            worker_startup_seconds = measure_pool_startup_seconds(
+                task=process_chunk_for_pre_replacements, task_args=([], replacements),
+                executor_backend=executor_backend
+            )
+        else:
+            worker_startup_seconds = measure_pool_startup_seconds(
+                task=process_chunk_for_pre_replacements_with_rule_filter, task_args=([], replacements, false_positive_rate),
+                executor_backend=executor_backend
+            )
+    return ParallelismPlanner(
+        seconds_per_item, worker_startup_seconds, max_processes=max_processes, executor_backend=executor_backend
+    )
+
 #=================================================================
 # 追加(202502):
 # 同一ルビが (ルビ付けした結果) 重複している場合に削除する関数
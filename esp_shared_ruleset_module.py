@@ -0,0 +1,212 @@
+## esp_shared_ruleset_module.py
+
+"""
+置換リスト / placeholder リストを multiprocessing.shared_memory に1回だけ書き込み、
+ワーカープロセスからは読み取り専用で参照するためのモジュール。
+
+これまでは各ワーカーが initializer (または starmap の各タスク) で3種類の置換リストを
+pickle で受け取り、それぞれが約 50 MB の (old, new, placeholder) のリストを丸ごと持っていた。
+ワーカー数を増やすと、その分だけメモリ使用量が増える。
+
+SharedRuleLists は全ての文字列を UTF-8 で1つの共有メモリにつなげて書き込み
+  [各文字列の開始位置 (uint64 × (文字列数+1))][UTF-8 の文字列データ (各文字列の後ろに '\0')]
+という形にする ('\0' は for で順に読むときに、まとめてデコードして split するための区切り)。
+SharedRuleList はその上の読み取り専用のビューで、
+リストと同じように len() / [i] / for で (old, new, placeholder) を返す (参照したときにだけデコードする)。
+SharedRuleList を pickle すると共有メモリの名前と位置だけが送られ、受け取った側では同じ共有メモリに attach する。
+
+共有されるのは規則のリストだけで、ReplacementEngine が内部で作る automaton / n-gram 索引などの辞書は
+Python のオブジェクトなので共有できない (各ワーカーが共有メモリのビューから1回だけ作る)。
+そのため、リストの複製の分はワーカー数に比例しなくなるが、automaton などの分は今でもワーカー数に比例して増える
+(メモリ使用量がワーカー数によらずほぼ一定になるのは、forkserver のサーバープロセスが同じ規則のエンジンを
+読み込み済みの場合だけ: esp_forkserver_preload_module。main.py では既定の置換用JSONの場合)。
+"""
+
+import array
+import atexit
+import weakref
+from collections.abc import Sequence
+from multiprocessing import shared_memory
+from typing import List, Dict, Tuple
+
+_OFFSET_ITEM_SIZE = 8  # 開始位置は uint64 ('Q')
+_ITER_BLOCK_SIZE = 4096  # for で読むときに1回でデコードする要素数
+
+# ================================
+# 1) 読み取り専用のビュー
+# ================================
+# このプロセスで attach した共有メモリ (名前 → SharedMemory) と、その上のビュー。
+# プロセスが終わるまで開いておき、終了時にビューを解放してから閉じる
+# (ビューが残ったまま SharedMemory が破棄されると BufferError になるため)。
+_attached_segments: Dict[str, shared_memory.SharedMemory] = {}
+_attached_views: List["SharedRuleList"] = []
+
+def _attach_segment(segment_name: str) -> shared_memory.SharedMemory:
+    segment = _attached_segments.get(segment_name)
+    if segment is None:
+        if not _attached_segments:
+            atexit.register(_close_attached_segments)
+        segment = shared_memory.SharedMemory(name=segment_name)
+        _attached_segments[segment_name] = segment
+    return segment
+
+def _close_attached_segments() -> None:
+    for view in _attached_views:
+        view._release()
+    _attached_views.clear()
+    for segment in _attached_segments.values():
+        segment.close()
+    _attached_segments.clear()
+
+class SharedRuleList(Sequence):
+    """
+    共有メモリ上の規則表の一部を、(old, new, placeholder) のリスト (width=1 なら文字列のリスト) として見せるビュー。
+    """
+
+    def __init__(
+        self,
+        segment_name: str,
+        string_count: int,
+        first_string: int,
+        length: int,
+        width: int,
+        separated: bool = True,
+        buffer=None
+    ):
+        self.segment_name = segment_name
+        self.string_count = string_count
+        self.first_string = first_string
+        self.length = length
+        self.width = width
+        # 文字列自体に '\0' を含むものがなければ、区切りでまとめて split できる
+        self.separated = separated
+        attached = buffer is None
+        if attached:
+            buffer = _attach_segment(segment_name).buf
+        offsets_size = _OFFSET_ITEM_SIZE * (string_count + 1)
+        self._offsets = buffer[:offsets_size].cast('Q')
+        self._data = buffer[offsets_size:]
+        if attached:
+            _attached_views.append(self)
+
+    def _string(self, string_index: int) -> str:
+        offsets = self._offsets
+        return str(self._data[offsets[string_index]:offsets[string_index + 1] - 1], 'utf-8')
+
+    def _strings(self, first_string_index: int, end_string_index: int) -> List[str]:
+        # [first_string_index, end_string_index) の文字列をまとめてデコードする
+        if not self.separated:
+            return [self._string(i) for i in range(first_string_index, end_string_index)]
+        offsets = self._offsets
+        block = str(self._data[offsets[first_string_index]:offsets[end_string_index] - 1], 'utf-8')
+        return block.split('\0')
+
+    def __len__(self) -> int:
+        return self.length
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return [self[i] for i in range(*index.indices(self.length))]
+        if index < 0:
+            index += self.length
+        if not 0 <= index < self.length:
+            raise IndexError("SharedRuleList index out of range")
+        base = self.first_string + index * self.width
+        if self.width == 1:
+            return self._string(base)
+        return tuple(self._string(base + k) for k in range(self.width))
+
+    def __iter__(self):
+        width = self.width
+        base = self.first_string
+        for block_start in range(0, self.length, _ITER_BLOCK_SIZE):
+            block_end = min(block_start + _ITER_BLOCK_SIZE, self.length)
+            strings = self._strings(base + block_start * width, base + block_end * width)
+            if width == 1:
+                yield from strings
+            else:
+                yield from zip(*(strings[k::width] for k in range(width)))
+
+    def __reduce__(self):
+        # pickle するときは共有メモリの名前と位置だけを送る
+        return (SharedRuleList, (
+            self.segment_name, self.string_count, self.first_string, self.length, self.width, self.separated
+        ))
+
+    def _release(self) -> None:
+        self._offsets.release()
+        self._data.release()
+
+# ================================
+# 2) 共有メモリへの書き込み (親プロセス側)
+# ================================
+def _release_segment(segment: shared_memory.SharedMemory, views: List[SharedRuleList]) -> None:
+    # ビューを先に解放してから閉じる (ビューが残っていると close() が BufferError になる)
+    for view in views:
+        view._release()
+    segment.close()
+    segment.unlink()
+
+class SharedRuleLists:
+    """
+    複数のリストを1つの共有メモリに書き込み、それぞれの SharedRuleList (views) を用意する。
+    使い終わったら close() で共有メモリを解放する (with 文でもよい)。
+    close() せずに捨てられた場合も、GC されたとき (またはプロセスの終了時) に weakref.finalize で解放する
+    (main.py の st.cache_resource から追い出されたプールなど。/dev/shm に共有メモリを残さないように)。
+
+    with SharedRuleLists([replacements_final_list, placeholders]) as shared:
+        shared.views[0]  # replacements_final_list と同じ内容のビュー
+    """
+
+    def __init__(self, rule_lists: List[Sequence]):
+        encoded_strings: List[bytes] = []
+        layout: List[Tuple[int, int, int]] = []  # (最初の文字列の番号, 要素数, 1要素あたりの文字列数)
+        for rule_list in rule_lists:
+            first_string = len(encoded_strings)
+            width = 1
+            for item in rule_list:
+                if isinstance(item, str):
+                    encoded_strings.append(item.encode('utf-8'))
+                else:
+                    width = len(item)
+                    encoded_strings.extend(s.encode('utf-8') for s in item)
+            layout.append((first_string, len(rule_list), width))
+
+        # 各文字列の後ろに '\0' を付ける (開始位置は '\0' の分も含めて数える)
+        offsets = array.array('Q', [0])
+        position = 0
+        separated = True
+        for encoded in encoded_strings:
+            if b'\0' in encoded:
+                separated = False
+            position += len(encoded) + 1
+            offsets.append(position)
+        string_count = len(encoded_strings)
+        offsets_bytes = offsets.tobytes()
+
+        self._segment = shared_memory.SharedMemory(create=True, size=max(len(offsets_bytes) + position, 1))
+        buffer = self._segment.buf
+        buffer[:len(offsets_bytes)] = offsets_bytes
+        if encoded_strings:
+            buffer[len(offsets_bytes):len(offsets_bytes) + position] = b'\0'.join(encoded_strings) + b'\0'
+
+        self.segment_name = self._segment.name
+        self.size = self._segment.size
+        self.views: List[SharedRuleList] = [
+            SharedRuleList(self.segment_name, string_count, first_string, length, width, separated, buffer)
+            for first_string, length, width in layout
+        ]
+        self._finalizer = weakref.finalize(self, _release_segment, self._segment, self.views)
+
+    def close(self) -> None:
+        if self._segment is None:
+            return
+        self._finalizer()
+        self.views = []
+        self._segment = None
+
+    def __enter__(self) -> "SharedRuleLists":
+        return self
+
+    def __exit__(self, *exc_info) -> None:
+        self.close()
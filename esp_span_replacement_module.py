@@ -0,0 +1,503 @@
+## esp_span_replacement_module.py
+
+"""
+placeholder ファイルを使わない (old → placeholder → new の往復をしない) 置換パイプライン。
+
+従来の orchestrate_comprehensive_esperanto_text_replacement は
+  old → '$12345$' → new
+と全ての規則を2回ずつ全文置換し、最後に placeholder の数だけ text.replace() をしている。
+また '$20987$-$499999$' などの placeholder ファイルが必要で、入力文中に同じ形の文字列があると衝突する。
+
+ここでは文書を区間(span)のリスト (SpanDocument) として持ち、
+1) %...% / @...@ / 大域置換 / 2文字語根置換 で確定した部分を「保護/局所置換/置換済み」の区間に切り出し、
+2) 各段階はまだ置換されていない区間(raw)だけを処理し、
+3) 最後に1回だけ連結する (HTML の <br> / &nbsp; 変換も連結と同時に行う)。
+   出力の表記 (output_orthography) を指定した場合は、連結の前に区間ごとに表記をそろえる
+   (置換済みの区間は規則の new の中身なので、表記を変えたものをキャッシュから引く → esp_orthography_module.OutputOrthography)。
+%...% / @...@ の区間は入力の正規化と同じ走査で求めたもの (esp_input_normalization_module.normalize_input) を使い、
+@...@ の文字数制限は従来どおり %...% を6文字の placeholder として数える。
+@...@ の中の %...% や2文字語根の '$' 境界の判定では、確定した区間を内部用の token
+('$' + 識別子 + '$' など) で表す。識別子には UTF-16 のサロゲート文字 (U+D800-U+DBFF) を使うので、
+UTF-8 として正しいテキストと衝突することはない。token の形(前後の '$' や長さ)は従来の placeholder に
+合わせてあるので、局所置換や '$' 境界の判定も従来と同じ結果になる。
+"""
+
+import re
+from typing import List, Tuple, Dict, Optional, Callable, Iterable, Union
+
+from esp_text_replacement_module import (
+    get_long_line_splitter,
+    split_long_lines,
+    join_split_lines
+)
+from esp_input_normalization_module import normalize_input
+from esp_pattern_matcher_module import ReplacementAutomaton, TwoCharRootMatcher, get_replacement_automaton
+from esp_orthography_module import OutputOrthography, get_output_orthography
+from esp_conversion_cache_module import ConversionCache, convert_unique_lines, output_format_key
+from esp_parallel_chunking_module import ProgressCallback, map_chunks_in_order, map_batches_with_progress
+from esp_executor_module import DEFAULT_EXECUTOR_BACKEND, create_executor
+
+# ================================
+# 1) 内部 token の定義
+# ================================
+_TOKEN_DIGIT_BASE = 0xD800      # 識別子の1桁 (U+D800-U+DBFF, 1024種類)
+_TOKEN_DIGIT_COUNT = 1024
+_SECOND_PASS_WRAPPER = '\uDC00'  # 2文字語根置換2回目の '!' に相当する区切り
+_MARKUP_TOKEN_WIDTH = 4         # '%1854%' / '@5134@' と同じ6文字にするための桁数
+
+SURROGATE_PATTERN = re.compile(r'[\uD800-\uDFFF]')
+MARKUP_TOKEN_PATTERN = re.compile(r'%([\uD800-\uDBFF]{4})%')
+TWO_CHAR_TOKEN_PATTERN = re.compile(r'\$([\uD800-\uDBFF]+)\$')
+
+def encode_token_id(token_id: int, width: int = 1) -> str:
+    digits = []
+    while True:
+        token_id, digit = divmod(token_id, _TOKEN_DIGIT_COUNT)
+        digits.append(chr(_TOKEN_DIGIT_BASE + digit))
+        if token_id == 0 and len(digits) >= width:
+            break
+    return ''.join(reversed(digits))
+
+def decode_token_id(encoded: str) -> int:
+    token_id = 0
+    for ch in encoded:
+        token_id = token_id * _TOKEN_DIGIT_COUNT + (ord(ch) - _TOKEN_DIGIT_BASE)
+    return token_id
+
+def split_rule_margins(old: str, new: str, boundary_chars: str) -> Tuple[int, int]:
+    """
+    old の先頭/末尾にある境界文字(空白や '$')の数を返す。
+    new も同じ境界文字で始まり/終わっている必要がある
+    (置換用JSON生成ページで作った規則は全てこの形になっている)。
+    """
+    lead = len(old) - len(old.lstrip(boundary_chars))
+    trail = len(old) - len(old.rstrip(boundary_chars)) if lead < len(old) else 0
+    if not (new.startswith(old[:lead]) and new.endswith(old[len(old) - trail:])) or len(new) < lead + trail:
+        raise ValueError(f"placeholder を使わない置換に対応していない規則です: {old!r} → {new!r}")
+    return lead, trail
+
+# ================================
+# 2) 区間(span)のリストで表した文書
+# ================================
+SPAN_RAW = 0        # まだ置換されていない部分
+SPAN_PROTECTED = 1  # %...% (置換しない部分)
+SPAN_LOCALIZED = 2  # @...@ (局所置換の結果)
+SPAN_CONVERTED = 3  # 大域置換 / 2文字語根置換の結果
+
+# 2文字語根置換で、隣の区間を表す1文字 (従来の placeholder の端の文字に相当)
+_NEIGHBOUR_BOUNDARY_CHARS = {SPAN_PROTECTED: '%', SPAN_LOCALIZED: '%', SPAN_CONVERTED: '$'}
+
+_HTML_SPACE_RUN_PATTERN = re.compile(r' {2,}')
+
+def _replace_html_space_run(match: re.Match) -> str:
+    # apply_html_formatting と同じく、3つずつ → 残り2つ の順に &nbsp; にする (残り1つはそのまま)
+    run_length = len(match.group(0))
+    return '&nbsp;' * (run_length - run_length % 3) + ('&nbsp;&nbsp;' if run_length % 3 == 2 else ' ' * (run_length % 3))
+
+def _format_html_piece(piece: str) -> str:
+    if '\n' in piece:
+        piece = piece.replace('\n', '<br>\n')
+    if '  ' in piece:
+        piece = _HTML_SPACE_RUN_PATTERN.sub(_replace_html_space_run, piece)
+    return piece
+
+def join_with_html_formatting(pieces: Iterable[str]) -> str:
+    """
+    ''.join(pieces) に apply_html_formatting(…, 'HTML…') を掛けたのと同じ文字列を返す。
+    区間をまたぐ空白の並びは次の区間に持ち越してから変換する。
+    """
+    formatted = []
+    pending_spaces = ''
+    for piece in pieces:
+        if pending_spaces:
+            piece = pending_spaces + piece
+        stripped = piece.rstrip(' ')
+        pending_spaces = piece[len(stripped):]
+        if stripped:
+            formatted.append(_format_html_piece(stripped))
+    if pending_spaces:
+        formatted.append(_format_html_piece(pending_spaces))
+    return ''.join(formatted)
+
+
+class SpanDocument:
+    """
+    文書を (種類, 文字列) の区間の並びとして持つ。
+    raw 以外の区間の文字列は最終的な出力 (new の中身など) で、以後の段階では触らない。
+    raw の区間どうしは隣り合わない (間に必ず raw 以外の区間がある)。
+    """
+
+    def __init__(self, kinds: List[int], texts: List[str]):
+        self.kinds = kinds
+        self.texts = texts
+
+    def replace_raw_spans(self, split_raw_span: Callable[[str, Optional[int], Optional[int]], Optional[List[Tuple[int, str]]]]) -> None:
+        """
+        raw の区間ごとに split_raw_span(文字列, 前の区間の種類, 次の区間の種類) を呼び、
+        返された (種類, 文字列) の並びで置き換える (None なら変更なし)。
+        """
+        kinds = self.kinds
+        texts = self.texts
+        new_kinds: List[int] = []
+        new_texts: List[str] = []
+        last_index = len(kinds) - 1
+        for index, kind in enumerate(kinds):
+            if kind == SPAN_RAW:
+                pieces = split_raw_span(
+                    texts[index],
+                    kinds[index - 1] if index > 0 else None,
+                    kinds[index + 1] if index < last_index else None
+                )
+                if pieces is not None:
+                    for piece_kind, piece_text in pieces:
+                        if piece_text or piece_kind != SPAN_RAW:
+                            new_kinds.append(piece_kind)
+                            new_texts.append(piece_text)
+                    continue
+            new_kinds.append(kind)
+            new_texts.append(texts[index])
+        self.kinds = new_kinds
+        self.texts = new_texts
+
+    def join(self, format_type: str, output_orthography: Optional[OutputOrthography] = None) -> str:
+        """
+        全区間を連結した文字列を返す (apply_html_formatting の変換も同時に行う)。
+        output_orthography があれば、区間ごとに出力の表記をそろえてから連結する。
+        """
+        texts = self.texts
+        if output_orthography is not None:
+            texts = output_orthography.convert_pieces(texts, [kind == SPAN_CONVERTED for kind in self.kinds])
+        if "HTML" in format_type:
+            return join_with_html_formatting(texts)
+        return ''.join(texts)
+
+# ================================
+# 3) placeholder を使わない置換パイプライン
+# ================================
+class SpanReplacementPipeline:
+    """
+    3種類の置換リストから作る、placeholder ファイル不要の変換パイプライン。
+    (リスト中の placeholder 列は使わない)
+    """
+
+    def __init__(
+        self,
+        replacements_final_list: List[Tuple[str, str, str]],
+        replacements_list_for_localized_string: List[Tuple[str, str, str]],
+        replacements_list_for_2char: List[Tuple[str, str, str]],
+        global_replacement_automaton: Optional[ReplacementAutomaton] = None
+    ):
+        if global_replacement_automaton is None:
+            global_replacement_automaton = get_replacement_automaton(replacements_final_list)
+        self.global_replacement_automaton = global_replacement_automaton
+        self.localized_replacement_automaton = get_replacement_automaton(replacements_list_for_localized_string)
+
+        # 大域置換: 各規則の new から前後の空白を除いた中身を出力する
+        # (規則数が多いので中身のリストは作らず、使うときに new から切り出す。ここでは形だけを確かめる)
+        self.replacements_final_list = replacements_final_list
+        for old, new, placeholder in replacements_final_list:
+            split_rule_margins(old, new, ' ')
+
+        # 局所置換: 同様に new の中身
+        self.localized_replacement_cores = []
+        for old, new, placeholder in replacements_list_for_localized_string:
+            lead, trail = split_rule_margins(old, new, ' ')
+            self.localized_replacement_cores.append(new[lead:len(new) - trail])
+
+        # 2文字語根: 各規則の token は識別子 0 〜 (規則数-1) に固定しておく
+        # (境界の '$' / 空白は残し、中身だけを token にする)
+        self.two_char_outputs = []
+        two_char_placeholders = []
+        for rule_index, (old, new, placeholder) in enumerate(replacements_list_for_2char):
+            lead, trail = split_rule_margins(old, new, '$ ')
+            self.two_char_outputs.append(new[lead:len(new) - trail])
+            two_char_placeholders.append(old[:lead] + '$' + encode_token_id(rule_index) + '$' + old[len(old) - trail:])
+        self.two_char_matcher = TwoCharRootMatcher(
+            replacements_list_for_2char, two_char_placeholders, _SECOND_PASS_WRAPPER
+        )
+
+    # ----------------------------------------
+    # 各段階
+    # ----------------------------------------
+    def _new_markup_token(self, markup_spans: List[Tuple[int, str]], kind: int, output: str) -> str:
+        markup_spans.append((kind, output))
+        return '%' + encode_token_id(len(markup_spans) - 1, _MARKUP_TOKEN_WIDTH) + '%'
+
+    def _resolve_markup_tokens(self, text: str, markup_spans: List[Tuple[int, str]]) -> str:
+        def replacer(match: re.Match) -> str:
+            return markup_spans[decode_token_id(match.group(1))][1]
+        return MARKUP_TOKEN_PATTERN.sub(replacer, text)
+
+    def _apply_localized_replacements(self, text: str) -> str:
+        # safe_replace(text, replacements_list_for_localized_string) と同じ結果
+        automaton = self.localized_replacement_automaton
+        pieces = []
+        cursor = 0
+        for start, rule_index in automaton.resolve_matches(text):
+            lead, trail = automaton.rule_margins[rule_index]
+            pieces.append(text[cursor:start + lead])
+            pieces.append(self.localized_replacement_cores[rule_index])
+            cursor = start + automaton.rule_lengths[rule_index] - trail
+        pieces.append(text[cursor:])
+        return ''.join(pieces)
+
+    def _localize_markup(self, text: str, at_start: int, at_end: int, inner_percent_spans: List[Tuple[int, int]]) -> str:
+        # @...@ の中身だけを局所置換する。中の %...% は '%1854%' と同じ6文字の token にして置換し、後で中身に戻す
+        markup_spans: List[Tuple[int, str]] = []
+        pieces = []
+        cursor = at_start + 1
+        for start, end in inner_percent_spans:
+            pieces.append(text[cursor:start])
+            pieces.append(self._new_markup_token(markup_spans, SPAN_PROTECTED, text[start:end].replace('%', '')))
+            cursor = end
+        pieces.append(text[cursor:at_end - 1])
+        replaced = self._apply_localized_replacements(''.join(pieces)).replace('@', '')
+        if markup_spans:
+            replaced = self._resolve_markup_tokens(replaced, markup_spans)
+        return replaced
+
+    def _protect_markup(
+        self,
+        text: str,
+        percent_spans: List[Tuple[int, int]],
+        at_spans: List[Tuple[int, int]]
+    ) -> SpanDocument:
+        # %...% / @...@ は normalize_input が求めた区間をそのまま切り出す (文字列を探し直さない)
+        kinds: List[int] = []
+        texts: List[str] = []
+        cursor = 0
+
+        def append_span(start: int, end: int, kind: int, output: str) -> None:
+            nonlocal cursor
+            if start > cursor:
+                kinds.append(SPAN_RAW)
+                texts.append(text[cursor:start])
+            kinds.append(kind)
+            texts.append(output)
+            cursor = end
+
+        percent_index = 0
+        num_percent_spans = len(percent_spans)
+        for at_start, at_end in at_spans:
+            # 3) この @...@ より前の %...% → そのまま残す部分 ('%' を除いた中身)
+            while percent_index < num_percent_spans and percent_spans[percent_index][0] < at_start:
+                start, end = percent_spans[percent_index]
+                append_span(start, end, SPAN_PROTECTED, text[start:end].replace('%', ''))
+                percent_index += 1
+            # 4) @...@ → 中身だけ局所置換 (中に %...% があればその中身も含む)
+            inner_index = percent_index
+            while percent_index < num_percent_spans and percent_spans[percent_index][0] < at_end:
+                percent_index += 1
+            append_span(at_start, at_end, SPAN_LOCALIZED, self._localize_markup(
+                text, at_start, at_end, percent_spans[inner_index:percent_index]
+            ))
+        for start, end in percent_spans[percent_index:]:
+            append_span(start, end, SPAN_PROTECTED, text[start:end].replace('%', ''))
+        if cursor < len(text):
+            kinds.append(SPAN_RAW)
+            texts.append(text[cursor:])
+        return SpanDocument(kinds, texts)
+
+    def _split_global_replacements(self, text: str, previous_kind: Optional[int], next_kind: Optional[int]) -> Optional[List[Tuple[int, str]]]:
+        # 5) 大域置換 (規則は '$' / '%' を含まないので、raw の区間をまたいで一致することはない)
+        automaton = self.global_replacement_automaton
+        pieces = []
+        cursor = 0
+        for start, rule_index in automaton.resolve_matches(text):
+            lead, trail = automaton.rule_margins[rule_index]
+            pieces.append((SPAN_RAW, text[cursor:start + lead]))
+            new = self.replacements_final_list[rule_index][1]
+            pieces.append((SPAN_CONVERTED, new[lead:len(new) - trail]))
+            cursor = start + automaton.rule_lengths[rule_index] - trail
+        if not pieces:
+            return None
+        pieces.append((SPAN_RAW, text[cursor:]))
+        return pieces
+
+    def _split_2char_replacements(self, text: str, previous_kind: Optional[int], next_kind: Optional[int]) -> Optional[List[Tuple[int, str]]]:
+        # 6) 2文字語根置換 (従来の2回のループと同じ結果: TwoCharRootMatcher)
+        # 隣の区間は、置換済みなら '$' (placeholder の端)、%...% / @...@ なら '%' の1文字として見せる
+        left = _NEIGHBOUR_BOUNDARY_CHARS.get(previous_kind, '')
+        right = _NEIGHBOUR_BOUNDARY_CHARS.get(next_kind, '')
+        replaced, first_pass_rules, second_pass_rules = self.two_char_matcher.replace(left + text + right)
+        if not (first_pass_rules or second_pass_rules):
+            return None
+        # '!' に相当する区切りは復元時に消える
+        replaced = replaced.replace(_SECOND_PASS_WRAPPER, '')
+        replaced = replaced[len(left):len(replaced) - len(right)]
+
+        pieces = []
+        cursor = 0
+        for match in TWO_CHAR_TOKEN_PATTERN.finditer(replaced):
+            pieces.append((SPAN_RAW, replaced[cursor:match.start()]))
+            pieces.append((SPAN_CONVERTED, self.two_char_outputs[decode_token_id(match.group(1))]))
+            cursor = match.end()
+        pieces.append((SPAN_RAW, replaced[cursor:]))
+        return pieces
+
+    # ----------------------------------------
+    # 変換
+    # ----------------------------------------
+    def convert(
+        self,
+        text: str,
+        format_type: str,
+        output_orthography: Union[str, OutputOrthography, None] = None,
+        normalization_counters: Optional[Dict[str, int]] = None
+    ) -> str:
+        # 1, 2) 空白の正規化 + エスペラント字上符への変換 (%...% / @...@ の区間も同じ走査で求める)
+        text, percent_spans, at_spans = normalize_input(text, normalization_counters)
+        if SURROGATE_PATTERN.search(text):
+            raise ValueError("サロゲート文字を含むテキストは placeholder を使わない置換では扱えません")
+
+        # 3, 4) %...% / @...@
+        document = self._protect_markup(text, percent_spans, at_spans)
+        # 5) 大域置換
+        document.replace_raw_spans(self._split_global_replacements)
+        # 6) 2文字語根置換
+        document.replace_raw_spans(self._split_2char_replacements)
+        # 7, 8) 全区間を1回で連結 (HTML形式の追加整形と、出力の表記をそろえるのも同時に行う)
+        return document.join(format_type, get_output_orthography(output_orthography))
+
+# ================================
+# 4) multiprocessing 関連
+# ================================
+def process_lines_with_span_pipeline(
+    lines: List[str],
+    replacements_final_list: List[Tuple[str, str, str]],
+    replacements_list_for_localized_string: List[Tuple[str, str, str]],
+    replacements_list_for_2char: List[Tuple[str, str, str]],
+    format_type: str,
+    output_orthography: Optional[str] = None
+) -> List[str]:
+    """
+    multiprocessing用の下請け関数 (process_lines の placeholder 不要版)。
+    """
+    pipeline = SpanReplacementPipeline(
+        replacements_final_list,
+        replacements_list_for_localized_string,
+        replacements_list_for_2char
+    )
+    return [pipeline.convert(line, format_type, output_orthography) for line in lines]
+
+
+# 各ワーカーで initializer から1回だけ作るパイプライン (ワーカーの状態は (パイプライン, format_type, 出力の表記))
+def _initialize_span_pipeline_worker(
+    replacements_final_list: List[Tuple[str, str, str]],
+    replacements_list_for_localized_string: List[Tuple[str, str, str]],
+    replacements_list_for_2char: List[Tuple[str, str, str]],
+    format_type: str,
+    output_orthography: Optional[str] = None
+) -> Tuple[SpanReplacementPipeline, str, Optional[str]]:
+    pipeline = SpanReplacementPipeline(
+        replacements_final_list,
+        replacements_list_for_localized_string,
+        replacements_list_for_2char
+    )
+    return pipeline, format_type, output_orthography
+
+def _span_pipeline_lines_in_worker(worker_state: Tuple[SpanReplacementPipeline, str, Optional[str]], lines: List[str]) -> List[str]:
+    pipeline, format_type, output_orthography = worker_state
+    return [pipeline.convert(line, format_type, output_orthography) for line in lines]
+
+
+def parallel_process_with_span_pipeline(
+    text: str,
+    num_processes: int,
+    replacements_final_list: List[Tuple[str, str, str]],
+    replacements_list_for_localized_string: List[Tuple[str, str, str]],
+    replacements_list_for_2char: List[Tuple[str, str, str]],
+    format_type: str,
+    cache: Optional[ConversionCache] = None,
+    ruleset_fingerprint: str = "",
+    chunk_timings: Optional[List[Dict]] = None,
+    executor_backend: str = DEFAULT_EXECUTOR_BACKEND,
+    progress_callback: Optional[ProgressCallback] = None,
+    output_orthography: Optional[str] = None
+) -> str:
+    """
+    parallel_process と同じ分割方法 (文字数の予算ごとのチャンク) で、span パイプラインを並列実行する。
+    (同じ行は1回だけ変換し、cache にない行だけを各プロセスに送る)
+    executor_backend で並列処理の実行方式 ("process" / "thread" / "inline") を選ぶ。
+    progress_callback は parallel_process と同じく、チャンクごとに (済んだ文字数, 全体の文字数) で呼ばれる。
+    output_orthography を指定すると、出力の表記も各行の変換の中でそろえる (SpanReplacementPipeline.convert を参照)。
+    """
+    return ''.join(parallel_process_lines_with_span_pipeline(
+        re.findall(r'.*?\n|.+$', text),
+        num_processes,
+        replacements_final_list,
+        replacements_list_for_localized_string,
+        replacements_list_for_2char,
+        format_type,
+        cache,
+        ruleset_fingerprint,
+        chunk_timings,
+        executor_backend,
+        progress_callback,
+        output_orthography
+    ))
+
+
+def parallel_process_lines_with_span_pipeline(
+    lines: List[str],
+    num_processes: int,
+    replacements_final_list: List[Tuple[str, str, str]],
+    replacements_list_for_localized_string: List[Tuple[str, str, str]],
+    replacements_list_for_2char: List[Tuple[str, str, str]],
+    format_type: str,
+    cache: Optional[ConversionCache] = None,
+    ruleset_fingerprint: str = "",
+    chunk_timings: Optional[List[Dict]] = None,
+    executor_backend: str = DEFAULT_EXECUTOR_BACKEND,
+    progress_callback: Optional[ProgressCallback] = None,
+    output_orthography: Optional[str] = None
+) -> List[str]:
+    """
+    parallel_process_with_span_pipeline の行単位版 (各行の変換結果のリストを返す)。
+    """
+    rule_arguments = (
+        replacements_final_list,
+        replacements_list_for_localized_string,
+        replacements_list_for_2char,
+        format_type,
+        output_orthography
+    )
+
+    def convert_missing_lines(missing_lines: List[str]) -> List[str]:
+        num_missing = len(missing_lines)
+        if num_processes <= 1 or num_missing <= 1:
+            if progress_callback is None:
+                return process_lines_with_span_pipeline(missing_lines, *rule_arguments)
+            # 進捗を返す場合も、パイプラインは1回だけ作る
+            pipeline = SpanReplacementPipeline(
+                replacements_final_list,
+                replacements_list_for_localized_string,
+                replacements_list_for_2char
+            )
+            return map_batches_with_progress(
+                lambda batch: [pipeline.convert(line, format_type, output_orthography) for line in batch],
+                missing_lines, progress_callback
+            )
+
+        # パイプラインは各ワーカーで1回だけ作り (スレッド / インラインでは全体で1回)、各チャンクでは行だけを送る
+        with create_executor(
+            executor_backend,
+            num_processes,
+            initializer=_initialize_span_pipeline_worker,
+            initargs=rule_arguments
+        ) as executor:
+            results, timings = map_chunks_in_order(
+                executor, _span_pipeline_lines_in_worker, missing_lines, num_processes, progress_callback=progress_callback
+            )
+        if chunk_timings is not None:
+            chunk_timings.extend(timings)
+        return results
+
+    cache_format_key = output_format_key(format_type, output_orthography)
+    if num_processes <= 1:
+        return convert_unique_lines(lines, convert_missing_lines, cache, ruleset_fingerprint, cache_format_key)
+    # 長い行は parallel_process_lines と同じく安全な位置で分割してから変換する
+    splitter = get_long_line_splitter(replacements_final_list, replacements_list_for_2char)
+    pieces, piece_counts = split_long_lines(lines, num_processes, splitter)
+    results = convert_unique_lines(pieces, convert_missing_lines, cache, ruleset_fingerprint, cache_format_key)
+    return join_split_lines(results, piece_counts)
@@ -4,69 +4,71 @@
 """
 このモジュールは「エスペラント文章の文字列(漢字)置換」を包括的に扱うツール集です。
 主な機能：
-1. エスペラント独自の文字形式（ĉ, ĝなど）への変換 → convert_to_circumflex
+1. エスペラント独自の文字形式（ĉ, ĝなど）への変換 → convert_to_circumflex (esp_orthography_module)
 2. 特殊な半角スペースの統一（ASCIIスペースに） → unify_halfwidth_spaces
+   (1, 2 と %...% / @...@ の区間の検出は、置換の前に normalize_input で1回の走査にまとめて行う → esp_input_normalization_module)
 3. (現在不要になった) HTMLルビ付与関数 → wrap_text_with_ruby (コメントのみ)
 4. %や@で囲まれたテキストのスキップ・局所変換 → (create_replacements_list_for_...)
 5. 大域的なプレースホルダー置換 → safe_replace
 6. それらをまとめて実行する複合置換関数 → orchestrate_comprehensive_esperanto_text_replacement
-7. multiprocessing を用いた行単位の並列実行 → parallel_process / process_segment
+   (output_orthography を指定すると、出力の表記 (^ 表記 / x 表記など) も placeholder の復元と同時にそろえる
+    → esp_orthography_module.OutputOrthography)
+7. multiprocessing を用いた行単位の並列実行 → parallel_process / parallel_process_lines / process_lines
+   (同じ行は1回だけ変換。ConversionCache を渡すと変換済みの行は再利用する。
+    行は文字数の予算ごとの小さなチャンクに分けて、空いたプロセスに順に割り振る → esp_parallel_chunking_module。
+    改行のない長い行は、変換結果が変わらない半角スペースの位置で分割してから並列に変換する → LongLineSplitter。
+    プロセス / スレッド / インラインのどれで実行するかは executor_backend で選ぶ → esp_executor_module。
+    progress_callback でチャンクごとの進捗を受け取り、callback から例外を送出すると残りのタスクを捨てて止まる)
+
+大域置換(5)には2種類の実装(backend)がある:
+- "automaton"  : esp_pattern_matcher_module の trie automaton で1回だけ走査する (既定)
+- "sequential" : 従来通り規則を1件ずつ `old in text` → `text.replace()` する
+                 (n-gram 索引で、入力に現れうる規則だけに絞ってから)
 """
 
 import re
 import json
-from typing import List, Tuple, Dict
-import multiprocessing
+from bisect import bisect_left
+from typing import List, Tuple, Dict, Set, Optional, Union
+
+from esp_pattern_matcher_module import (
+    RuleFilter,
+    get_replacement_automaton,
+    get_ngram_rule_index,
+    get_two_char_root_matcher
+)
+from esp_conversion_cache_module import ConversionCache, convert_unique_lines, output_format_key
+from esp_parallel_chunking_module import AdaptiveChunkSizer, ProgressCallback, map_chunks_in_order, map_batches_with_progress
+from esp_executor_module import DEFAULT_EXECUTOR_BACKEND, create_executor
+from esp_input_normalization_module import (
+    PERCENT_MAX_CONTENT_CHARS,
+    AT_MAX_CONTENT_CHARS,
+    normalize_input,
+    find_enclosed_spans,
+    scan_markup_spans
+)
+from esp_orthography_module import (
+    x_to_circumflex,
+    circumflex_to_x,
+    x_to_hat,
+    hat_to_x,
+    hat_to_circumflex,
+    circumflex_to_hat,
+    replace_esperanto_chars,
+    convert_to_circumflex,
+    OutputOrthography,
+    get_output_orthography
+)
 
 # ================================
 # 1) エスペラント文字変換用の辞書
 # ================================
-# それぞれ (x表記 → ĉ) や (ĉ → c^)など、様々なマッピングを辞書にしている
-x_to_circumflex = {
-    'cx': 'ĉ', 'gx': 'ĝ', 'hx': 'ĥ', 'jx': 'ĵ', 'sx': 'ŝ', 'ux': 'ŭ',
-    'Cx': 'Ĉ', 'Gx': 'Ĝ', 'Hx': 'Ĥ', 'Jx': 'Ĵ', 'Sx': 'Ŝ', 'Ux': 'Ŭ'
-}
-circumflex_to_x = {
-    'ĉ': 'cx', 'ĝ': 'gx', 'ĥ': 'hx', 'ĵ': 'jx', 'ŝ': 'sx', 'ŭ': 'ux',
-    'Ĉ': 'Cx', 'Ĝ': 'Gx', 'Ĥ': 'Hx', 'Ĵ': 'Jx', 'Ŝ': 'Sx', 'Ŭ': 'Ux'
-}
-x_to_hat = {
-    'cx': 'c^', 'gx': 'g^', 'hx': 'h^', 'jx': 'j^', 'sx': 's^', 'ux': 'u^',
-    'Cx': 'C^', 'Gx': 'G^', 'Hx': 'H^', 'Jx': 'J^', 'Sx': 'S^', 'Ux': 'U^'
-}
-hat_to_x = {
-    'c^': 'cx', 'g^': 'gx', 'h^': 'hx', 'j^': 'jx', 's^': 'sx', 'u^': 'ux',
-    'C^': 'Cx', 'G^': 'Gx', 'H^': 'Hx', 'J^': 'Jx', 'S^': 'Sx', 'U^': 'Ux'
-}
-hat_to_circumflex = {
-    'c^': 'ĉ', 'g^': 'ĝ', 'h^': 'ĥ', 'j^': 'ĵ', 's^': 'ŝ', 'u^': 'ŭ',
-    'C^': 'Ĉ', 'G^': 'Ĝ', 'H^': 'Ĥ', 'J^': 'Ĵ', 'S^': 'Ŝ', 'U^': 'Ŭ'
-}
-circumflex_to_hat = {
-    'ĉ': 'c^', 'ĝ': 'g^', 'ĥ': 'h^', 'ĵ': 'j^', 'ŝ': 's^', 'ŭ': 'u^',
-    'Ĉ': 'C^', 'Ĝ': 'G^', 'Ĥ': 'H^', 'Ĵ': 'J^', 'Ŝ': 'S^', 'Ŭ': 'U^'
-}
+# 対応表 (x表記 → ĉ, ĉ → c^ など) と、それらを1回の走査で変換する関数は esp_orthography_module にまとめた
+# (このモジュールからも従来どおり import できる)
 
 # ================================
 # 2) 基本の文字形式変換関数
 # ================================
-def replace_esperanto_chars(text, char_dict: Dict[str, str]) -> str:
-    # char_dict に含まれるペア (original_char, converted_char) ごとに
-    # text.replace() していく
-    for original_char, converted_char in char_dict.items():
-        text = text.replace(original_char, converted_char)
-    return text
-
-def convert_to_circumflex(text: str) -> str:
-    """
-    テキストを字上符形式（ĉ, ĝ, ĥ, ĵ, ŝ, ŭなど）に統一します。
-    1. hat_to_circumflex: c^ → ĉ
-    2. x_to_circumflex: cx → ĉ
-    """
-    text = replace_esperanto_chars(text, hat_to_circumflex)
-    text = replace_esperanto_chars(text, x_to_circumflex)
-    return text
-
 def unify_halfwidth_spaces(text: str) -> str:
     """
     全角スペース(U+3000)は変更せず、半角スペースと視覚的に区別がつきにくい空白文字を
@@ -83,12 +85,20 @@ def unify_halfwidth_spaces(text: str) -> str:
 # ================================
 # 4) 占位符(placeholder)関連
 # ================================
-def safe_replace(text: str, replacements: List[Tuple[str, str, str]]) -> str:
+def safe_replace(
+    text: str,
+    replacements: List[Tuple[str, str, str]],
+    rule_filter: Optional[RuleFilter] = None
+) -> str:
     """
     (old, new, placeholder) のリストを受け取り、
     text中の old → placeholder → new の段階置換を行う。
+    rule_filter (replacements から作った NgramRuleIndex / KgramBitsetRuleFilter) を渡すと、
+    候補の規則だけを調べる (結果は同じ)。
     """
     valid_replacements = {}
+    if rule_filter is not None:
+        replacements = [replacements[i] for i in rule_filter.candidate_rule_indices(text)]
 
     # まず old→placeholder
     for old, new, placeholder in replacements:
@@ -111,24 +121,24 @@ def import_placeholders(filename: str) -> List[str]:
     return placeholders
 
 # '%' で囲まれた箇所をスキップするための正規表現
+# (区間は esp_input_normalization_module.find_enclosed_spans で、'%' の位置だけから同じ規則で求める)
 PERCENT_PATTERN = re.compile(r'%(.{1,50}?)%')
 def find_percent_enclosed_strings_for_skipping_replacement(text: str) -> List[str]:
-    """'%foo%' の形を全て抽出。50文字以内に限定。"""
-    matches = []
-    used_indices = set()
-    for match in PERCENT_PATTERN.finditer(text):
-        start, end = match.span()
-        if start not in used_indices and end-2 not in used_indices:
-            matches.append(match.group(1))
-            used_indices.update(range(start, end))
-    return matches
-
-def create_replacements_list_for_intact_parts(text: str, placeholders: List[str]) -> List[Tuple[str, str]]:
+    """'%foo%' の形を全て抽出。50文字以内に限定。重なる区間は左のものを優先する。"""
+    return [text[start + 1:end - 1] for start, end in find_enclosed_spans(text, '%', PERCENT_MAX_CONTENT_CHARS)]
+
+def create_replacements_list_for_intact_parts(
+    text: str,
+    placeholders: List[str],
+    matches: Optional[List[str]] = None
+) -> List[Tuple[str, str]]:
     """
     '%xxx%' で囲まれた箇所を検出し、
     ( '%xxx%', placeholder ) という形で対応させるリストを作る
+    (matches に検出済みの 'xxx' のリストを渡すと、text は探し直さない)
     """
-    matches = find_percent_enclosed_strings_for_skipping_replacement(text)
+    if matches is None:
+        matches = find_percent_enclosed_strings_for_skipping_replacement(text)
     replacements_list_for_intact_parts = []
     for i, match in enumerate(matches):
         if i < len(placeholders):
@@ -137,32 +147,34 @@ def create_replacements_list_for_intact_parts(text: str, placeholders: List[str]
             break
     return replacements_list_for_intact_parts
 
-# '@' で囲まれた箇所を局所置換するための正規表現
+# '@' で囲まれた箇所を局所置換するための正規表現 (区間の求め方は '%' と同じ)
 AT_PATTERN = re.compile(r'@(.{1,18}?)@')
 def find_at_enclosed_strings_for_localized_replacement(text: str) -> List[str]:
-    """'@foo@' の形を全て抽出。18文字以内に限定。"""
-    matches = []
-    used_indices = set()
-    for match in AT_PATTERN.finditer(text):
-        start, end = match.span()
-        if start not in used_indices and end-2 not in used_indices:
-            matches.append(match.group(1))
-            used_indices.update(range(start, end))
-    return matches
+    """'@foo@' の形を全て抽出。18文字以内に限定。重なる区間は左のものを優先する。"""
+    return [text[start + 1:end - 1] for start, end in find_enclosed_spans(text, '@', AT_MAX_CONTENT_CHARS)]
 
 def create_replacements_list_for_localized_replacement(text, placeholders: List[str],
-                                                       replacements_list_for_localized_string: List[Tuple[str, str, str]]
+                                                       replacements_list_for_localized_string: List[Tuple[str, str, str]],
+                                                       rule_filter: Optional[RuleFilter] = None,
+                                                       matches: Optional[List[str]] = None
                                                        ) -> List[List[str]]:
     """
     '@xxx@' で囲まれた箇所を検出し、
     その内部文字列 'xxx' を replacements_list_for_localized_string で置換した結果を
     placeholder に置き換える。
+    rule_filter を省略した場合は n-gram 索引 (NgramRuleIndex) で候補の規則を絞る。
+    (matches に検出済みの 'xxx' のリストを渡すと、text は探し直さない)
     """
-    matches = find_at_enclosed_strings_for_localized_replacement(text)
+    if matches is None:
+        matches = find_at_enclosed_strings_for_localized_replacement(text)
+    if not matches:
+        return []
+    if rule_filter is None:
+        rule_filter = get_ngram_rule_index(replacements_list_for_localized_string)
     tmp_list = []
     for i, match in enumerate(matches):
         if i < len(placeholders):
-            replaced_match = safe_replace(match, replacements_list_for_localized_string)
+            replaced_match = safe_replace(match, replacements_list_for_localized_string, rule_filter)
             tmp_list.append([f"@{match}@", placeholders[i], replaced_match])
         else:
             break
@@ -171,53 +183,134 @@ def create_replacements_list_for_localized_replacement(text, placeholders: List[
 # ================================
 # 5) メインの複合文字列(漢字)置換関数
 # ================================
-def orchestrate_comprehensive_esperanto_text_replacement(
-    text, 
-    placeholders_for_skipping_replacements: List[str],
-    replacements_list_for_localized_string: List[Tuple[str, str, str]],
-    placeholders_for_localized_replacement: List[str],
+GLOBAL_REPLACEMENT_BACKENDS = ("automaton", "sequential")
+DEFAULT_GLOBAL_REPLACEMENT_BACKEND = "automaton"
+
+def apply_global_replacements(
+    text: str,
     replacements_final_list: List[Tuple[str, str, str]],
-    replacements_list_for_2char: List[Tuple[str, str, str]],
-    format_type: str
-) -> str:
+    backend: str = DEFAULT_GLOBAL_REPLACEMENT_BACKEND,
+    rule_filter: Optional[RuleFilter] = None
+) -> Tuple[str, Dict[str, str]]:
     """
-    複数の変換ルールに従ってエスペラント文を文字列(漢字)置換するメイン関数。
-
-    1) 空白の正規化 → 2) エスペラント文字(ĉ等)の字上符形式統一
-    3) %で囲まれた部分をスキップ
-    4) @で囲まれた部分を局所置換
-    5) 大域置換
-    6) 2文字語根の置換を2回
-    7) プレースホルダ復元
-    8) HTML形式が指定なら追加整形
+    大域置換 (old → placeholder) を行い、(置換後のtext, {placeholder: new}) を返す。
+    backend が "automaton" でも "sequential" でも結果は同じになる。
+    "sequential" では rule_filter (省略時は n-gram 索引) で候補の規則を絞ってから調べる。
     """
-    # 1, 2) 空白の正規化 + エスペラント字上符への変換
-    text = unify_halfwidth_spaces(text)
-    text = convert_to_circumflex(text)
-
-    # 3) %...% スキップ部の一時置換
-    replacements_list_for_intact_parts = create_replacements_list_for_intact_parts(text, placeholders_for_skipping_replacements)
-    # 文字数長い順にsort (衝突を避けるため)
-    sorted_replacements_list_for_intact_parts = sorted(replacements_list_for_intact_parts, key=lambda x: len(x[0]), reverse=True)
-    for original, place_holder_ in sorted_replacements_list_for_intact_parts:
-        text = text.replace(original, place_holder_)
-
-    # 4) @...@ 局所置換
-    tmp_replacements_list_for_localized_string_2 = create_replacements_list_for_localized_replacement(
-        text, placeholders_for_localized_replacement, replacements_list_for_localized_string
-    )
-    sorted_replacements_list_for_localized_string = sorted(tmp_replacements_list_for_localized_string_2, key=lambda x: len(x[0]), reverse=True)
-    for original, place_holder_, replaced_original in sorted_replacements_list_for_localized_string:
-        text = text.replace(original, place_holder_)
-
-    # 5) 大域置換 (old, new, placeholder)
+    if backend == "automaton":
+        return get_replacement_automaton(replacements_final_list).replace_with_placeholders(text)
+    if backend != "sequential":
+        raise ValueError(f"未知の backend です: {backend}")
+
+    # 入力に先頭 n-gram が現れる規則だけを、元の順番で調べる
+    if rule_filter is None:
+        rule_filter = get_ngram_rule_index(replacements_final_list)
     valid_replacements = {}
-    for old, new, placeholder in replacements_final_list:
+    for rule_index in rule_filter.candidate_rule_indices(text):
+        old, new, placeholder = replacements_final_list[rule_index]
         if old in text:
             text = text.replace(old, placeholder)
             valid_replacements[placeholder] = new
+    return text, valid_replacements
+
+def protect_intact_and_localized_parts(
+    text: str,
+    placeholders_for_skipping_replacements: List[str],
+    replacements_list_for_localized_string: List[Tuple[str, str, str]],
+    placeholders_for_localized_replacement: List[str],
+    rule_filter: Optional[RuleFilter] = None,
+    markup_spans: Optional[Tuple[List[Tuple[int, int]], List[Tuple[int, int]]]] = None
+) -> Tuple[str, List[List[str]], List[List[str]]]:
+    """
+    3) %...% (スキップ部) と 4) @...@ (局所置換部) を placeholder に一時置換する。
+    markup_spans に normalize_input が求めた (%...% の区間, @...@ の区間) を渡すと、text から探し直さない
+    (省略した場合は scan_markup_spans で、'%' / '@' の位置を1回だけ探して求める)。
+    戻り値: (置換後のtext, %用の復元リスト, @用の復元リスト)
+
+    従来は一致した '%xxx%' / '@xxx@' ごとに (長い順に) text.replace() していたので、記号の多い行では
+    行の長さ × 記号の数 に比例する時間がかかった。ここでは全ての区間を左から順に1回の join で置き換える。
+    i 番目の区間には i 番目の placeholder を使い (placeholder が足りなければその区間は置き換えない)、
+    同じ文字列の区間には最初の区間と同じ placeholder を使う (text.replace() で全ての出現を置き換えたのと同じ)。
+    @...@ の中の %...% は先に placeholder にしてから局所置換する (従来と同じ)。
+    """
+    if markup_spans is None:
+        markup_spans = scan_markup_spans(text)
+    percent_spans, at_spans = markup_spans
+    intact_parts: Dict[str, str] = {}
+    localized_parts: Dict[str, List[str]] = {}
+    replacements_list_for_intact_parts: List[List[str]] = []
+    replacements_list_for_localized_string_2: List[List[str]] = []
+    if at_spans and rule_filter is None:
+        rule_filter = get_ngram_rule_index(replacements_list_for_localized_string)
+
+    def protect_intact_part(span_index: int) -> str:
+        start, end = percent_spans[span_index]
+        original = text[start:end]
+        place_holder_ = intact_parts.get(original)
+        if place_holder_ is None:
+            if span_index >= len(placeholders_for_skipping_replacements):
+                return original
+            place_holder_ = intact_parts[original] = placeholders_for_skipping_replacements[span_index]
+            replacements_list_for_intact_parts.append([original, place_holder_])
+        return place_holder_
+
+    def localize_part(span_index: int, match: str) -> str:
+        original = f"@{match}@"
+        entry = localized_parts.get(original)
+        if entry is None:
+            if span_index >= len(placeholders_for_localized_replacement):
+                return original
+            replaced_match = safe_replace(match, replacements_list_for_localized_string, rule_filter)
+            entry = localized_parts[original] = [original, placeholders_for_localized_replacement[span_index], replaced_match]
+            replacements_list_for_localized_string_2.append(entry)
+        return entry[1]
+
+    pieces = []
+    cursor = 0
+    percent_index = 0
+    num_percent_spans = len(percent_spans)
+    for at_index, (at_start, at_end) in enumerate(at_spans):
+        # 3) この @...@ より前の %...%
+        while percent_index < num_percent_spans and percent_spans[percent_index][0] < at_start:
+            pieces.append(text[cursor:percent_spans[percent_index][0]])
+            pieces.append(protect_intact_part(percent_index))
+            cursor = percent_spans[percent_index][1]
+            percent_index += 1
+        # 4) @...@ (中の %...% は placeholder にした後の文字列を局所置換する)
+        inner_pieces = []
+        inner_cursor = at_start + 1
+        while percent_index < num_percent_spans and percent_spans[percent_index][0] < at_end:
+            inner_pieces.append(text[inner_cursor:percent_spans[percent_index][0]])
+            inner_pieces.append(protect_intact_part(percent_index))
+            inner_cursor = percent_spans[percent_index][1]
+            percent_index += 1
+        inner_pieces.append(text[inner_cursor:at_end - 1])
+        pieces.append(text[cursor:at_start])
+        pieces.append(localize_part(at_index, ''.join(inner_pieces)))
+        cursor = at_end
+    for span_index in range(percent_index, num_percent_spans):
+        pieces.append(text[cursor:percent_spans[span_index][0]])
+        pieces.append(protect_intact_part(span_index))
+        cursor = percent_spans[span_index][1]
+    if pieces:
+        pieces.append(text[cursor:])
+        text = ''.join(pieces)
+
+    return text, replacements_list_for_intact_parts, replacements_list_for_localized_string_2
+
+def apply_2char_replacements_sequential(
+    text: str,
+    replacements_list_for_2char: List[Tuple[str, str, str]],
+    rule_filter: Optional[RuleFilter] = None
+) -> Tuple[str, Dict[str, str], Dict[str, str]]:
+    """
+    6) 2文字語根の置換を2回行う (従来の方式: 規則ごとに全文を走査)。
+    rule_filter を渡すと、入力に現れうる規則だけを調べる (結果は同じ)。
+    戻り値: (置換後のtext, 1回目の {placeholder: new}, 2回目の {'!placeholder!': new})
+    """
+    if rule_filter is not None:
+        replacements_list_for_2char = [replacements_list_for_2char[i] for i in rule_filter.candidate_rule_indices(text)]
 
-    # 6) 2文字語根置換(2回)
     valid_replacements_for_2char_roots = {}
     for old, new, placeholder in replacements_list_for_2char:
         if old in text:
@@ -231,7 +324,107 @@ def orchestrate_comprehensive_esperanto_text_replacement(
             text = text.replace(old, place_holder_second)
             valid_replacements_for_2char_roots_2[place_holder_second] = new
 
-    # 7) placeholderを最終的な文字列に戻す
+    return text, valid_replacements_for_2char_roots, valid_replacements_for_2char_roots_2
+
+def apply_2char_replacements(
+    text: str,
+    replacements_list_for_2char: List[Tuple[str, str, str]]
+) -> Tuple[str, Dict[str, str], Dict[str, str]]:
+    """
+    6) 2文字語根の置換を2回行う。
+    '$' / 空白の境界に接する区間だけを TwoCharRootMatcher で1回走査する
+    (結果は apply_2char_replacements_sequential と同じ)。
+    戻り値: (置換後のtext, 1回目の {placeholder: new}, 2回目の {'!placeholder!': new})
+    """
+    matcher = get_two_char_root_matcher(replacements_list_for_2char)
+    text, first_pass_rules, second_pass_rules = matcher.replace(text)
+
+    valid_replacements_for_2char_roots = {}
+    for rule_index in first_pass_rules:
+        old, new, placeholder = replacements_list_for_2char[rule_index]
+        valid_replacements_for_2char_roots[placeholder] = new
+
+    valid_replacements_for_2char_roots_2 = {}
+    for rule_index in second_pass_rules:
+        old, new, placeholder = replacements_list_for_2char[rule_index]
+        valid_replacements_for_2char_roots_2["!" + placeholder + "!"] = new
+
+    return text, valid_replacements_for_2char_roots, valid_replacements_for_2char_roots_2
+
+# placeholder の文法: '$数字$' ('$数字up$' / '$数字cap$' も含む)、2回目の2文字語根置換の '!…!'、'@数字@'、'%数字%'
+PLACEHOLDER_CORE_PATTERN = r'\$\d+(?:up|cap)?\$'
+# 重なった候補も拾えるよう先読みで全位置を調べ、呼び出し側で位置(cursor)を管理する
+SECOND_PASS_PLACEHOLDER_PATTERN = re.compile(r'(?=(![ $]?' + PLACEHOLDER_CORE_PATTERN + r'[ $]?!))')
+RESTORABLE_PLACEHOLDER_PATTERN = re.compile(r'(?=(' + PLACEHOLDER_CORE_PATTERN + r'|@\d+@|%\d+%))')
+PERCENT_PLACEHOLDER_PATTERN = re.compile(r'(?=(%\d+%))')
+_PLACEHOLDER_PARTS_PATTERN = re.compile(r'([ $]*)(' + PLACEHOLDER_CORE_PATTERN + r')([ $]*)')
+
+def split_placeholders_in_single_scan(text: str, pattern: re.Pattern, lookup: Dict[str, str]) -> List[str]:
+    """
+    pattern (先読み) に一致する候補を左から順に調べ、lookup にあるものだけで text を分割する。
+    lookup にない候補は分割せず、その次の位置から探し続ける。
+    (re.split と同じく、置き換える placeholder が奇数番目に入る)
+    """
+    pieces = []
+    cursor = 0
+    for match in pattern.finditer(text):
+        start = match.start()
+        if start < cursor:
+            continue
+        token = match.group(1)
+        if token not in lookup:
+            continue
+        pieces.append(text[cursor:start])
+        pieces.append(token)
+        cursor = start + len(token)
+    pieces.append(text[cursor:])
+    return pieces
+
+def replace_placeholders_in_single_scan(text: str, pattern: re.Pattern, lookup: Dict[str, str]) -> str:
+    """
+    pattern (先読み) に一致する候補を左から順に調べ、lookup にあるものだけを置き換える。
+    lookup にない候補は置き換えず、その次の位置から探し続ける。
+    """
+    if not lookup:
+        return text
+    pieces = split_placeholders_in_single_scan(text, pattern, lookup)
+    if len(pieces) == 1:
+        return text
+    pieces[1::2] = [lookup[token] for token in pieces[1::2]]
+    return ''.join(pieces)
+
+def build_placeholder_core_lookup(*valid_replacements_dicts: Dict[str, str]) -> Optional[Dict[str, str]]:
+    """
+    {placeholder: new} から {'$数字$': new の中身} を作る。
+    placeholder の前後の空白/'$' は new 側にも同じものが付いている(置換用JSON生成時にそう作る)ので、
+    中心部分だけを置き換えれば str.replace() で placeholder 全体を置き換えたのと同じになる。
+    この形になっていない規則があれば None を返す (従来の逐次復元を使う)。
+    """
+    core_lookup = {}
+    for valid_replacements in valid_replacements_dicts:
+        for placeholder, new in valid_replacements.items():
+            parts = _PLACEHOLDER_PARTS_PATTERN.fullmatch(placeholder)
+            if parts is None:
+                return None
+            lead, core, trail = parts.groups()
+            if len(new) < len(lead) + len(trail) or not (new.startswith(lead) and new.endswith(trail)):
+                return None
+            core_new = new[len(lead):len(new) - len(trail)]
+            if core_lookup.setdefault(core, core_new) != core_new:
+                return None
+    return core_lookup
+
+def restore_placeholders_sequential(
+    text: str,
+    valid_replacements: Dict[str, str],
+    valid_replacements_for_2char_roots: Dict[str, str],
+    valid_replacements_for_2char_roots_2: Dict[str, str],
+    sorted_replacements_list_for_intact_parts: List[List[str]],
+    sorted_replacements_list_for_localized_string: List[List[str]]
+) -> str:
+    """
+    7) placeholderを最終的な文字列に戻す (従来の方式: placeholder 1件ごとに text.replace())
+    """
     for place_holder_second, new in reversed(valid_replacements_for_2char_roots_2.items()):
         text = text.replace(place_holder_second, new)
 
@@ -246,16 +439,127 @@ def orchestrate_comprehensive_esperanto_text_replacement(
         text = text.replace(place_holder_, replaced_original.replace("@",""))
     for original, place_holder_ in sorted_replacements_list_for_intact_parts:
         text = text.replace(place_holder_, original.replace("%",""))
+    return text
 
-    # 8) HTML形式であれば、改行を <br> に変換 + スペースを &nbsp; に置換
+def restore_placeholders(
+    text: str,
+    valid_replacements: Dict[str, str],
+    valid_replacements_for_2char_roots: Dict[str, str],
+    valid_replacements_for_2char_roots_2: Dict[str, str],
+    sorted_replacements_list_for_intact_parts: List[List[str]],
+    sorted_replacements_list_for_localized_string: List[List[str]],
+    output_orthography: Union[str, OutputOrthography, None] = None
+) -> str:
+    """
+    7) placeholderを最終的な文字列に戻す
+
+    placeholder 1件ごとに text.replace() する代わりに、
+    (1) 2回目の2文字語根置換の '!…!' を外す走査
+    (2) '$…$' / '@…@' / '%…%' を辞書で引いて置き換える走査
+    の2回だけテキストを走査する。結果は restore_placeholders_sequential と同じ。
+
+    output_orthography (esp_orthography_module.OUTPUT_ORTHOGRAPHIES) を指定すると、出力の表記も同時にそろえる
+    (結果全体を変換したのと同じ。規則の new の中身は表記を変えたものをキャッシュから引き、
+     それ以外の部分だけを変換する)。OutputOrthography を渡すと、そのキャッシュを使う。
+    """
+    orthography = get_output_orthography(output_orthography)
+    core_lookup = build_placeholder_core_lookup(
+        valid_replacements, valid_replacements_for_2char_roots, valid_replacements_for_2char_roots_2
+    )
+    if core_lookup is None:
+        text = restore_placeholders_sequential(
+            text, valid_replacements, valid_replacements_for_2char_roots, valid_replacements_for_2char_roots_2,
+            sorted_replacements_list_for_intact_parts, sorted_replacements_list_for_localized_string
+        )
+        return orthography.converter.convert(text) if orthography is not None else text
+
+    # (1) '!placeholder!' → 'placeholder' (外した後は1回目の placeholder と同じ形になる)
+    second_pass_lookup = {place_holder_second: place_holder_second[1:-1] for place_holder_second in valid_replacements_for_2char_roots_2}
+    text = replace_placeholders_in_single_scan(text, SECOND_PASS_PLACEHOLDER_PATTERN, second_pass_lookup)
+
+    # (2) '@…@' の中に '%…%' の placeholder があれば、従来通り % 側も復元しておく
+    intact_lookup = {place_holder_: original.replace("%","") for original, place_holder_ in sorted_replacements_list_for_intact_parts}
+    lookup = dict(core_lookup) if orthography is not None else core_lookup
+    lookup.update(intact_lookup)
+    for original, place_holder_, replaced_original in sorted_replacements_list_for_localized_string:
+        lookup[place_holder_] = replace_placeholders_in_single_scan(
+            replaced_original.replace("@",""), PERCENT_PLACEHOLDER_PATTERN, intact_lookup
+        )
+    if orthography is None:
+        return replace_placeholders_in_single_scan(text, RESTORABLE_PLACEHOLDER_PATTERN, lookup)
+
+    # placeholder 以外の部分 (偶数番目) と、置き換えた中身 ('$…$' なら規則の new の中身) ごとに表記をそろえる
+    pieces = split_placeholders_in_single_scan(text, RESTORABLE_PLACEHOLDER_PATTERN, lookup)
+    tokens = pieces[1::2]
+    rule_value_flags = [False] * len(pieces)
+    rule_value_flags[1::2] = [token in core_lookup for token in tokens]
+    pieces[1::2] = [lookup[token] for token in tokens]
+    return ''.join(orthography.convert_pieces(pieces, rule_value_flags))
+
+def apply_html_formatting(text: str, format_type: str) -> str:
+    """
+    8) HTML形式であれば、改行を <br> に変換 + スペースを &nbsp; に置換
+    """
     if "HTML" in format_type:
         text = text.replace("\n", "<br>\n")
         # text = wrap_text_with_ruby(text, chunk_size=10) # (過去の関数/不要)
         text = re.sub(r"   ", "&nbsp;&nbsp;&nbsp;", text)  # 3つ以上の空白を変換
         text = re.sub(r"  ", "&nbsp;&nbsp;", text)  # 2つ以上の空白を変換
-
     return text
 
+def orchestrate_comprehensive_esperanto_text_replacement(
+    text, 
+    placeholders_for_skipping_replacements: List[str],
+    replacements_list_for_localized_string: List[Tuple[str, str, str]],
+    placeholders_for_localized_replacement: List[str],
+    replacements_final_list: List[Tuple[str, str, str]],
+    replacements_list_for_2char: List[Tuple[str, str, str]],
+    format_type: str,
+    global_replacement_backend: str = DEFAULT_GLOBAL_REPLACEMENT_BACKEND,
+    output_orthography: Optional[str] = None
+) -> str:
+    """
+    複数の変換ルールに従ってエスペラント文を文字列(漢字)置換するメイン関数。
+
+    1) 空白の正規化 → 2) エスペラント文字(ĉ等)の字上符形式統一
+    3) %で囲まれた部分をスキップ
+    4) @で囲まれた部分を局所置換
+    5) 大域置換
+    6) 2文字語根の置換を2回
+    7) プレースホルダ復元 (output_orthography を指定すれば、出力の表記も同時にそろえる)
+    8) HTML形式が指定なら追加整形
+
+    (同じ規則で何度も変換する場合は esp_replacement_engine_module.ReplacementEngine を使うと、
+     規則の前処理を1回で済ませられる)
+    """
+    # 1, 2) 空白の正規化 + エスペラント字上符への変換 (%...% / @...@ の区間も同じ走査で求める)
+    text, percent_spans, at_spans = normalize_input(text)
+
+    # 3, 4) %...% スキップ部 / @...@ 局所置換部 の一時置換
+    text, sorted_replacements_list_for_intact_parts, sorted_replacements_list_for_localized_string = protect_intact_and_localized_parts(
+        text, placeholders_for_skipping_replacements,
+        replacements_list_for_localized_string, placeholders_for_localized_replacement,
+        markup_spans=(percent_spans, at_spans)
+    )
+
+    # 5) 大域置換 (old, new, placeholder)
+    text, valid_replacements = apply_global_replacements(text, replacements_final_list, global_replacement_backend)
+
+    # 6) 2文字語根置換(2回)
+    text, valid_replacements_for_2char_roots, valid_replacements_for_2char_roots_2 = apply_2char_replacements(
+        text, replacements_list_for_2char
+    )
+
+    # 7) placeholderを最終的な文字列に戻す
+    text = restore_placeholders(
+        text, valid_replacements, valid_replacements_for_2char_roots, valid_replacements_for_2char_roots_2,
+        sorted_replacements_list_for_intact_parts, sorted_replacements_list_for_localized_string,
+        output_orthography
+    )
+
+    # 8) HTML形式であれば、改行を <br> に変換 + スペースを &nbsp; に置換
+    return apply_html_formatting(text, format_type)
+
 # ================================
 # 6) multiprocessing 関連
 # ================================
@@ -267,7 +571,9 @@ def process_segment(
     placeholders_for_localized_replacement: List[str],
     replacements_final_list: List[Tuple[str, str, str]],
     replacements_list_for_2char: List[Tuple[str, str, str]],
-    format_type: str
+    format_type: str,
+    global_replacement_backend: str = DEFAULT_GLOBAL_REPLACEMENT_BACKEND,
+    output_orthography: Optional[str] = None
 ) -> str:
     """
     multiprocessing用の下請け関数。
@@ -281,11 +587,179 @@ def process_segment(
         placeholders_for_localized_replacement,
         replacements_final_list,
         replacements_list_for_2char,
-        format_type
+        format_type,
+        global_replacement_backend,
+        output_orthography
     )
     return result
 
 
+def process_lines(
+    lines: List[str],
+    placeholders_for_skipping_replacements: List[str],
+    replacements_list_for_localized_string: List[Tuple[str, str, str]],
+    placeholders_for_localized_replacement: List[str],
+    replacements_final_list: List[Tuple[str, str, str]],
+    replacements_list_for_2char: List[Tuple[str, str, str]],
+    format_type: str,
+    global_replacement_backend: str = DEFAULT_GLOBAL_REPLACEMENT_BACKEND,
+    output_orthography: Optional[str] = None
+) -> List[str]:
+    """
+    multiprocessing用の下請け関数 (行ごとの変換結果をリストで返す版)。
+    """
+    return [
+        orchestrate_comprehensive_esperanto_text_replacement(
+            line,
+            placeholders_for_skipping_replacements,
+            replacements_list_for_localized_string,
+            placeholders_for_localized_replacement,
+            replacements_final_list,
+            replacements_list_for_2char,
+            format_type,
+            global_replacement_backend,
+            output_orthography
+        )
+        for line in lines
+    ]
+
+
+# ----------------------------------------
+# 改行のない長い行の分割
+# ----------------------------------------
+# 分割位置のスペースの前後に来てはいけない文字 (%...% / @...@ の区切りや placeholder の一部と繋がりうるもの)
+_UNSAFE_CUT_NEIGHBOUR_CHARS = frozenset('!$%@')
+# ASCII スペース + unify_halfwidth_spaces で ASCII スペースになる文字
+_UNIFIED_SPACE_PATTERN = re.compile(r"[ \u00A0\u2002\u2003\u2004\u2005\u2006\u2007\u2008\u2009\u200A]")
+# 入力文中の placeholder と同じ形の文字列 (従来の方式では行全体の復元結果に影響するので、この行は分割しない)
+_PLACEHOLDER_LIKE_PATTERN = re.compile(PLACEHOLDER_CORE_PATTERN + r'|@\d+@|%\d+%')
+
+class LongLineSplitter:
+    """
+    改行を含まない長い行を、変換結果が変わらない位置で分割する。
+    pieces = splitter.split(line, max_piece_chars) は ''.join(pieces) == line で、
+    各 piece を別々に変換して連結した結果は line をまとめて変換した結果と同じになる。
+
+    分割するのは次の条件を満たす半角スペースの直後だけ:
+    - 前後の文字が空白でない (HTML形式の &nbsp; 変換は連続する空白を見るため) / '!' '$' '%' '@' でない
+    - %...% / @...@ の中でない
+    - 空白を含む規則 ('abbreviationu ' / ' al ' など) がそのスペースを含む形で現れない
+      (空白を含まない規則は、スペースをまたいで一致することがない)
+    判定は空白の正規化と字上符形式への変換をした後の文字列で行う (どちらもスペースをまたがない変換)。
+    """
+
+    def __init__(self, *replacement_lists: List[Tuple[str, str, str]]):
+        # 空白を含む old を長さごとに集めておく
+        self.spaced_olds_by_length: Dict[int, Set[str]] = {}
+        for replacement_list in replacement_lists:
+            for old, new, placeholder in replacement_list:
+                if ' ' in old:
+                    self.spaced_olds_by_length.setdefault(len(old), set()).add(old)
+
+    def _covered_by_spaced_rule(self, text: str, position: int) -> bool:
+        for length, olds in self.spaced_olds_by_length.items():
+            for start in range(max(position - length + 1, 0), position + 1):
+                if text[start:start + length] in olds:
+                    return True
+        return False
+
+    @staticmethod
+    def _markup_spans(percent_spans: List[Tuple[int, int]], at_spans: List[Tuple[int, int]]) -> Tuple[List[int], List[int]]:
+        # %...% の範囲と @...@ の範囲 (normalize_input の区間) を重なりのない区間にまとめて、
+        # (開始位置のリスト, 終了位置のリスト) で返す
+        starts: List[int] = []
+        ends: List[int] = []
+        for start, end in sorted(percent_spans + at_spans):
+            if ends and start < ends[-1]:
+                ends[-1] = max(ends[-1], end)
+            else:
+                starts.append(start)
+                ends.append(end)
+        return starts, ends
+
+    def _is_safe_cut(self, text: str, position: int, span_starts: List[int], span_ends: List[int]) -> bool:
+        if position == 0 or position + 1 >= len(text):
+            return False
+        for neighbour in (text[position - 1], text[position + 1]):
+            if neighbour.isspace() or neighbour in _UNSAFE_CUT_NEIGHBOUR_CHARS:
+                return False
+        index = bisect_left(span_starts, position + 1) - 1
+        if index >= 0 and position < span_ends[index]:
+            return False
+        return not self._covered_by_spaced_rule(text, position)
+
+    def split(self, line: str, max_piece_chars: int) -> List[str]:
+        if len(line) <= max_piece_chars or _PLACEHOLDER_LIKE_PATTERN.search(line):
+            return [line]
+        normalized, percent_spans, at_spans = normalize_input(line)
+        # 正規化の前後で、スペース(になる文字)は1対1に対応する
+        line_spaces = [match.start() for match in _UNIFIED_SPACE_PATTERN.finditer(line)]
+        normalized_spaces = [match.start() for match in _UNIFIED_SPACE_PATTERN.finditer(normalized)]
+        span_starts, span_ends = self._markup_spans(percent_spans, at_spans)
+
+        pieces: List[str] = []
+        piece_start = 0
+        target = max_piece_chars
+        space_index = bisect_left(normalized_spaces, target)
+        while space_index < len(normalized_spaces):
+            position = normalized_spaces[space_index]
+            if not self._is_safe_cut(normalized, position, span_starts, span_ends):
+                space_index += 1
+                continue
+            cut = line_spaces[space_index] + 1
+            pieces.append(line[piece_start:cut])
+            piece_start = cut
+            space_index = bisect_left(normalized_spaces, position + 1 + max_piece_chars)
+        pieces.append(line[piece_start:])
+        return pieces
+
+# 同じリストオブジェクトに対しては作り直さない (esp_pattern_matcher_module の automaton と同じ方式)
+_long_line_splitter_cache: List[Tuple[list, list, LongLineSplitter]] = []
+
+def get_long_line_splitter(
+    replacements_final_list: List[Tuple[str, str, str]],
+    replacements_list_for_2char: List[Tuple[str, str, str]]
+) -> LongLineSplitter:
+    for cached_final_list, cached_2char_list, splitter in _long_line_splitter_cache:
+        if cached_final_list is replacements_final_list and cached_2char_list is replacements_list_for_2char:
+            return splitter
+    splitter = LongLineSplitter(replacements_final_list, replacements_list_for_2char)
+    _long_line_splitter_cache.append((replacements_final_list, replacements_list_for_2char, splitter))
+    if len(_long_line_splitter_cache) > 4:
+        _long_line_splitter_cache.pop(0)
+    return splitter
+
+def split_long_lines(lines: List[str], num_processes: int, splitter: LongLineSplitter) -> Tuple[List[str], List[int]]:
+    """
+    並列に変換するために、最初のチャンクの大きさ (AdaptiveChunkSizer) より長い行を splitter で分割する。
+    (分割後の行のリスト, 元の各行が何個に分かれたか) を返す。元に戻すには join_split_lines を使う。
+    """
+    max_piece_chars = AdaptiveChunkSizer(sum(len(line) for line in lines), num_processes).chunk_chars
+    pieces: List[str] = []
+    piece_counts: List[int] = []
+    for line in lines:
+        line_pieces = splitter.split(line, max_piece_chars)
+        pieces.extend(line_pieces)
+        piece_counts.append(len(line_pieces))
+    return pieces, piece_counts
+
+def join_split_lines(results: List[str], piece_counts: List[int]) -> List[str]:
+    joined: List[str] = []
+    position = 0
+    for count in piece_counts:
+        joined.append(''.join(results[position:position + count]))
+        position += count
+    return joined
+
+
+# 各ワーカーで initializer から1回だけ受け取る、process_lines の規則の引数 (ワーカーの状態)
+def _initialize_process_lines_worker(rule_arguments: tuple) -> tuple:
+    return rule_arguments
+
+def _process_lines_in_worker(rule_arguments: tuple, lines: List[str]) -> List[str]:
+    return process_lines(lines, *rule_arguments)
+
+
 def parallel_process(
     text: str,
     num_processes: int,
@@ -294,13 +768,28 @@ def parallel_process(
     placeholders_for_localized_replacement: List[str],
     replacements_final_list: List[Tuple[str, str, str]],
     replacements_list_for_2char: List[Tuple[str, str, str]],
-    format_type: str
+    format_type: str,
+    global_replacement_backend: str = DEFAULT_GLOBAL_REPLACEMENT_BACKEND,
+    cache: Optional[ConversionCache] = None,
+    ruleset_fingerprint: str = "",
+    chunk_timings: Optional[List[Dict]] = None,
+    executor_backend: str = DEFAULT_EXECUTOR_BACKEND,
+    progress_callback: Optional[ProgressCallback] = None,
+    output_orthography: Optional[str] = None
 ) -> str:
     """
-    与えられた text を行単位で分割し、process_segment を
+    与えられた text を行単位で分割し、process_lines を
     マルチプロセスで並列実行した結果を結合する。
+    同じ内容の行は1回だけ変換し、cache (ConversionCache) があれば、そこにない行だけを各プロセスに送る。
+    (cache を使う場合、ruleset_fingerprint には compute_ruleset_fingerprint の値を渡す)
+    行は文字数の予算ごとのチャンクに分けて、空いたプロセスから順に処理する。
+    chunk_timings にリストを渡すと、各チャンクの処理時間 (map_chunks_in_order を参照) を追加する。
+    executor_backend で並列処理の実行方式 ("process" / "thread" / "inline", esp_executor_module を参照) を選ぶ。
+    progress_callback(済んだ文字数, 全体の文字数) は、変換したチャンクごと (直列なら一定の文字数ごと) に呼ばれる。
+    callback から例外 (ConversionCancelled など) を送出すると、投入済みの残りのタスクは捨てられる。
+    output_orthography を指定すると、出力の表記も各行の変換の中でそろえる (orchestrate_comprehensive_esperanto_text_replacement を参照)。
     """
-    if num_processes <= 1:
+    if num_processes <= 1 and cache is None and progress_callback is None:
         # シングルコアで直接orchestrate_comprehensive_esperanto_text_replacementを呼ぶ
         return orchestrate_comprehensive_esperanto_text_replacement(
             text,
@@ -309,46 +798,94 @@ def parallel_process(
             placeholders_for_localized_replacement,
             replacements_final_list,
             replacements_list_for_2char,
-            format_type
+            format_type,
+            global_replacement_backend,
+            output_orthography
         )
 
     # 行ごとに分割 (改行込み)
+    # (1行だけの文章も、parallel_process_lines で安全な位置に分割してから並列に変換する)
     lines = re.findall(r'.*?\n|.+$', text)
-    num_lines = len(lines)
-    if num_lines <= 1:
-        # 行数が1以下なら並列化しても意味ないのでシングルで
-        return orchestrate_comprehensive_esperanto_text_replacement(
-            text,
-            placeholders_for_skipping_replacements,
-            replacements_list_for_localized_string,
-            placeholders_for_localized_replacement,
-            replacements_final_list,
-            replacements_list_for_2char,
-            format_type
-        )
+    return ''.join(parallel_process_lines(
+        lines,
+        num_processes,
+        placeholders_for_skipping_replacements,
+        replacements_list_for_localized_string,
+        placeholders_for_localized_replacement,
+        replacements_final_list,
+        replacements_list_for_2char,
+        format_type,
+        global_replacement_backend,
+        cache,
+        ruleset_fingerprint,
+        chunk_timings,
+        executor_backend,
+        progress_callback,
+        output_orthography
+    ))
+
+
+def parallel_process_lines(
+    lines: List[str],
+    num_processes: int,
+    placeholders_for_skipping_replacements: List[str],
+    replacements_list_for_localized_string: List[Tuple[str, str, str]],
+    placeholders_for_localized_replacement: List[str],
+    replacements_final_list: List[Tuple[str, str, str]],
+    replacements_list_for_2char: List[Tuple[str, str, str]],
+    format_type: str,
+    global_replacement_backend: str = DEFAULT_GLOBAL_REPLACEMENT_BACKEND,
+    cache: Optional[ConversionCache] = None,
+    ruleset_fingerprint: str = "",
+    chunk_timings: Optional[List[Dict]] = None,
+    executor_backend: str = DEFAULT_EXECUTOR_BACKEND,
+    progress_callback: Optional[ProgressCallback] = None,
+    output_orthography: Optional[str] = None
+) -> List[str]:
+    """
+    parallel_process の行単位版: lines (改行込み) の各行の変換結果を同じ順番のリストで返す。
+    長い行は LongLineSplitter で分割してから変換し、結果をつなぎ直す。
+    """
+    rule_arguments = (
+        placeholders_for_skipping_replacements,
+        replacements_list_for_localized_string,
+        placeholders_for_localized_replacement,
+        replacements_final_list,
+        replacements_list_for_2char,
+        format_type,
+        global_replacement_backend,
+        output_orthography
+    )
 
-    lines_per_process = max(num_lines // num_processes, 1)
-    ranges = [(i * lines_per_process, (i + 1) * lines_per_process) for i in range(num_processes)]
-    # 最後のプロセスに残りを全部割り当てる
-    ranges[-1] = (ranges[-1][0], num_lines)
-
-    with multiprocessing.Pool(processes=num_processes) as pool:
-        results = pool.starmap(
-            process_segment,
-            [
-                (
-                    lines[start:end],
-                    placeholders_for_skipping_replacements,
-                    replacements_list_for_localized_string,
-                    placeholders_for_localized_replacement,
-                    replacements_final_list,
-                    replacements_list_for_2char,
-                    format_type
-                )
-                for (start, end) in ranges
-            ]
-        )
-    return ''.join(results)
+    def convert_missing_lines(missing_lines: List[str]) -> List[str]:
+        num_missing = len(missing_lines)
+        if num_processes <= 1 or num_missing <= 1:
+            return map_batches_with_progress(
+                lambda batch: process_lines(batch, *rule_arguments), missing_lines, progress_callback
+            )
+
+        # 規則は initializer で各ワーカーに1回だけ渡し (スレッド / インラインでは受け渡し自体が不要)、各チャンクでは行だけを送る
+        # (途中で例外が起きたら、with 文を抜けるときに残りのタスクは捨てられる)
+        with create_executor(
+            executor_backend,
+            num_processes,
+            initializer=_initialize_process_lines_worker,
+            initargs=(rule_arguments,)
+        ) as executor:
+            results, timings = map_chunks_in_order(
+                executor, _process_lines_in_worker, missing_lines, num_processes, progress_callback=progress_callback
+            )
+        if chunk_timings is not None:
+            chunk_timings.extend(timings)
+        return results
+
+    cache_format_key = output_format_key(format_type, output_orthography)
+    if num_processes <= 1:
+        return convert_unique_lines(lines, convert_missing_lines, cache, ruleset_fingerprint, cache_format_key)
+    splitter = get_long_line_splitter(replacements_final_list, replacements_list_for_2char)
+    pieces, piece_counts = split_long_lines(lines, num_processes, splitter)
+    results = convert_unique_lines(pieces, convert_missing_lines, cache, ruleset_fingerprint, cache_format_key)
+    return join_split_lines(results, piece_counts)
 
 
 def apply_ruby_html_header_and_footer(processed_text: str, format_type: str) -> str:
@@ -356,6 +893,15 @@ def apply_ruby_html_header_and_footer(processed_text: str, format_type: str) ->
     指定された出力形式に応じて、processed_text に対するHTMLヘッダーとフッターを適用する。
     例: ルビサイズ調整用の<style> を挿入するなど。
     """
+    ruby_style_head, ruby_style_tail = get_ruby_html_header_and_footer(format_type)
+    return ruby_style_head + processed_text + ruby_style_tail
+
+
+def get_ruby_html_header_and_footer(format_type: str) -> Tuple[str, str]:
+    """
+    apply_ruby_html_header_and_footer で前後に付ける (ヘッダー, フッター) を返す。
+    (変換結果を少しずつファイルに書き出す場合に使う)
+    """
     if format_type in ('HTML格式_Ruby文字_大小调整','HTML格式_Ruby文字_大小调整_汉字替换'):
         # html形式におけるルビサイズの変更形式
         ruby_style_head="""<!DOCTYPE html>
@@ -471,4 +1017,4 @@ ruby rt {
         ruby_style_head = ""
         ruby_style_tail = ""
     
-    return ruby_style_head + processed_text + ruby_style_tail
\ No newline at end of file
+    return ruby_style_head, ruby_style_tail
\ No newline at end of file
@@ -0,0 +1,269 @@
+## esp_worker_pool_module.py
+
+"""
+変換用のワーカープロセスを常駐させておくためのモジュール。
+
+parallel_process は呼び出しのたびに multiprocessing.Pool を作り
+(main.py では 'spawn' なので毎回 Python の起動 + モジュールの import からやり直し)、
+さらに starmap の各タスクに replacements_final_list や placeholder のリストを丸ごと pickle して渡している。
+数MB 以下の文章では、この起動と引数の受け渡しの時間の方が変換そのものより長く、
+並列処理を有効にするとかえって遅くなる。
+
+WarmWorkerPool は
+- プールを1回だけ作り、各ワーカーでは initializer で規則を受け取って ReplacementEngine を1回だけ組み立てる
+- 以後のタスクでは変換する行(文字列)だけを送る
+ので、main.py では st.cache_resource で (規則の fingerprint, format_type, 出力の表記, プロセス数) ごとに保持して
+rerun をまたいで使い回す。
+calibrate_conversion_planner は、このエンジンで直列/並列のどちらが速いかを決めるための
+ParallelismPlanner (esp_parallel_planning_module) を、1文字あたりの変換時間とワーカーの起動時間を測って作る。
+規則のリストは共有メモリ (esp_shared_ruleset_module) に1回だけ書き込み、各ワーカーはそれを参照する
+(ワーカーごとにリストの複製を持たない。ただし automaton などは各ワーカーが組み立てるので、その分のメモリは
+ワーカー数に比例する)。
+executor_backend が "thread" / "inline" (esp_executor_module) の場合は、ワーカーは呼び出し元のエンジンをそのまま使う
+(プロセスの起動も、エンジンの組み立て直しも、共有メモリも不要)。
+forkserver で同じ規則のエンジンを読み込み済みなら (esp_executor_module.configure_worker_start_method)、
+各ワーカーはそれを使うので、起動は fork だけになる (automaton なども fork 元のものを共有するので、
+メモリ使用量もワーカー数によらずほぼ一定になる)。起動にかかった時間は cold_start_seconds に残る。
+convert_lines に progress_callback を渡すとチャンクごとに進捗を返す。変換が途中で止められた場合
+(callback から例外を送出した場合や streamlit の rerun / stop)、残りのタスクはワーカーごと捨て、ワーカーを起動し直す
+(止めた変換が、他の利用者のための CPU を使い続けないように)。
+ただし main.py ではプールをセッション間で共有するので、他の変換が同じプールを使っている間は
+ワーカーは止めず、止めた変換の投入済みのチャンク (多くても 2×プロセス数 個) の結果を捨てるだけにする。
+"""
+
+import re
+import time
+import threading
+import multiprocessing
+from typing import List, Dict, Tuple, Iterable, Optional
+
+from esp_replacement_engine_module import ReplacementEngine, build_worker_engine
+from esp_text_replacement_module import get_long_line_splitter, split_long_lines, join_split_lines
+from esp_conversion_cache_module import convert_unique_lines
+from esp_input_normalization_module import new_normalization_counters, add_normalization_counters
+from esp_shared_ruleset_module import SharedRuleLists
+from esp_parallel_chunking_module import ProgressCallback, map_chunks_in_order
+from esp_parallel_planning_module import (
+    ParallelismPlanner,
+    available_cpu_count,
+    measure_seconds_per_unit,
+    measure_pool_startup_seconds
+)
+from esp_executor_module import create_executor, backend_runs_in_parallel
+
+# ================================
+# 1) ワーカー側
+# ================================
+# 各ワーカープロセスで1つだけ作るエンジン (ワーカーの状態)
+def _initialize_pool_worker(
+    engine_arguments: Optional[tuple],
+    preload_key: Optional[tuple] = None,
+    format_type: str = "",
+    output_orthography: Optional[str] = None
+) -> ReplacementEngine:
+    return build_worker_engine(engine_arguments, preload_key, format_type, output_orthography)
+
+# スレッド / インラインでは、呼び出し元のエンジンをそのままワーカーの状態にする
+def _use_engine_in_worker(engine: ReplacementEngine) -> ReplacementEngine:
+    return engine
+
+def _convert_lines_in_worker(engine: ReplacementEngine, lines: List[str]) -> List[str]:
+    # result_cache は呼び出し元で引くので、ここでは使わない
+    return [engine._convert_text(line) for line in lines]
+
+def _convert_lines_counting_in_worker(engine: ReplacementEngine, lines: List[str]) -> Tuple[List[str], Dict[str, int]]:
+    # 飛ばした正規化の段階の数もチャンクごとに返す (ワーカーの中の回数は呼び出し元に届かないため)
+    counters = new_normalization_counters()
+    return [engine._convert_text(line, counters) for line in lines], counters
+
+# ================================
+# 2) 常駐プール
+# ================================
+class WarmWorkerPool:
+    """
+    1つの ReplacementEngine (規則 + format_type + 出力の表記) 専用の常駐ワーカープール。
+
+    pool = WarmWorkerPool(engine, num_processes=4)
+    pool = WarmWorkerPool(engine, num_processes=4, executor_backend="thread")  # 既定は engine.executor_backend
+    pool.convert(text)          # engine.convert_parallel(text, 4) と同じ結果
+    pool.convert_lines(lines)   # 行ごとの変換結果のリスト
+    pool.last_chunk_timings     # 直前の変換の各チャンクの処理時間
+    pool.wait_until_ready()     # ワーカーの起動を待つ (pool.cold_start_seconds に起動にかかった秒数が入る)
+    pool.convert_lines(lines, progress_callback=report)  # report(済んだ文字数, 全体の文字数) をチャンクごとに呼ぶ
+    pool.close()
+    """
+
+    def __init__(
+        self,
+        engine: ReplacementEngine,
+        num_processes: int,
+        share_rules: bool = True,
+        executor_backend: Optional[str] = None
+    ):
+        if num_processes < 1:
+            raise ValueError("num_processes は1以上にしてください")
+        self.engine = engine
+        self.num_processes = num_processes
+        self.ruleset_fingerprint = engine.ruleset_fingerprint
+        self.format_type = engine.format_type
+        self.output_format_key = engine.output_format_key
+        self.executor_backend = executor_backend if executor_backend is not None else engine.executor_backend
+        created = time.perf_counter()
+        self._shared_rules: Optional[SharedRuleLists] = None
+        if self.executor_backend == "process":
+            # 規則は initializer で各ワーカーに1回だけ渡す
+            # (share_rules なら共有メモリに書き込み、ワーカーには共有メモリの名前と位置だけを送る。
+            #  forkserver で同じ規則のエンジンを読み込み済みなら、規則は送らない)
+            self._initargs, self._shared_rules = engine._worker_rules(share_rules)
+            self._initializer = _initialize_pool_worker
+        else:
+            self._initializer, self._initargs = _use_engine_in_worker, (engine,)
+        self._start_workers(created)
+        self.last_chunk_timings: List[Dict] = []
+        # 実行中の変換の数 (止められた変換のワーカーを終了させてよいかどうかの判断に使う)
+        self._lock = threading.Lock()
+        self._active_conversions = 0
+        # 変換中に close() された (main.py で st.cache_resource から追い出された) ら、最後の変換が終わってから閉じる
+        self._close_requested = False
+
+    def _start_workers(self, created: float) -> None:
+        # cold_start_seconds は created (規則の準備を始めた時刻) から最初のタスクが返るまで
+        self._created = created
+        self.cold_start_seconds: Optional[float] = None
+        self._executor = create_executor(self.executor_backend, self.num_processes, self._initializer, self._initargs)
+
+    def _convert_missing_lines(
+        self,
+        missing_lines: List[str],
+        progress_callback: Optional[ProgressCallback],
+        normalization_counters: Optional[Dict[str, int]]
+    ) -> List[str]:
+        # 文字数の予算ごとのチャンクに分け、空いたワーカーから順に処理する
+        with self._lock:
+            executor = self._executor
+            self._active_conversions += 1
+        try:
+            results, timings = map_chunks_in_order(
+                executor, _convert_lines_counting_in_worker, missing_lines, self.num_processes,
+                progress_callback=progress_callback, returns_counters=True
+            )
+            self.last_chunk_timings = timings
+            if normalization_counters is not None:
+                for timing in timings:
+                    add_normalization_counters(normalization_counters, timing["counters"])
+        except BaseException:
+            with self._lock:
+                self._active_conversions -= 1
+                # 他の変換がこのワーカーを使っていなければ、投入済みの残りのタスクはワーカーごと捨て
+                # (規則の共有メモリは残す)、次の変換のためにワーカーを起動し直す
+                if self._active_conversions == 0 and executor is self._executor:
+                    executor.cancel()
+                    if self._close_requested:
+                        self._executor = None
+                        self._release_resources()
+                    else:
+                        self._start_workers(time.perf_counter())
+            raise
+        with self._lock:
+            self._active_conversions -= 1
+            if self._active_conversions == 0 and self._close_requested:
+                self._release_resources()
+        return results
+
+    def convert_lines(
+        self,
+        lines: Iterable[str],
+        progress_callback: Optional[ProgressCallback] = None,
+        normalization_counters: Optional[Dict[str, int]] = None
+    ) -> List[str]:
+        """
+        行(改行込み)ごとの変換結果を同じ順番のリストで返す。
+        同じ内容の行と engine.result_cache にある行は、ワーカーには送らない。
+        長い行は安全な位置で分割してから変換する (LongLineSplitter)。
+        progress_callback があれば、チャンクごとに (済んだ文字数, 全体の文字数) で呼ぶ
+        (ワーカーに送る行の分だけ。callback から例外を送出すると、残りのタスクを捨てて止まる)。
+        normalization_counters (esp_input_normalization_module.new_normalization_counters) を渡すと、
+        ワーカーが変換した行で飛ばした正規化の段階の数を、チャンクごとに集めてそこに足す。
+        """
+        if self._executor is None:
+            raise RuntimeError("このワーカープールは既に閉じられています")
+        self.last_chunk_timings = []
+        splitter = get_long_line_splitter(self.engine.replacements_final_list, self.engine.replacements_list_for_2char)
+        pieces, piece_counts = split_long_lines(list(lines), self.num_processes, splitter)
+        results = convert_unique_lines(
+            pieces,
+            lambda missing_lines: self._convert_missing_lines(missing_lines, progress_callback, normalization_counters),
+            self.engine.result_cache,
+            self.ruleset_fingerprint,
+            self.output_format_key
+        )
+        return join_split_lines(results, piece_counts)
+
+    def convert(self, text: str, progress_callback: Optional[ProgressCallback] = None) -> str:
+        return ''.join(self.convert_lines(re.findall(r'.*?\n|.+$', text), progress_callback))
+
+    def wait_until_ready(self) -> None:
+        """
+        ワーカーの起動 (エンジンの組み立て) が終わるまで待つ。
+        初めて呼んだときは、プールを作ってからワーカーが最初のタスクを返すまでの秒数を cold_start_seconds に残す。
+        """
+        if self._executor is None:
+            raise RuntimeError("このワーカープールは既に閉じられています")
+        self._executor.submit_with_state(_convert_lines_in_worker, []).get()
+        if self.cold_start_seconds is None:
+            self.cold_start_seconds = time.perf_counter() - self._created
+
+    def close(self) -> None:
+        """
+        ワーカーを終了させ、規則の共有メモリを解放する。
+        他のスレッド (Streamlit の別のセッション) の変換が実行中なら、その変換が終わったときに閉じる。
+        """
+        with self._lock:
+            if self._active_conversions > 0:
+                self._close_requested = True
+                return
+            self._release_resources()
+
+    def _release_resources(self) -> None:
+        # self._lock の中で呼ぶこと
+        if self._executor is not None:
+            self._executor.close()
+            self._executor = None
+        if self._shared_rules is not None:
+            self._shared_rules.close()
+            self._shared_rules = None
+
+    def __enter__(self) -> "WarmWorkerPool":
+        return self
+
+    def __exit__(self, *exc_info) -> None:
+        self.close()
+
+# ================================
+# 3) 直列 / 並列の自動選択のための計測
+# ================================
+def calibrate_conversion_planner(
+    engine: ReplacementEngine,
+    sample_text: str,
+    max_processes: Optional[int] = None,
+    executor_backend: Optional[str] = None
+) -> ParallelismPlanner:
+    """
+    sample_text を直列で1回変換して1文字あたりの時間を測り (result_cache は使わない)、
+    CPU が2つ以上使えるなら、1ワーカーの WarmWorkerPool の起動時間も測って ParallelismPlanner を作る。
+    (executor_backend を省略すると engine.executor_backend。並列に動かない方式なら常に直列を選ぶ)
+    """
+    if executor_backend is None:
+        executor_backend = engine.executor_backend
+    seconds_per_char = measure_seconds_per_unit(lambda: engine._convert_text(sample_text), len(sample_text))
+    worker_startup_seconds = 0.0
+    if available_cpu_count() >= 2 and backend_runs_in_parallel(executor_backend):
+        if executor_backend == "process" and multiprocessing.get_start_method() == "forkserver":
+            # サーバープロセスの起動 (と規則の読み込み) は最初の1回だけなので、先に済ませてから測る
+            measure_pool_startup_seconds(executor_backend="process")
+        with WarmWorkerPool(engine, 1, executor_backend=executor_backend) as pool:
+            pool.wait_until_ready()
+            worker_startup_seconds = pool.cold_start_seconds
+    return ParallelismPlanner(
+        seconds_per_char, worker_startup_seconds, max_processes=max_processes, executor_backend=executor_backend
+    )
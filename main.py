@@ -8,40 +8,58 @@ import json
 import pandas as pd  # 必要なら使う
 from typing import List, Dict, Tuple, Optional
 import streamlit.components.v1 as components
-import multiprocessing
-
-#=================================================================
-# Streamlit で multiprocessing を使う際、PicklingError 回避のため
-# 明示的に 'spawn' モードを設定する必要がある。
-#=================================================================
-try:
-    multiprocessing.set_start_method("spawn")
-except RuntimeError:
-    pass  # すでに start method が設定済みの場合はここで無視する
+import hashlib
+import time
+import inspect
 
 #=================================================================
 # エスペラント文の(漢字)置換・ルビ振りなどを行う独自モジュールから
 # 関数をインポートする。
 # esp_text_replacement_module.py内に定義されているツールをまとめて呼び出す
 #=================================================================
-from esp_text_replacement_module import (
-    x_to_circumflex,
-    x_to_hat,
-    hat_to_circumflex,
-    circumflex_to_hat,
-    replace_esperanto_chars,
-    import_placeholders,
-    orchestrate_comprehensive_esperanto_text_replacement,
-    parallel_process,
-    apply_ruby_html_header_and_footer
+from esp_text_replacement_module import import_placeholders
+from esp_input_normalization_module import new_normalization_counters
+from esp_replacement_engine_module import (
+    ReplacementEngine,
+    split_combined_replacements_data
+)
+from esp_conversion_cache_module import ConversionCache, reconvert_changed_lines
+from esp_worker_pool_module import WarmWorkerPool, calibrate_conversion_planner
+from esp_parallel_planning_module import ParallelismPlanner, record_actual_seconds
+from esp_executor_module import (
+    EXECUTOR_BACKENDS,
+    DEFAULT_EXECUTOR_BACKEND,
+    DEFAULT_WORKER_START_METHOD,
+    configure_worker_start_method
+)
+
+DEFAULT_JSON_PATH = "./Appの运行に使用する各类文件/最终的な替换用リスト(列表)(合并3个JSON文件).json"
+
+#=================================================================
+# Streamlit で multiprocessing を使う際のワーカーの起動方式。
+# (fork だと Streamlit のスレッドごと複製されて PicklingError などの原因になるので使わない)
+# forkserver を使える環境 (Linux など) では、変換モジュールと既定の置換用JSONのエンジンを
+# 読み込み済みのサーバープロセスから fork するので、ワーカーごとに streamlit / pandas の import や
+# automaton の組み立てをやり直さない (automaton なども共有されるので、プロセス数を増やしてもメモリ使用量がほぼ一定)。
+# 使えない環境 (Windows) では従来どおり 'spawn'。
+# spawn の場合や、アップロードした別の置換用JSONでは、規則のリストだけが共有メモリで共有され、
+# automaton などは各ワーカーが組み立てる (その分のメモリはプロセス数に比例する)。
+# (どちらでも、ワーカーにはこのスクリプトを import し直させない: hide_main_module)
+#=================================================================
+worker_start_method = configure_worker_start_method(
+    DEFAULT_WORKER_START_METHOD,
+    preload_ruleset_path=DEFAULT_JSON_PATH,
+    hide_main_module=True
 )
 
 #=================================================================
-# Streamlit の @st.cache_data デコレータを使い、読み込み結果をキャッシュして
+# Streamlit の @st.cache_resource デコレータを使い、読み込み結果をキャッシュして
 # JSONファイルのロード高速化を図る。大きなJSON(50MB程度)を都度読むと遅いので、
 # ここで呼び出す関数をキャッシュする作り。
+# (@st.cache_data だと毎回コピーが返るため、大域置換用の automaton が
+#  rerun のたびに作り直されてしまう。cache_resource なら同じリストが返る)
 #=================================================================
-@st.cache_data
+@st.cache_resource
 def load_replacements_lists(json_path: str) -> Tuple[List, List, List]:
     """
     JSONファイルをロードし、以下の3つのリストをタプルとして返す:
@@ -51,19 +69,110 @@ def load_replacements_lists(json_path: str) -> Tuple[List, List, List]:
     """
     with open(json_path, 'r', encoding='utf-8') as f:
         data = json.load(f)
-    replacements_final_list = data.get(
-        "全域替换用のリスト(列表)型配列(replacements_final_list)", []
-    )
-    replacements_list_for_localized_string = data.get(
-        "局部文字替换用のリスト(列表)型配列(replacements_list_for_localized_string)", []
-    )
-    replacements_list_for_2char = data.get(
-        "二文字词根替换用のリスト(列表)型配列(replacements_list_for_2char)", []
-    )
-    return (
+    return split_combined_replacements_data(data)
+
+@st.cache_resource(max_entries=2)
+def load_uploaded_replacements_lists(json_bytes: bytes) -> Tuple[List, List, List]:
+    """
+    アップロードされたJSON(バイト列)を読み込む。同じ内容なら rerun でも再読み込みしない。
+    """
+    return split_combined_replacements_data(json.loads(json_bytes.decode('utf-8')))
+
+@st.cache_resource(max_entries=8)
+def get_replacement_engine(
+    ruleset_key: str,
+    format_type: str,
+    _replacements_lists: Tuple[List, List, List],
+    _placeholders_for_skipping_replacements: List[str],
+    _placeholders_for_localized_replacement: List[str]
+) -> ReplacementEngine:
+    """
+    置換規則(ruleset_key) + format_type ごとに1つだけ変換エンジンを作って保持する。
+    (引数名が _ で始まるものはキャッシュのキーに含めない)
+    同じ文書・同じ行を変換し直したときのために、行単位の変換結果のキャッシュも持たせる。
+    """
+    (replacements_final_list,
+     replacements_list_for_localized_string,
+     replacements_list_for_2char) = _replacements_lists
+    return ReplacementEngine(
         replacements_final_list,
         replacements_list_for_localized_string,
         replacements_list_for_2char,
+        _placeholders_for_skipping_replacements,
+        _placeholders_for_localized_replacement,
+        format_type,
+        result_cache=ConversionCache(max_entries=20000)
+    )
+
+def close_warm_worker_pool(pool: WarmWorkerPool) -> None:
+    pool.close()
+
+# キャッシュから追い出された (設定を変えた) プールは on_release で閉じ、ワーカーと規則の共有メモリを解放する。
+# on_release のない古い Streamlit では、プールが GC されたときに共有メモリだけは解放される
+# (SharedRuleLists の weakref.finalize)。
+WARM_WORKER_POOL_CACHE_OPTIONS = (
+    {"on_release": close_warm_worker_pool}
+    if "on_release" in inspect.signature(st.cache_resource).parameters else {}
+)
+
+@st.cache_resource(max_entries=2, **WARM_WORKER_POOL_CACHE_OPTIONS)
+def get_warm_worker_pool(
+    ruleset_fingerprint: str,
+    format_type: str,
+    output_orthography: str,
+    num_processes: int,
+    executor_backend: str,
+    _replacement_engine: ReplacementEngine
+) -> WarmWorkerPool:
+    """
+    並列処理用のワーカープールを (規則の fingerprint, format_type, 出力の表記, プロセス数, 実行方式) ごとに1つだけ作って保持する。
+    各ワーカーは起動時に1回だけ規則を受け取るので、送信のたびにプロセスを起動したり
+    規則を pickle して送ったりしなくてよい。
+    """
+    return WarmWorkerPool(_replacement_engine, num_processes, executor_backend=executor_backend)
+
+# 自動モードで使う最大のプロセス数 / 判断理由の表示
+MAX_AUTO_PROCESSES = 8
+PLAN_REASON_LABELS = {
+    "single_cpu": "nur eine CPU verfügbar",
+    "small_input": "Eingabe zu klein, der Start der Prozesse würde länger dauern",
+    "overhead": "der Start der Prozesse würde den Zeitgewinn aufheben",
+    "faster": "parallele Verarbeitung ist voraussichtlich schneller",
+    "serial_backend": "die gewählte Ausführungsart arbeitet nicht parallel"
+}
+EXECUTOR_BACKEND_LABELS = {
+    "process": "Prozesse (multiprocessing)",
+    "thread": "Threads (ohne Prozessstart; echte Parallelität nur mit free-threaded Python 3.13+)",
+    "inline": "Inline (ohne Parallelisierung, zum Vergleich)"
+}
+# 結果の表記 (letter_type) → 変換エンジンの出力の表記 (esp_orthography_module.OUTPUT_ORTHOGRAPHIES)
+OUTPUT_ORTHOGRAPHY_BY_LETTER_TYPE = {
+    "上付き文字": "circumflex",
+    "x 形式": "x",
+    "^形式": "hat"
+}
+# 変換した行で、入力に現れないので飛ばした正規化の段階 (esp_input_normalization_module の回数のキー) の表示
+NORMALIZATION_STAGE_LABELS = {
+    "spaces_skipped": "Vereinheitlichung der Leerzeichen",
+    "orthography_skipped": "Umwandlung von cx / c^ in ĉ",
+    "markup_skipped": "Suche nach %- / @-Markierungen"
+}
+
+@st.cache_resource(max_entries=8)
+def get_parallelism_planner(
+    ruleset_fingerprint: str,
+    format_type: str,
+    executor_backend: str,
+    _replacement_engine: ReplacementEngine
+) -> ParallelismPlanner:
+    """
+    自動モード用: 例文で1文字あたりの変換時間を、1ワーカーのワーカープールでワーカーの起動時間を
+    (規則 + format_type + 実行方式 ごとに1回だけ) 測って、直列/並列を選ぶ ParallelismPlanner を作る。
+    """
+    with open('./例句_Esperanto文本.txt', 'r', encoding='utf-8') as f:
+        sample_text = f.read(50000)
+    return calibrate_conversion_planner(
+        _replacement_engine, sample_text, max_processes=MAX_AUTO_PROCESSES, executor_backend=executor_backend
     )
 
 #=================================================================
@@ -102,16 +211,13 @@ with st.expander("Beispiel-JSON-Datei (für Ersetzungen) herunterladen"):
             mime="application/json"
         )
 
-replacements_final_list: List[Tuple[str, str, str]] = []
-replacements_list_for_localized_string: List[Tuple[str, str, str]] = []
-replacements_list_for_2char: List[Tuple[str, str, str]] = []
+replacements_lists: Tuple[List, List, List] = ([], [], [])
+ruleset_key = ""
 
 if selected_option == "デフォルトを使用する":
-    default_json_path = "./Appの运行に使用する各类文件/最终的な替换用リスト(列表)(合并3个JSON文件).json"
     try:
-        (replacements_final_list,
-         replacements_list_for_localized_string,
-         replacements_list_for_2char) = load_replacements_lists(default_json_path)
+        replacements_lists = load_replacements_lists(DEFAULT_JSON_PATH)
+        ruleset_key = DEFAULT_JSON_PATH
         st.success("Die Standard-JSON-Datei wurde erfolgreich geladen.")
     except Exception as e:
         st.error(f"Die Standard-JSON-Datei konnte nicht geladen werden: {e}")
@@ -123,16 +229,9 @@ else:
     )
     if uploaded_file is not None:
         try:
-            combined_data = json.load(uploaded_file)
-            replacements_final_list = combined_data.get(
-                "全域替换用のリスト(列表)型配列(replacements_final_list)", []
-            )
-            replacements_list_for_localized_string = combined_data.get(
-                "局部文字替换用のリスト(列表)型配列(replacements_list_for_localized_string)", []
-            )
-            replacements_list_for_2char = combined_data.get(
-                "二文字词根替换用のリスト(列表)型配列(replacements_list_for_2char)", []
-            )
+            uploaded_json_bytes = uploaded_file.getvalue()
+            replacements_lists = load_uploaded_replacements_lists(uploaded_json_bytes)
+            ruleset_key = "upload:" + hashlib.sha256(uploaded_json_bytes).hexdigest()
             st.success("Die hochgeladene JSON-Datei wurde erfolgreich verarbeitet.")
         except Exception as e:
             st.error(f"Die hochgeladene JSON-Datei konnte nicht gelesen werden: {e}")
@@ -165,11 +264,26 @@ with st.expander("Einstellungen für die Parallelverarbeitung öffnen"):
     Hier können Sie die Anzahl der Prozesse festlegen, 
     die parallel bei der Ersetzung der Zeichen (Kanji) ausgeführt werden.
     """)
-    use_parallel = st.checkbox("Parallelverarbeitung verwenden", value=False)
+    # 自動: CPU 数・入力の大きさ・(1回だけ測った)変換速度とワーカーの起動時間から、直列か何プロセスかを選ぶ
+    parallel_mode = st.radio(
+        "Verarbeitungsmodus",
+        ("自動", "直列", "並列"),
+        format_func=lambda x: (
+            "Automatisch (seriell oder parallel, Prozessanzahl nach CPU und Textlänge)" if x == "自動"
+            else ("Seriell" if x == "直列" else "Parallel mit fester Prozessanzahl")
+        )
+    )
     num_processes = st.number_input(
-        "Anzahl gleichzeitiger Prozesse",
+        "Anzahl gleichzeitiger Prozesse (nur für \"Parallel mit fester Prozessanzahl\")",
         min_value=2, max_value=4, value=4, step=1
     )
+    # 並列処理をプロセス / スレッド / インラインのどれで実行するか (esp_executor_module)
+    executor_backend = st.radio(
+        "Ausführungsart der Parallelverarbeitung",
+        EXECUTOR_BACKENDS,
+        index=EXECUTOR_BACKENDS.index(DEFAULT_EXECUTOR_BACKEND),
+        format_func=lambda x: EXECUTOR_BACKEND_LABELS[x]
+    )
 
 st.write("---")
 
@@ -205,6 +319,15 @@ selected_display = st.selectbox(
 )
 format_type = options[selected_display]
 
+# 置換規則 + 出力形式 ごとに1つの変換エンジンを使い回す
+replacement_engine = get_replacement_engine(
+    ruleset_key,
+    format_type,
+    replacements_lists,
+    placeholders_for_skipping_replacements,
+    placeholders_for_localized_replacement
+)
+
 processed_text = ""
 
 #=================================================================
@@ -263,6 +386,8 @@ with st.form(key='profile_form'):
     )
 
     submit_btn = st.form_submit_button('Senden')
+    # 変換中に押すと、Streamlit が実行中のスクリプトを次の st.* の呼び出し (進捗バーの更新) で止める。
+    # そのとき変換のワーカーに投入済みの残りのタスクは捨てられる (esp_executor_module の cancel)
     cancel_btn = st.form_submit_button("Abbrechen")
 
     if cancel_btn:
@@ -270,38 +395,117 @@ with st.form(key='profile_form'):
         st.stop()
 
     if submit_btn:
+        # 前回送信した入力(text0_value)と行(段落)単位で比較し、変わった段落だけを変換し直す。
+        # 前回の変換結果は、置換規則 + 出力形式 + 結果の表記 が同じ場合だけ使う。
+        # (結果の表記は変換エンジンが行ごとの変換の中でそろえるので、変換後の文書全体をもう1回走査しない)
+        output_orthography = OUTPUT_ORTHOGRAPHY_BY_LETTER_TYPE[letter_type]
+        output_engine = replacement_engine.with_output_orthography(output_orthography)
+        conversion_key = (ruleset_key, format_type, output_orthography)
+        previous_conversion = st.session_state.get("converted_paragraphs")
+        previous_lines: List[str] = []
+        previous_results: List[str] = []
+        if previous_conversion is not None and previous_conversion[0] == conversion_key:
+            previous_lines, previous_results = previous_conversion[1], previous_conversion[2]
         st.session_state["text0_value"] = text0
 
-        if use_parallel:
-            processed_text = parallel_process(
-                text=text0,
-                num_processes=num_processes,
-                placeholders_for_skipping_replacements=placeholders_for_skipping_replacements,
-                replacements_list_for_localized_string=replacements_list_for_localized_string,
-                placeholders_for_localized_replacement=placeholders_for_localized_replacement,
-                replacements_final_list=replacements_final_list,
-                replacements_list_for_2char=replacements_list_for_2char,
-                format_type=format_type
-            )
-        else:
-            processed_text = orchestrate_comprehensive_esperanto_text_replacement(
-                text=text0,
-                placeholders_for_skipping_replacements=placeholders_for_skipping_replacements,
-                replacements_list_for_localized_string=replacements_list_for_localized_string,
-                placeholders_for_localized_replacement=placeholders_for_localized_replacement,
-                replacements_final_list=replacements_final_list,
-                replacements_list_for_2char=replacements_list_for_2char,
-                format_type=format_type
+        cache_counters_before = replacement_engine.cache_counters()
+        paragraphs = re.findall(r'.*?\n|.+$', text0)
+        # 自動モードでは、変換し直す段落の文字数が分かった時点で直列/並列を決める
+        # (このセッションですでに起動したプロセス数のプールは、起動時間0として比べる)
+        conversion_plan: Dict = {}
+        # このセッションで新しく起動したワーカープールの起動時間 (プロセス数, 秒)
+        worker_cold_starts: List[Tuple[int, float]] = []
+        warm_process_counts = st.session_state.setdefault("warm_process_counts", set())
+        # 変換した行 (ワーカーで変換した行も含む) で飛ばした正規化の段階の数
+        normalization_counters = new_normalization_counters()
+        # チャンクごと (直列なら一定の文字数ごと) の進捗
+        progress_bar = st.progress(0.0, text="Ersetzung läuft … (mit „Abbrechen“ beenden)")
+
+        def report_progress(done_chars: int, total_chars: int) -> None:
+            progress_bar.progress(
+                done_chars / total_chars if total_chars else 1.0,
+                text=f"Ersetzung läuft … {done_chars:,} / {total_chars:,} Zeichen (mit „Abbrechen“ beenden)"
             )
 
-        if letter_type == '上付き文字':
-            processed_text = replace_esperanto_chars(processed_text, x_to_circumflex)
-            processed_text = replace_esperanto_chars(processed_text, hat_to_circumflex)
-        elif letter_type == '^形式':
-            processed_text = replace_esperanto_chars(processed_text, x_to_hat)
-            processed_text = replace_esperanto_chars(processed_text, circumflex_to_hat)
+        def convert_paragraphs(changed_paragraphs: List[str]) -> List[str]:
+            if parallel_mode == "自動":
+                planner = get_parallelism_planner(
+                    replacement_engine.ruleset_fingerprint, format_type, executor_backend, replacement_engine
+                )
+                # 同じ内容の段落は1回だけ変換されるので、重複を除いた文字数で予測する
+                conversion_plan.update(planner.plan(
+                    sum(len(paragraph) for paragraph in dict.fromkeys(changed_paragraphs)),
+                    {count for fingerprint, fmt, orthography, backend, count in warm_process_counts
+                     if (fingerprint, fmt, orthography, backend)
+                     == (replacement_engine.ruleset_fingerprint, format_type, output_orthography, executor_backend)}
+                ))
+                use_parallel, processes = conversion_plan["mode"] == "parallel", conversion_plan["num_processes"]
+            else:
+                use_parallel, processes = parallel_mode == "並列", num_processes
+            started = time.perf_counter()
+            if use_parallel:
+                worker_pool = get_warm_worker_pool(
+                    replacement_engine.ruleset_fingerprint, format_type, output_orthography, processes, executor_backend,
+                    output_engine
+                )
+                warm_process_counts.add(
+                    (replacement_engine.ruleset_fingerprint, format_type, output_orthography, executor_backend, processes)
+                )
+                if worker_pool.cold_start_seconds is None:
+                    worker_pool.wait_until_ready()
+                    worker_cold_starts.append((processes, worker_pool.cold_start_seconds))
+                converted = worker_pool.convert_lines(
+                    changed_paragraphs, progress_callback=report_progress, normalization_counters=normalization_counters
+                )
+            else:
+                converted = list(output_engine.convert_lines(
+                    changed_paragraphs, progress_callback=report_progress, normalization_counters=normalization_counters
+                ))
+            if conversion_plan:
+                record_actual_seconds(conversion_plan, time.perf_counter() - started)
+            return converted
+
+        converted_paragraphs, num_changed_paragraphs = reconvert_changed_lines(
+            paragraphs, previous_lines, previous_results, convert_paragraphs
+        )
+        progress_bar.empty()
+        st.session_state["converted_paragraphs"] = (conversion_key, paragraphs, converted_paragraphs)
+        processed_text = ''.join(converted_paragraphs)
+        cache_counters_after = replacement_engine.cache_counters()
+        cache_hits = (cache_counters_after["memory_hits"] - cache_counters_before["memory_hits"]
+                      + cache_counters_after["disk_hits"] - cache_counters_before["disk_hits"])
+        st.caption(
+            f"{num_changed_paragraphs} von {len(paragraphs)} Absätzen neu ersetzt "
+            f"(davon {cache_hits} aus dem Zeilen-Cache); unveränderte Absätze wurden vom letzten Durchlauf übernommen."
+        )
+        for cold_start_processes, cold_start_seconds in worker_cold_starts:
+            st.caption(
+                f"Kaltstart der Worker ({cold_start_processes} × {EXECUTOR_BACKEND_LABELS[executor_backend]}, "
+                f"Startmethode: {worker_start_method}): {cold_start_seconds:.2f} s."
+            )
+        if conversion_plan:
+            mode_label = (
+                f"parallel mit {conversion_plan['num_processes']} Prozessen"
+                if conversion_plan["mode"] == "parallel" else "seriell"
+            )
+            st.caption(
+                f"Automatische Wahl: {mode_label} ({PLAN_REASON_LABELS[conversion_plan['reason']]}; "
+                f"verfügbare CPUs: {conversion_plan['cpu_count']}). "
+                f"Vorhergesagt {conversion_plan['predicted_seconds']:.2f} s "
+                f"(seriell {conversion_plan['predicted_serial_seconds']:.2f} s), "
+                f"tatsächlich {conversion_plan['actual_seconds']:.2f} s."
+            )
+        if normalization_counters["documents"]:
+            skipped_stages = ', '.join(
+                f"{label} {normalization_counters[key]}×" for key, label in NORMALIZATION_STAGE_LABELS.items()
+            )
+            st.caption(
+                f"Vorverarbeitung der {normalization_counters['documents']} ersetzten Textabschnitte – "
+                f"übersprungen, weil nicht nötig: {skipped_stages} "
+                f"(alle Schritte übersprungen: {normalization_counters['all_skipped']}×)."
+            )
 
-        processed_text = apply_ruby_html_header_and_footer(processed_text, format_type)
+        processed_text = replacement_engine.apply_html_header_and_footer(processed_text)
 
 #=================================================================
 # =========================================
@@ -38,7 +38,7 @@ import re
 import json
 import streamlit as st
 from typing import List, Dict, Tuple, Optional
-import multiprocessing
+import time
 from io import StringIO
 import streamlit.components.v1 as components
 
@@ -61,8 +61,35 @@ from esp_replacement_json_make_module import (
     capitalize_ruby_and_rt,
     process_chunk_for_pre_replacements,
     parallel_build_pre_replacements_dict,
+    calibrate_pre_replacements_planner,
     remove_redundant_ruby_if_identical
 )
+from esp_pattern_matcher_module import KgramBitsetRuleFilter
+from esp_parallel_planning_module import record_actual_seconds
+from esp_executor_module import (
+    EXECUTOR_BACKENDS,
+    DEFAULT_EXECUTOR_BACKEND,
+    DEFAULT_WORKER_START_METHOD,
+    configure_worker_start_method
+)
+
+# このページから先に開かれた場合も、main.py と同じ起動方式 (forkserver / spawn) でワーカーを起動する
+# (ワーカーにはこのページのスクリプトを import し直させない)
+configure_worker_start_method(DEFAULT_WORKER_START_METHOD, hide_main_module=True)
+
+# 自動モードの判断理由の表示 (main.py と同じ)
+PLAN_REASON_LABELS = {
+    "single_cpu": "nur eine CPU verfügbar",
+    "small_input": "Datenmenge zu klein, der Start der Prozesse würde länger dauern",
+    "overhead": "der Start der Prozesse würde den Zeitgewinn aufheben",
+    "faster": "parallele Verarbeitung ist voraussichtlich schneller",
+    "serial_backend": "die gewählte Ausführungsart arbeitet nicht parallel"
+}
+EXECUTOR_BACKEND_LABELS = {
+    "process": "Prozesse (multiprocessing)",
+    "thread": "Threads (ohne Prozessstart; echte Parallelität nur mit free-threaded Python 3.13+)",
+    "inline": "Inline (ohne Parallelisierung, zum Vergleich)"
+}
 
 
 #---------------------------------------------------------------------
@@ -406,8 +433,33 @@ with st.expander("Einstellungen für Parallelverarbeitung anzeigen"):
     Bei sehr großen Datenmengen kann die Nutzung mehrerer CPU-Kerne zu einer Leistungssteigerung führen.
     """)
 
-    use_parallel = st.checkbox("Parallelverarbeitung verwenden", value=False)
-    num_processes = st.number_input("Anzahl gleichzeitiger Prozesse", min_value=2, max_value=6, value=5, step=1)
+    # 自動: CPU 数・語根の数・(その場で測った)1語根あたりの時間とワーカーの起動時間から、直列か何プロセスかを選ぶ
+    parallel_mode = st.radio(
+        "Verarbeitungsmodus",
+        ("自動", "直列", "並列"),
+        format_func=lambda x: (
+            "Automatisch (seriell oder parallel, Prozessanzahl nach CPU und Datenmenge)" if x == "自動"
+            else ("Seriell" if x == "直列" else "Parallel mit fester Prozessanzahl")
+        )
+    )
+    num_processes = st.number_input(
+        "Anzahl gleichzeitiger Prozesse (nur für \"Parallel mit fester Prozessanzahl\")",
+        min_value=2, max_value=6, value=5, step=1
+    )
+    # 並列処理をプロセス / スレッド / インラインのどれで実行するか (esp_executor_module)
+    executor_backend = st.radio(
+        "Ausführungsart der Parallelverarbeitung",
+        EXECUTOR_BACKENDS,
+        index=EXECUTOR_BACKENDS.index(DEFAULT_EXECUTOR_BACKEND),
+        format_func=lambda x: EXECUTOR_BACKEND_LABELS[x]
+    )
+
+    # safe_replace() の前に、入力に現れえない規則を k-gram の bitset で除外する (結果は同じ)
+    use_rule_filter = st.checkbox("Regeln vorab mit einem k-Gramm-Bitset (Bloom-Filter) ausschließen", value=True)
+    rule_filter_false_positive_rate = st.number_input(
+        "Zulässige Falsch-Positiv-Rate des Filters",
+        min_value=0.0001, max_value=0.5, value=0.01, step=0.005, format="%.4f"
+    )
 
 st.write("### Erstellen der endgültigen Ersetzungs-JSON-Datei (Button)")
 
@@ -464,14 +516,41 @@ if st.button("JSON-Datei für die Ersetzung erstellen"):
                 imported_placeholders_for_global_replacement[kk]
             ])
 
+        # temporary_replacements_list_final は以後変更しないので、絞り込み用のフィルタを1回だけ作る
+        rule_filter = None
+        rule_filter_counters = {}
+        if use_rule_filter:
+            rule_filter = KgramBitsetRuleFilter(
+                temporary_replacements_list_final,
+                false_positive_rate=rule_filter_false_positive_rate
+            )
+
         #-------------------------------------------------------------
         # (6) parallel_build_pre_replacements_dict
+        #     (自動モードでは、ここで1回だけ計測して直列/並列を決める)
         #-------------------------------------------------------------
+        build_plan = {}
+        if parallel_mode == "自動":
+            build_planner = calibrate_pre_replacements_planner(
+                E_stem_with_Part_Of_Speech_list,
+                temporary_replacements_list_final,
+                rule_filter_false_positive_rate if use_rule_filter else None,
+                executor_backend=executor_backend
+            )
+            build_plan = build_planner.plan(len(E_stem_with_Part_Of_Speech_list))
+            use_parallel, build_processes = build_plan["mode"] == "parallel", build_plan["num_processes"]
+        else:
+            use_parallel, build_processes = parallel_mode == "並列", num_processes
+        build_started = time.perf_counter()
+
         if use_parallel:
             pre_replacements_dict_1 = parallel_build_pre_replacements_dict(
                 E_stem_with_Part_Of_Speech_list,
                 temporary_replacements_list_final,
-                num_processes
+                build_processes,
+                rule_filter_false_positive_rate if use_rule_filter else None,
+                rule_filter_counters,
+                executor_backend
             )
         else:
             progress_bar = st.progress(0)
@@ -490,7 +569,7 @@ if st.button("JSON-Datei für die Ersetzung erstellen"):
                                 ]
                         else:
                             pre_replacements_dict_1[j[0]] = [
-                                safe_replace(j[0], temporary_replacements_list_final),
+                                safe_replace(j[0], temporary_replacements_list_final, rule_filter),
                                 j[1]
                             ]
                 if i % 1000 == 0:
@@ -503,6 +582,19 @@ if st.button("JSON-Datei für die Ersetzung erstellen"):
             progress_text.write("Die aufwändigste Verarbeitung ist zu 100 % abgeschlossen. (3–4 Sekunden benötigt)")
 
 
+        if build_plan:
+            record_actual_seconds(build_plan, time.perf_counter() - build_started)
+            build_mode_label = (
+                f"parallel mit {build_plan['num_processes']} Prozessen" if build_plan["mode"] == "parallel" else "seriell"
+            )
+            st.caption(
+                f"Automatische Wahl: {build_mode_label} ({PLAN_REASON_LABELS[build_plan['reason']]}; "
+                f"verfügbare CPUs: {build_plan['cpu_count']}). "
+                f"Vorhergesagt {build_plan['predicted_seconds']:.2f} s "
+                f"(seriell {build_plan['predicted_serial_seconds']:.2f} s), "
+                f"tatsächlich {build_plan['actual_seconds']:.2f} s."
+            )
+
         # 例: 処理上、除外したいキーをここでpopする (domen, teren, posten等)
         keys_to_remove = ['domen', 'teren','posten']
         for key in keys_to_remove:
@@ -553,7 +645,7 @@ if st.button("JSON-Datei für die Ersetzung erstellen"):
         verb_suffix_2l_2={}
         for original_verb_suffix,replaced_verb_suffix in verb_suffix_2l.items():
             # 例: 'as'→'as' のままのことが多いが、safe_replaceで更に別ルビを当てはめる可能性あり
-            verb_suffix_2l_2[original_verb_suffix] = safe_replace(replaced_verb_suffix, temporary_replacements_list_final)
+            verb_suffix_2l_2[original_verb_suffix] = safe_replace(replaced_verb_suffix, temporary_replacements_list_final, rule_filter)
 
         # 一番の工夫ポイント(以下、コメントはコード内にある通り):
         #  置換の優先順位をどう定めるかで、置換の精度が大きく変わる。
@@ -563,7 +655,7 @@ if st.button("JSON-Datei für die Ersetzung erstellen"):
         # という流れで段階的に書き換え、最終的に "replacements_final_list" へまとめる方針。
 
         unchangeable_after_creation_list=[]
-        AN_replacement = safe_replace('an', temporary_replacements_list_final)
+        AN_replacement = safe_replace('an', temporary_replacements_list_final, rule_filter)
         AN_treatment=[]
 
         pre_replacements_dict_3={}
@@ -700,10 +792,10 @@ if st.button("JSON-Datei für die Ersetzung erstellen"):
                 i5 = i3+"/an/a"
                 i6 = i3+"/an/e"
                 i7 = i3+"/a/n/"
-                pre_replacements_dict_3[i4.replace('/', '')] = [safe_replace(i4,temporary_replacements_list_final).replace("</rt></ruby>","%%%").replace('/', '').replace("%%%","</rt></ruby>"), (len(i4.replace('/', ''))-1)*10000+3000]
-                pre_replacements_dict_3[i5.replace('/', '')] = [safe_replace(i5,temporary_replacements_list_final).replace("</rt></ruby>","%%%").replace('/', '').replace("%%%","</rt></ruby>"), (len(i5.replace('/', ''))-1)*10000+3000]
-                pre_replacements_dict_3[i6.replace('/', '')] = [safe_replace(i6,temporary_replacements_list_final).replace("</rt></ruby>","%%%").replace('/', '').replace("%%%","</rt></ruby>"), (len(i6.replace('/', ''))-1)*10000+3000]
-                pre_replacements_dict_3[i7.replace('/', '')] = [safe_replace(i7,temporary_replacements_list_final).replace("</rt></ruby>","%%%").replace('/', '').replace("%%%","</rt></ruby>"), (len(i7.replace('/', ''))-1)*10000+3000]
+                pre_replacements_dict_3[i4.replace('/', '')] = [safe_replace(i4, temporary_replacements_list_final, rule_filter).replace("</rt></ruby>","%%%").replace('/', '').replace("%%%","</rt></ruby>"), (len(i4.replace('/', ''))-1)*10000+3000]
+                pre_replacements_dict_3[i5.replace('/', '')] = [safe_replace(i5, temporary_replacements_list_final, rule_filter).replace("</rt></ruby>","%%%").replace('/', '').replace("%%%","</rt></ruby>"), (len(i5.replace('/', ''))-1)*10000+3000]
+                pre_replacements_dict_3[i6.replace('/', '')] = [safe_replace(i6, temporary_replacements_list_final, rule_filter).replace("</rt></ruby>","%%%").replace('/', '').replace("%%%","</rt></ruby>"), (len(i6.replace('/', ''))-1)*10000+3000]
+                pre_replacements_dict_3[i7.replace('/', '')] = [safe_replace(i7, temporary_replacements_list_final, rule_filter).replace("</rt></ruby>","%%%").replace('/', '').replace("%%%","</rt></ruby>"), (len(i7.replace('/', ''))-1)*10000+3000]
             else:
                 # 末尾に"an"がつくパターンに準じた置換処理
                 i2 = an[1]
@@ -713,10 +805,10 @@ if st.button("JSON-Datei für die Ersetzung erstellen"):
                 i5 = i3+"an/a"
                 i6 = i3+"an/e"
                 i7 = i3+"/a/n/"
-                pre_replacements_dict_3[i4.replace('/', '')] = [safe_replace(i4,temporary_replacements_list_final).replace("</rt></ruby>","%%%").replace('/', '').replace("%%%","</rt></ruby>"), (len(i4.replace('/', ''))-1)*10000+3000]
-                pre_replacements_dict_3[i5.replace('/', '')] = [safe_replace(i5,temporary_replacements_list_final).replace("</rt></ruby>","%%%").replace('/', '').replace("%%%","</rt></ruby>"), (len(i5.replace('/', ''))-1)*10000+3000]
-                pre_replacements_dict_3[i6.replace('/', '')] = [safe_replace(i6,temporary_replacements_list_final).replace("</rt></ruby>","%%%").replace('/', '').replace("%%%","</rt></ruby>"), (len(i6.replace('/', ''))-1)*10000+3000]
-                pre_replacements_dict_3[i7.replace('/', '')] = [safe_replace(i7,temporary_replacements_list_final).replace("</rt></ruby>","%%%").replace('/', '').replace("%%%","</rt></ruby>"), (len(i7.replace('/', ''))-1)*10000+3000]
+                pre_replacements_dict_3[i4.replace('/', '')] = [safe_replace(i4, temporary_replacements_list_final, rule_filter).replace("</rt></ruby>","%%%").replace('/', '').replace("%%%","</rt></ruby>"), (len(i4.replace('/', ''))-1)*10000+3000]
+                pre_replacements_dict_3[i5.replace('/', '')] = [safe_replace(i5, temporary_replacements_list_final, rule_filter).replace("</rt></ruby>","%%%").replace('/', '').replace("%%%","</rt></ruby>"), (len(i5.replace('/', ''))-1)*10000+3000]
+                pre_replacements_dict_3[i6.replace('/', '')] = [safe_replace(i6, temporary_replacements_list_final, rule_filter).replace("</rt></ruby>","%%%").replace('/', '').replace("%%%","</rt></ruby>"), (len(i6.replace('/', ''))-1)*10000+3000]
+                pre_replacements_dict_3[i7.replace('/', '')] = [safe_replace(i7, temporary_replacements_list_final, rule_filter).replace("</rt></ruby>","%%%").replace('/', '').replace("%%%","</rt></ruby>"), (len(i7.replace('/', ''))-1)*10000+3000]
 
         for on in ON:
             if on[1].endswith("/on/"):
@@ -726,10 +818,10 @@ if st.button("JSON-Datei für die Ersetzung erstellen"):
                 i5 = i3+"/on/a"
                 i6 = i3+"/on/e"
                 i7 = i3+"/o/n/"
-                pre_replacements_dict_3[i4.replace('/', '')] = [safe_replace(i4,temporary_replacements_list_final).replace("</rt></ruby>","%%%").replace('/', '').replace("%%%","</rt></ruby>"), (len(i4.replace('/', ''))-1)*10000+3000]
-                pre_replacements_dict_3[i5.replace('/', '')] = [safe_replace(i5,temporary_replacements_list_final).replace("</rt></ruby>","%%%").replace('/', '').replace("%%%","</rt></ruby>"), (len(i5.replace('/', ''))-1)*10000+3000]
-                pre_replacements_dict_3[i6.replace('/', '')] = [safe_replace(i6,temporary_replacements_list_final).replace("</rt></ruby>","%%%").replace('/', '').replace("%%%","</rt></ruby>"), (len(i6.replace('/', ''))-1)*10000+3000]
-                pre_replacements_dict_3[i7.replace('/', '')] = [safe_replace(i7,temporary_replacements_list_final).replace("</rt></ruby>","%%%").replace('/', '').replace("%%%","</rt></ruby>"), (len(i7.replace('/', ''))-1)*10000+3000]
+                pre_replacements_dict_3[i4.replace('/', '')] = [safe_replace(i4, temporary_replacements_list_final, rule_filter).replace("</rt></ruby>","%%%").replace('/', '').replace("%%%","</rt></ruby>"), (len(i4.replace('/', ''))-1)*10000+3000]
+                pre_replacements_dict_3[i5.replace('/', '')] = [safe_replace(i5, temporary_replacements_list_final, rule_filter).replace("</rt></ruby>","%%%").replace('/', '').replace("%%%","</rt></ruby>"), (len(i5.replace('/', ''))-1)*10000+3000]
+                pre_replacements_dict_3[i6.replace('/', '')] = [safe_replace(i6, temporary_replacements_list_final, rule_filter).replace("</rt></ruby>","%%%").replace('/', '').replace("%%%","</rt></ruby>"), (len(i6.replace('/', ''))-1)*10000+3000]
+                pre_replacements_dict_3[i7.replace('/', '')] = [safe_replace(i7, temporary_replacements_list_final, rule_filter).replace("</rt></ruby>","%%%").replace('/', '').replace("%%%","</rt></ruby>"), (len(i7.replace('/', ''))-1)*10000+3000]
             else:
                 i2 = on[1]
                 i2_2 = re.sub(r"on$", "", i2)
@@ -738,10 +830,10 @@ if st.button("JSON-Datei für die Ersetzung erstellen"):
                 i5 = i3+"on/a"
                 i6 = i3+"on/e"
                 i7 = i3+"/o/n/"
-                pre_replacements_dict_3[i4.replace('/', '')] = [safe_replace(i4,temporary_replacements_list_final).replace("</rt></ruby>","%%%").replace('/', '').replace("%%%","</rt></ruby>"), (len(i4.replace('/', ''))-1)*10000+3000]
-                pre_replacements_dict_3[i5.replace('/', '')] = [safe_replace(i5,temporary_replacements_list_final).replace("</rt></ruby>","%%%").replace('/', '').replace("%%%","</rt></ruby>"), (len(i5.replace('/', ''))-1)*10000+3000]
-                pre_replacements_dict_3[i6.replace('/', '')] = [safe_replace(i6,temporary_replacements_list_final).replace("</rt></ruby>","%%%").replace('/', '').replace("%%%","</rt></ruby>"), (len(i6.replace('/', ''))-1)*10000+3000]
-                pre_replacements_dict_3[i7.replace('/', '')] = [safe_replace(i7,temporary_replacements_list_final).replace("</rt></ruby>","%%%").replace('/', '').replace("%%%","</rt></ruby>"), (len(i7.replace('/', ''))-1)*10000+3000]
+                pre_replacements_dict_3[i4.replace('/', '')] = [safe_replace(i4, temporary_replacements_list_final, rule_filter).replace("</rt></ruby>","%%%").replace('/', '').replace("%%%","</rt></ruby>"), (len(i4.replace('/', ''))-1)*10000+3000]
+                pre_replacements_dict_3[i5.replace('/', '')] = [safe_replace(i5, temporary_replacements_list_final, rule_filter).replace("</rt></ruby>","%%%").replace('/', '').replace("%%%","</rt></ruby>"), (len(i5.replace('/', ''))-1)*10000+3000]
+                pre_replacements_dict_3[i6.replace('/', '')] = [safe_replace(i6, temporary_replacements_list_final, rule_filter).replace("</rt></ruby>","%%%").replace('/', '').replace("%%%","</rt></ruby>"), (len(i6.replace('/', ''))-1)*10000+3000]
+                pre_replacements_dict_3[i7.replace('/', '')] = [safe_replace(i7, temporary_replacements_list_final, rule_filter).replace("</rt></ruby>","%%%").replace('/', '').replace("%%%","</rt></ruby>"), (len(i7.replace('/', ''))-1)*10000+3000]
 
         #-------------------------------------------------------------
         # (9) custom_stemming_setting_list (ユーザーが定義した語根分解法) を適用
@@ -786,7 +878,7 @@ if st.button("JSON-Datei für die Ersetzung erstellen"):
                         replacement_priority_by_length = int(i[1])
 
                     # ここで "i[0]"をsafe_replaceしてルビ等を入れる
-                    Replaced_String = safe_replace(i[0], temporary_replacements_list_final)\
+                    Replaced_String = safe_replace(i[0], temporary_replacements_list_final, rule_filter)\
                                       .replace("</rt></ruby>","%%%").replace('/', '').replace("%%%","</rt></ruby>")
 
                     if "ne" in i[2]:
@@ -803,7 +895,7 @@ if st.button("JSON-Datei für die Ersetzung erstellen"):
                     if len(i[2])>=1:
                         for j_item in i[2]:
                             j2 = j_item.replace('/', '')
-                            j3 = safe_replace(j_item,temporary_replacements_list_final)\
+                            j3 = safe_replace(j_item, temporary_replacements_list_final, rule_filter)\
                                   .replace("</rt></ruby>","%%%").replace('/', '').replace("%%%","</rt></ruby>")
                             pre_replacements_dict_3[esperanto_Word_before_replacement + j2] = [Replaced_String + j3, replacement_priority_by_length+len(j2)*10000]
                     else:
@@ -856,7 +948,7 @@ if st.button("JSON-Datei für die Ersetzung erstellen"):
                         if len(i[2])>=1:
                             for j_item in i[2]:
                                 j2 = j_item.replace('/', '')
-                                j3 = safe_replace(j_item, temporary_replacements_list_final)\
+                                j3 = safe_replace(j_item, temporary_replacements_list_final, rule_filter)\
                                       .replace("</rt></ruby>","%%%").replace('/', '').replace("%%%","</rt></ruby>")
                                 pre_replacements_dict_3[esperanto_Word_before_replacement + j2] = [Replaced_String + j3, replacement_priority_by_length+len(j2)*10000]
                         else:
@@ -945,7 +1037,7 @@ if st.button("JSON-Datei für die Ersetzung erstellen"):
         #-------------------------------------------------------------
         replacements_list_for_suffix_2char_roots = []
         for i in range(len(suffix_2char_roots)):
-            replaced_suffix = remove_redundant_ruby_if_identical(safe_replace(suffix_2char_roots[i], temporary_replacements_list_final))
+            replaced_suffix = remove_redundant_ruby_if_identical(safe_replace(suffix_2char_roots[i], temporary_replacements_list_final, rule_filter))
             replacements_list_for_suffix_2char_roots.append([
                 "$"+suffix_2char_roots[i],
                 "$"+replaced_suffix,
@@ -964,7 +1056,7 @@ if st.button("JSON-Datei für die Ersetzung erstellen"):
 
         replacements_list_for_prefix_2char_roots = []
         for i in range(len(prefix_2char_roots)):
-            replaced_prefix = remove_redundant_ruby_if_identical(safe_replace(prefix_2char_roots[i], temporary_replacements_list_final))
+            replaced_prefix = remove_redundant_ruby_if_identical(safe_replace(prefix_2char_roots[i], temporary_replacements_list_final, rule_filter))
             replacements_list_for_prefix_2char_roots.append([
                 prefix_2char_roots[i]+"$",
                 replaced_prefix+"$",
@@ -983,7 +1075,7 @@ if st.button("JSON-Datei für die Ersetzung erstellen"):
 
         replacements_list_for_standalone_2char_roots = []
         for i in range(len(standalone_2char_roots)):
-            replaced_standalone = remove_redundant_ruby_if_identical(safe_replace(standalone_2char_roots[i], temporary_replacements_list_final))
+            replaced_standalone = remove_redundant_ruby_if_identical(safe_replace(standalone_2char_roots[i], temporary_replacements_list_final, rule_filter))
             replacements_list_for_standalone_2char_roots.append([
                 " "+standalone_2char_roots[i]+" ",
                 " "+replaced_standalone+" ",
@@ -1063,6 +1155,10 @@ if st.button("JSON-Datei für die Ersetzung erstellen"):
         #-------------------------------------------------------------
         download_data = json.dumps(combined_data, ensure_ascii=False, indent=2)
         st.success("Die Ersetzungsliste wurde erfolgreich generiert!")
+        if rule_filter is not None:
+            rules_scanned = rule_filter.rules_scanned + rule_filter_counters.get('scanned', 0)
+            rules_skipped = rule_filter.rules_skipped + rule_filter_counters.get('skipped', 0)
+            st.write(f"k-Gramm-Filter: {rules_skipped} Regelprüfungen übersprungen, {rules_scanned} Regelprüfungen durchgeführt.")
 
         st.download_button(
             label="Abschließende Ersetzungsliste (Fusion aus 3 JSON-Dateien) herunterladen",
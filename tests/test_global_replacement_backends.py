@@ -0,0 +1,176 @@
+# test_global_replacement_backends.py
+"""
+大域置換の backend ("sequential" / "automaton") と、placeholder を使わない span pipeline の結果が
+一致することを確かめる差分テスト。
+
+規則は esp_replacement_json_make_module が作る置換用JSONと同じ形の小さな規則を、ここで組み立てる
+- 大域置換: (old, new, '$N$') を old の長い順 (= 優先順位) に並べる。大文字 ('$Nup$') / 先頭だけ大文字 ('$Ncap$') の規則も作る
+- 局所置換 (@...@ の中): (old, new, '@N@')
+- 2文字語根: '$xx' / 'xx$' / ' xx ' の3つの形 (placeholder はそれぞれ '$$N$' / '$N$$' / ' $N$ ')
+- %...% スキップ用 / @...@ 局所置換の結果用の placeholder: '%N%' / '@N@'
+入力は %...% / @...@ が入れ子にならず、必ず閉じている (well-formed な) 文を乱数で作る。
+"""
+
+import os
+import sys
+import random
+from typing import List, Tuple
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from esp_text_replacement_module import orchestrate_comprehensive_esperanto_text_replacement
+from esp_replacement_engine_module import ReplacementEngine
+
+# ================================
+# 1) 規則 (置換用JSONと同じ形)
+# ================================
+# (語根, 訳語): 大域置換の規則の old / new の部品
+ROOTS = [
+    ("inter", "間"), ("konsent", "同意"), ("dom", "家"), ("lern", "学"), ("ant", "者"),
+    ("ŝip", "船"), ("ĉambr", "部屋"), ("ĝust", "正"), ("est", "在"), ("hav", "持"),
+    ("bon", "良"), ("parol", "話"), ("sci", "知"), ("ej", "所"), ("mal", "反")
+]
+# 複数の語根をつないだ規則 (短い規則と重なるので、old の長い順の優先順位が効く)
+COMPOUNDS = [("inter", "konsent"), ("lern", "ant"), ("lern", "ej"), ("mal", "bon"), ("ŝip", "ej"), ("parol", "ant")]
+# 2文字語根
+TWO_CHAR_ROOTS = [("al", "へ"), ("ad", "続"), ("ne", "不"), ("ek", "始")]
+# 局所置換 (@...@ の中だけで使う) の規則
+LOCALIZED_ROOTS = [("ŝat", "好"), ("dom", "館"), ("ad", "継")]
+
+def ruby(root: str, gloss: str) -> str:
+    return f'<ruby>{root}<rt class="M_M">{gloss}</rt></ruby>'
+
+def capitalize_first_letter(new: str) -> str:
+    # '<ruby>' の後の最初の文字だけを大文字にする
+    start = len("<ruby>") if new.startswith("<ruby>") else 0
+    return new[:start] + new[start:start + 1].upper() + new[start + 1:]
+
+def case_variants(old: str, new: str, placeholder_number: int, placeholder_format: str) -> List[Tuple[str, str, str]]:
+    """小文字 / 大文字 / 先頭だけ大文字 の規則 (placeholder は 'N' / 'Nup' / 'Ncap')。"""
+    return [
+        (old, new, placeholder_format.format(f"{placeholder_number}")),
+        (old.upper(), new.upper(), placeholder_format.format(f"{placeholder_number}up")),
+        (old.capitalize(), capitalize_first_letter(new), placeholder_format.format(f"{placeholder_number}cap"))
+    ]
+
+def build_ruleset():
+    replacements_final_list = []
+    placeholder_number = 20000
+    words = [(root, ruby(root, gloss)) for root, gloss in ROOTS]
+    glosses = dict(ROOTS)
+    words += [("".join(parts), "".join(ruby(part, glosses[part]) for part in parts)) for parts in COMPOUNDS]
+    for old, new in words:
+        replacements_final_list += case_variants(old, new, placeholder_number, "${}$")
+        placeholder_number += 1
+    replacements_final_list.sort(key=lambda rule: len(rule[0]), reverse=True)
+
+    replacements_list_for_2char = []
+    placeholder_number = 13246
+    for form in ("${}", "{}$", " {} "):
+        for root, gloss in TWO_CHAR_ROOTS:
+            placeholder = form.format("${}$")
+            for old, new, placeholder_ in case_variants(root, ruby(root, gloss), placeholder_number, placeholder):
+                replacements_list_for_2char.append((form.format(old), form.format(new), placeholder_))
+            placeholder_number += 1
+
+    replacements_list_for_localized_string = []
+    placeholder_number = 20374
+    for root, gloss in LOCALIZED_ROOTS:
+        for old, new, _ in case_variants(root, ruby(root, gloss), 0, "{}"):
+            replacements_list_for_localized_string.append((old, new, f"@{placeholder_number}@"))
+            placeholder_number += 1
+    replacements_list_for_localized_string.sort(key=lambda rule: len(rule[0]), reverse=True)
+
+    placeholders_for_skipping_replacements = [f"%{number}%" for number in range(1854, 1954)]
+    placeholders_for_localized_replacement = [f"@{number}@" for number in range(5134, 5234)]
+    return (
+        replacements_final_list, replacements_list_for_localized_string, replacements_list_for_2char,
+        placeholders_for_skipping_replacements, placeholders_for_localized_replacement
+    )
+
+RULESET = build_ruleset()
+
+# ================================
+# 2) 入力 (well-formed な %...% / @...@ を含む文)
+# ================================
+X_SYSTEM = {"ĉ": "cx", "ĝ": "gx", "ŝ": "sx"}
+HAT_SYSTEM = {"ĉ": "c^", "ĝ": "g^", "ŝ": "s^"}
+ENDINGS = ["", "o", "a", "as", "is", "oj", "on", "e", "i"]
+
+def random_word(rnd: random.Random) -> str:
+    kind = rnd.random()
+    if kind < 0.25:
+        word = rnd.choice(TWO_CHAR_ROOTS)[0] + rnd.choice(ENDINGS)
+    elif kind < 0.35:
+        word = rnd.choice(TWO_CHAR_ROOTS)[0]
+    else:
+        roots = [rnd.choice(ROOTS + LOCALIZED_ROOTS)[0] for _ in range(rnd.randint(1, 3))]
+        if rnd.random() < 0.3:
+            roots.insert(rnd.randint(0, len(roots)), rnd.choice(TWO_CHAR_ROOTS)[0])
+        word = "".join(roots) + rnd.choice(ENDINGS)
+    case = rnd.random()
+    if case < 0.1:
+        word = word.upper()
+    elif case < 0.3:
+        word = word.capitalize()
+    # 入力の表記 (cx / c^) は正規化で ĉ にそろえられる
+    orthography = rnd.random()
+    for letter in X_SYSTEM:
+        if orthography < 0.2:
+            word = word.replace(letter, X_SYSTEM[letter])
+        elif orthography < 0.3:
+            word = word.replace(letter, HAT_SYSTEM[letter])
+    return word
+
+def random_text(rnd: random.Random) -> str:
+    tokens = []
+    for _ in range(rnd.randint(1, 25)):
+        markup = rnd.random()
+        if markup < 0.1:
+            tokens.append("%" + " ".join(random_word(rnd) for _ in range(rnd.randint(1, 2))) + "%")
+        elif markup < 0.2:
+            tokens.append("@" + random_word(rnd) + "@")
+        else:
+            tokens.append(random_word(rnd))
+        tokens.append(rnd.choice([" ", " ", " ", ", ", ". ", "  ", "　"]))
+    return "".join(tokens).strip()
+
+# ================================
+# 3) テスト
+# ================================
+FORMAT_TYPES = ["HTML格式_Ruby文字_大小调整", "HTML格式", "括弧(号)格式"]
+OUTPUT_ORTHOGRAPHIES = [None, "x", "hat"]
+
+def orchestrate(text: str, format_type: str, backend: str, output_orthography) -> str:
+    (replacements_final_list, replacements_list_for_localized_string, replacements_list_for_2char,
+     placeholders_for_skipping_replacements, placeholders_for_localized_replacement) = RULESET
+    return orchestrate_comprehensive_esperanto_text_replacement(
+        text, placeholders_for_skipping_replacements, replacements_list_for_localized_string,
+        placeholders_for_localized_replacement, replacements_final_list, replacements_list_for_2char,
+        format_type, global_replacement_backend=backend, output_orthography=output_orthography
+    )
+
+@pytest.mark.parametrize("format_type", FORMAT_TYPES)
+@pytest.mark.parametrize("output_orthography", OUTPUT_ORTHOGRAPHIES)
+def test_backends_and_span_pipeline_agree(format_type, output_orthography):
+    span_engine = ReplacementEngine(*RULESET, format_type, pipeline="span", output_orthography=output_orthography)
+    rnd = random.Random(f"{format_type}/{output_orthography}")
+    for _ in range(300):
+        text = random_text(rnd)
+        sequential = orchestrate(text, format_type, "sequential", output_orthography)
+        assert orchestrate(text, format_type, "automaton", output_orthography) == sequential, text
+        assert span_engine.convert(text) == sequential, text
+
+def test_rules_of_every_kind_are_applied():
+    # 乱数の入力だけでは、どの規則も使われていないのに一致している、ということがないように
+    text = "Interkonsento, @ŝato@ kaj %domo% al lernanto ne EST sxipejo"
+    sequential = orchestrate(text, "HTML格式", "sequential", None)
+    assert ruby("konsent", "同意") in sequential
+    assert ruby("ŝat", "好") in sequential
+    assert "domo" in sequential and ruby("dom", "家") not in sequential
+    assert ruby("al", "へ") in sequential
+    assert ruby("ne", "不") in sequential
+    assert ruby("ŝip", "船") + ruby("ej", "所") in sequential
+    assert "$" not in sequential and "%" not in sequential and "@" not in sequential